@@ -0,0 +1,157 @@
+from __future__ import annotations
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Optional, Tuple, Union
+import asyncio
+import os
+
+from .utils import write_atomic, xml_root
+
+# An asyncio front end for create_rxml and create_xtaltrak_recipe.
+#
+# Reading, parsing and solving run in an executor, at most max_concurrency conversions at a time,
+# so a slow screen does not block the event loop. Outputs are written to a temporary file and
+# renamed into place, so a cancelled conversion never leaves a partial file.
+
+# A path to read, or the xml itself
+XmlSource = Union[str, os.PathLike, bytes]
+
+
+class AsyncConverter:
+    '''
+    Runs conversions from asyncio code.
+
+    factory: A create_rxml.FactoriesJSON, or a reference.ReferenceDataManager in which case each
+        conversion uses the generation that is current when it starts. If None, FactoriesJSON(data_dir)
+        is loaded in the executor on first use.
+    executor: Defaults to a thread pool of max_concurrency workers, owned and shut down by close().
+
+    Cancelling a conversion stops waiting for it and skips writing its output. Work that is already
+    running in the executor finishes in the background as it cannot be interrupted.
+    '''
+
+    def __init__(self, factory=None, *, data_dir='data', max_concurrency: int = 4,
+                 executor: Optional[Executor] = None):
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be at least 1')
+        self.data_dir = data_dir
+        self.max_concurrency = max_concurrency
+        self._factory = factory
+        self._factory_lock = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._own_executor = executor is None
+        self._executor = ThreadPoolExecutor(max_concurrency) if executor is None else executor
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def get_factory(self):
+        if self._factory is None:
+            async with self._factory_lock:
+                if self._factory is None:
+                    from .create_rxml import FactoriesJSON
+                    self._factory = await self._run(FactoriesJSON, self.data_dir)
+        factory = self._factory
+        # A ReferenceDataManager
+        if hasattr(factory, 'current'):
+            factory = factory.current
+        return factory
+
+    async def convert_design(self, design_xml: XmlSource, recipe_xml: Optional[XmlSource] = None, *,
+                             output_xml=None, include_aliases: bool = False) -> str:
+        '''
+        The async create_rxml.to_rm_xml. Returns the RockMaker xml and writes it to output_xml if given.
+        '''
+        from .create_rxml import to_rm_xml
+
+        def convert(factory):
+            design_xo = xml_root(design_xml)
+            recipe_xo = None if recipe_xml is None else xml_root(recipe_xml)
+            return to_rm_xml(factory=factory, design_xo=design_xo, recipe_xo=recipe_xo,
+                             include_aliases=include_aliases)
+
+        factory = await self.get_factory()
+        async with self._semaphore:
+            xmlstr = await self._run(convert, factory)
+            if output_xml is not None:
+                await self._run(write_atomic, output_xml, xmlstr)
+        return xmlstr
+
+    async def convert_rxml(self, rmxml: XmlSource, *, volume: float, require_exact_ph: bool = True,
+                           output_xml=None, name: Optional[str] = None) -> str:
+        '''
+        The async create_xtaltrak_recipe.main. The screen name defaults to the stem of the path, or
+        of a stream's name, and is empty for bytes and buffers.
+        Returns the XtalTrak recipe xml and writes it to output_xml if given.
+        '''
+        from .create_xtaltrak_recipe import convert_screen
+        from .factories import rockmaker
+
+        if name is None:
+            path = rmxml if isinstance(rmxml, (str, os.PathLike)) else getattr(rmxml, 'name', None)
+            name = Path(path).stem if isinstance(path, (str, os.PathLike)) else ''
+
+        def convert(factory):
+            screen = rockmaker.screen_from_rxml_dom(xml_root(rmxml), name=name)
+            return convert_screen(screen=screen, volume=volume,
+                                  require_exact_ph=require_exact_ph, factory=factory)
+
+        factory = await self.get_factory()
+        async with self._semaphore:
+            xmlstr = await self._run(convert, factory)
+            if output_xml is not None:
+                await self._run(write_atomic, output_xml, xmlstr)
+        return xmlstr
+
+    async def convert_batch(self, jobs: Iterable[dict], *, kind: str = 'design',
+                            return_exceptions: bool = True) -> AsyncIterator[Tuple[dict, object]]:
+        '''
+        Converts each job (the keyword arguments of convert_design, or convert_rxml if kind is 'rxml')
+        and yields (job, xml) in the order they finish. A failed job yields (job, exception), or
+        raises if return_exceptions is False. Closing the iterator early cancels the remaining jobs.
+        '''
+        convert = {'design': self.convert_design, 'rxml': self.convert_rxml}[kind]
+
+        async def run(job):
+            try:
+                return job, await convert(**job)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return job, e
+
+        tasks = [asyncio.ensure_future(run(job)) for job in jobs]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        if self._own_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+async def convert_design(design_xml: XmlSource, recipe_xml: Optional[XmlSource] = None, *,
+                         factory=None, data_dir='data', **kwargs) -> str:
+    '''
+    A single conversion, see AsyncConverter.convert_design
+    '''
+    async with AsyncConverter(factory, data_dir=data_dir, max_concurrency=1) as converter:
+        return await converter.convert_design(design_xml, recipe_xml, **kwargs)
+
+
+async def convert_rxml(rmxml: XmlSource, *, volume: float, factory=None, data_dir='data', **kwargs) -> str:
+    '''
+    A single conversion, see AsyncConverter.convert_rxml
+    '''
+    async with AsyncConverter(factory, data_dir=data_dir, max_concurrency=1) as converter:
+        return await converter.convert_rxml(rmxml, volume=volume, **kwargs)
@@ -0,0 +1,185 @@
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional, Tuple
+import hashlib
+import json
+
+from .config.constants import LAB_NAME
+from .factories.names import normalize_name
+
+# Canonical forms of screens, designs and recipes for comparing their chemistry.
+#
+# The canonical form of a plate is {well id: well}, where a well is the sorted tuple of its
+# components. It does not depend on local ids, the order of sets or of the items within a well,
+# float noise below CANONICAL_DIGITS decimals, the case and spacing of chemical names, or
+# RockMaker's % unit prefix. Plate names are not part of the form, so renamed copies are equal.
+#
+# content_hash gives a stable sha256 of a canonical form, so equal chemistry has equal hashes
+# across processes and runs.
+
+CANONICAL_DIGITS = 6
+
+Well = Tuple[tuple, ...]
+Wells = Dict[int, Well]
+
+
+def canonical_number(value) -> Optional[float]:
+    if value is None:
+        return None
+    value = round(float(value), CANONICAL_DIGITS)
+    # -0.0 == 0.0 but they hash differently as text
+    return value + 0.0
+
+
+def canonical_name(name: Optional[str]) -> Optional[str]:
+    if name is None:
+        return None
+    return ' '.join(name.lower().split())
+
+
+def chemical_name(name: str) -> str:
+    # Without the lab suffix of the ingredients written by create_rxml (see Ingredient.name)
+    name = canonical_name(name)
+    suffix = f' {LAB_NAME.lower()}'
+    return name[:-len(suffix)] if name.endswith(suffix) else name
+
+
+def chemical_key(name: str) -> str:
+    '''
+    The same key for a chemical in a Screen, Design or SourcePlate, see names.normalize_name
+    '''
+    return normalize_name(chemical_name(name))
+
+
+def canonical_units(units: Optional[str]) -> Optional[str]:
+    if units is None:
+        return None
+    return units.strip().lstrip('%')
+
+
+def component_key(component: tuple):
+    # None sorts before any value
+    return tuple((x is not None, x) for x in component)
+
+
+def _well(components: Iterable[tuple]) -> Well:
+    return tuple(sorted(components, key=component_key))
+
+
+def screen_condition(condition) -> Well:
+    '''
+    A RockMaker condition: (ingredient, type, concentration, units, pH, stock concentration,
+    stock pH, high pH stock pH) for each condition ingredient
+    '''
+    components = []
+    for ci in condition:
+        high_ph_stock = ci.high_ph_stock
+        components.append((
+            canonical_name(ci.ingredient.ingredient_name),
+            ci.type,
+            canonical_number(ci.concentration),
+            canonical_units(ci.stock.units),
+            canonical_number(ci.ph),
+            canonical_number(ci.stock.stockConcentration),
+            canonical_number(ci.stock.ph),
+            None if high_ph_stock is None else canonical_number(high_ph_stock.ph),
+        ))
+    return _well(components)
+
+
+def screen_wells(screen) -> Wells:
+    return {
+        well_id: screen_condition(condition)
+        for well_id, condition in enumerate(screen.conditions, start=1)
+    }
+
+
+def design_well(design_well) -> Well:
+    '''
+    A CrystalTrak design well: (chemical, class, concentration, units, pH) for each item
+    '''
+    return _well(
+        (
+            canonical_name(di.chemical.name),
+            di.item_class,
+            canonical_number(di.concentration),
+            canonical_units(di.units),
+            canonical_number(di.ph),
+        )
+        for di in design_well.items
+    )
+
+
+def design_wells(design) -> Wells:
+    return {well_id: design_well(dw) for well_id, dw in design.wells.items()}
+
+
+def source_plate_wells(source_plate) -> Wells:
+    '''
+    A recipe: (stock, barcode, concentration, units, pH, volume) for each dispense into a well
+    '''
+    wells: Dict[int, List[tuple]] = {}
+    geometry = source_plate.geometry
+    for stock in source_plate.stocks:
+        stock_key = (
+            canonical_name(stock.stock_name),
+            stock.barcode or None,
+            canonical_number(stock.conc),
+            canonical_units(stock.units),
+            canonical_number(stock.ph),
+        )
+        for well in stock.wells:
+            wells.setdefault(geometry.id(well.name), []).append(
+                stock_key + (canonical_number(well.volume),))
+    return {well_id: _well(components) for well_id, components in wells.items()}
+
+
+def canonical_form(obj) -> Wells:
+    '''
+    The canonical wells of a Screen, Design or SourcePlate
+    '''
+    from .objects import rockmaker as objects_rm
+    from .objects import xtaltrak as objects_xt
+    if isinstance(obj, objects_rm.Screen):
+        return screen_wells(obj)
+    if isinstance(obj, objects_xt.Design):
+        return design_wells(obj)
+    if isinstance(obj, objects_xt.SourcePlate):
+        return source_plate_wells(obj)
+    raise TypeError(f'No canonical form for {type(obj).__name__}')
+
+
+def well_hash(well: Well) -> str:
+    return hashlib.sha256(
+        json.dumps(well, separators=(',', ':')).encode()).hexdigest()
+
+
+def content_hash(obj) -> str:
+    '''
+    A stable hash of a Screen, Design or SourcePlate, or of canonical wells
+    '''
+    wells = obj if isinstance(obj, dict) else canonical_form(obj)
+    hasher = hashlib.sha256()
+    for well_id in sorted(wells):
+        hasher.update(json.dumps([well_id, wells[well_id]], separators=(',', ':')).encode())
+        hasher.update(b'\n')
+    return hasher.hexdigest()
+
+
+def diff_wells(a: Wells, b: Wells) -> List[Tuple[int, List[tuple], List[tuple]]]:
+    '''
+    (well id, components only in a, components only in b) of each well that differs
+    '''
+    diffs = []
+    for well_id in sorted(a.keys() | b.keys()):
+        well_a, well_b = a.get(well_id, ()), b.get(well_id, ())
+        if well_a == well_b:
+            continue
+        only_a = list(well_a)
+        only_b = []
+        for component in well_b:
+            if component in only_a:
+                only_a.remove(component)
+            else:
+                only_b.append(component)
+        diffs.append((well_id, only_a, only_b))
+    return diffs
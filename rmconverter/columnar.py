@@ -0,0 +1,183 @@
+from __future__ import annotations
+from array import array
+from typing import Dict, Iterable, List, Tuple
+import math
+
+# Flattens screens and designs into columns for analysis:
+#   - a Screen into one row per condition ingredient (conditions x condition ingredients x stocks)
+#   - a Design into one row per design item (wells x items)
+# The rows of many screens or designs are built in a single pass into typed arrays. Strings such
+# as ingredient names and units are dictionary encoded: the column holds int32 codes into
+# table.dictionaries[column]. Missing numbers are NaN and missing ids -1.
+#
+# NumPy and pyarrow are only imported by to_numpy and to_arrow.
+
+# (column, array typecode), 'dict' columns are dictionary encoded strings
+SCREEN_COLUMNS = (
+    ('screen', 'dict'),
+    ('well_id', 'i'),
+    ('ingredient', 'dict'),
+    ('type', 'dict'),
+    ('concentration', 'd'),
+    ('units', 'dict'),
+    ('ph', 'd'),
+    ('stock_local_id', 'i'),
+    ('stock_concentration', 'd'),
+    ('stock_ph', 'd'),
+    ('high_ph_stock_local_id', 'i'),
+    ('high_ph_stock_ph', 'd'),
+    ('volume', 'd'),
+    ('high_ph_volume', 'd'),
+)
+
+DESIGN_COLUMNS = (
+    ('design', 'dict'),
+    ('well_id', 'i'),
+    ('chemical_id', 'i'),
+    ('chemical', 'dict'),
+    ('item_class', 'dict'),
+    ('concentration', 'd'),
+    ('units', 'dict'),
+    ('ph', 'd'),
+)
+
+_NUMPY_TYPES = {'i': 'i4', 'd': 'f8', 'dict': 'i4'}
+_NAN = math.nan
+
+
+def _number(value) -> float:
+    return _NAN if value is None else value
+
+
+def _id(value) -> int:
+    return -1 if value is None else value
+
+
+class ColumnarTable:
+    '''
+    Typed columns of equal length, see the module comment
+    '''
+
+    def __init__(self, columns: Iterable[Tuple[str, str]]):
+        self.layout = tuple(columns)
+        self.columns: Dict[str, array] = {
+            name: array('i' if typecode == 'dict' else typecode) for name, typecode in self.layout}
+        self.dictionaries: Dict[str, List[str]] = {
+            name: [] for name, typecode in self.layout if typecode == 'dict'}
+        self._codes: Dict[str, Dict[str, int]] = {name: {} for name in self.dictionaries}
+
+    def __len__(self):
+        return len(self.columns[self.layout[0][0]])
+
+    def encode(self, column: str, value) -> int:
+        if value is None:
+            return -1
+        codes = self._codes[column]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+            self.dictionaries[column].append(value)
+        return code
+
+    def decode(self, column: str, code: int):
+        return None if code < 0 else self.dictionaries[column][code]
+
+    def to_numpy(self):
+        '''
+        A structured array. The codes of dictionary columns are decoded with self.dictionaries.
+        '''
+        import numpy as np
+        dtype = np.dtype([(name, _NUMPY_TYPES[typecode]) for name, typecode in self.layout])
+        table = np.empty(len(self), dtype=dtype)
+        for name, _ in self.layout:
+            table[name] = np.frombuffer(self.columns[name], dtype=dtype[name]) if len(self) else []
+        return table
+
+    def to_arrow(self):
+        '''
+        A pyarrow Table with dictionary columns as DictionaryArrays
+        '''
+        import pyarrow as pa
+        arrays = []
+        for name, typecode in self.layout:
+            values = self.columns[name]
+            if typecode == 'dict':
+                indices = pa.array(values, type=pa.int32(), mask=_missing_mask(values, -1))
+                arrays.append(pa.DictionaryArray.from_arrays(
+                    indices, pa.array(self.dictionaries[name], type=pa.string())))
+            elif typecode == 'i':
+                arrays.append(pa.array(values, type=pa.int32(), mask=_missing_mask(values, -1)))
+            else:
+                arrays.append(pa.array(values, type=pa.float64(), from_pandas=True))
+        return pa.Table.from_arrays(arrays, names=[name for name, _ in self.layout])
+
+
+def _missing_mask(values, missing):
+    if missing not in values:
+        return None
+    import numpy as np
+    return np.frombuffer(values, dtype='i4') == missing
+
+
+def screens_table(screens) -> ColumnarTable:
+    '''
+    One row per condition ingredient of each screen
+    '''
+    table = ColumnarTable(SCREEN_COLUMNS)
+    c = table.columns
+    encode = table.encode
+    for screen in screens:
+        screen_code = encode('screen', screen.name)
+        for well_id, condition in enumerate(screen.conditions, start=1):
+            for ci in condition:
+                stock = ci.stock
+                high_ph_stock = ci.high_ph_stock
+                c['screen'].append(screen_code)
+                c['well_id'].append(well_id)
+                c['ingredient'].append(encode('ingredient', ci.ingredient.ingredient_name))
+                c['type'].append(encode('type', ci.type))
+                c['concentration'].append(_number(ci.concentration))
+                c['units'].append(encode('units', stock.units))
+                c['ph'].append(_number(ci.ph))
+                c['stock_local_id'].append(_id(stock.localID))
+                c['stock_concentration'].append(_number(stock.stockConcentration))
+                c['stock_ph'].append(_number(stock.ph))
+                if high_ph_stock is None:
+                    c['high_ph_stock_local_id'].append(-1)
+                    c['high_ph_stock_ph'].append(_NAN)
+                else:
+                    c['high_ph_stock_local_id'].append(_id(high_ph_stock.localID))
+                    c['high_ph_stock_ph'].append(_number(high_ph_stock.ph))
+                c['volume'].append(_number(ci.volume))
+                c['high_ph_volume'].append(_number(ci.high_ph_volume))
+    return table
+
+
+def screen_table(screen) -> ColumnarTable:
+    return screens_table((screen,))
+
+
+def designs_table(designs) -> ColumnarTable:
+    '''
+    One row per item of each design well, in well order
+    '''
+    table = ColumnarTable(DESIGN_COLUMNS)
+    c = table.columns
+    encode = table.encode
+    for design in designs:
+        design_code = encode('design', design.name)
+        for well_id in sorted(design.wells):
+            for item in design.wells[well_id].items:
+                c['design'].append(design_code)
+                c['well_id'].append(well_id)
+                c['chemical_id'].append(_id(item.chemical.id))
+                c['chemical'].append(encode('chemical', item.chemical.name))
+                c['item_class'].append(encode('item_class', item.item_class))
+                c['concentration'].append(_number(item.concentration))
+                c['units'].append(encode('units', item.units))
+                c['ph'].append(_number(item.ph))
+    return table
+
+
+def design_table(design) -> ColumnarTable:
+    return designs_table((design,))
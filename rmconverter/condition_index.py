@@ -0,0 +1,329 @@
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+import argparse
+import json
+
+import numpy as np
+
+from . import canonical
+from .exceptions import ChemNotFoundError
+from .factories.names import ChemicalNameIndex
+
+# A k-nearest-neighbour index over the conditions of a library of screens and designs.
+#
+# A condition is a sparse vector with one dimension per (chemical, units), holding its
+# concentration divided by the largest concentration of that dimension in the library, so that
+# eg. 0.1 M and 25 % w/v components count alike. The pH of the condition (its buffer's, else the
+# first component with one) is an extra dimension scaled by ph_weight / 14; conditions without a
+# pH have 0 there. Chemicals are identified by their catalogue chemical when the index is built
+# with the reference data (so "PEG 4000" and "polyethylene glycol 4,000" are one dimension), and
+# otherwise by their normalised name (see factories/names.py), so Screens and Designs share
+# dimensions. The index keeps the normalised names and aliases of its chemicals, so queries are
+# resolved the same way without the reference data. A query for a chemical and units that are
+# not in the index is an error, with the closest indexed names as suggestions.
+#
+# The vectors are stored as CSR arrays. A query is scored against blocks of rows at a time: the
+# dot products are a bincount over the block's non zeros, the squared norms are precomputed, and
+# the best k of each block are merged, so the memory used does not grow with the library.
+# The index is saved as a single .npz file.
+
+DEFAULT_BLOCK_SIZE = 65536
+DEFAULT_PH_WEIGHT = 1.0
+MAX_PH = 14.0
+
+# (name, concentration or (low, high), units)
+QueryItem = Tuple[str, Union[float, Tuple[float, float]], str]
+
+
+def condition_items(well: canonical.Well) -> Tuple[List[Tuple[str, str, float]], Optional[float]]:
+    '''
+    ([(name, units, concentration)], pH) of a canonical well
+    '''
+    items = []
+    ph = None
+    buffer_ph = None
+    for component in well:
+        name, item_class, conc, units, component_ph = component[:5]
+        items.append((name, units, conc or 0.0))
+        if component_ph is not None:
+            if item_class == 'Buffer' and buffer_ph is None:
+                buffer_ph = component_ph
+            if ph is None:
+                ph = component_ph
+    return items, buffer_ph if buffer_ph is not None else ph
+
+
+class ConditionIndex:
+    '''
+    See the module comment. Built with from_plates, saved with save and loaded with load.
+
+    keys: (plate name, well id) of each row
+    names: normalised name or alias -> the chemical name of its dimensions
+    '''
+
+    def __init__(self, dims: List[Tuple[str, str]], scales, indptr, indices, data, ph,
+                 keys: List[Tuple[str, int]], ph_weight: float = DEFAULT_PH_WEIGHT,
+                 names: Optional[Dict[str, str]] = None):
+        self.dims = dims
+        self.dim_index: Dict[Tuple[str, str], int] = {dim: i for i, dim in enumerate(dims)}
+        self.names = {canonical.chemical_key(name): name for name, _ in dims}
+        self.names.update(names or {})
+        self._name_index = None
+        self.scales = np.asarray(scales, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.data = np.asarray(data, dtype=np.float64)
+        # NaN if the condition has no pH
+        self.ph = np.asarray(ph, dtype=np.float64)
+        self.keys = keys
+        self.ph_weight = ph_weight
+
+        # The row of each non zero, and the squared norm of each row including the pH
+        self._rows = np.repeat(np.arange(len(keys), dtype=np.int64), np.diff(self.indptr))
+        self._ph_values = self._scale_ph(self.ph)
+        self._norms = np.bincount(self._rows, weights=self.data ** 2, minlength=len(keys)) + self._ph_values ** 2
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _scale_ph(self, ph):
+        return np.nan_to_num(np.asarray(ph, dtype=np.float64) * (self.ph_weight / MAX_PH))
+
+    @classmethod
+    def from_plates(cls, plates: Iterable[Tuple[str, object]], ph_weight: float = DEFAULT_PH_WEIGHT,
+                    chems_f=None):
+        '''
+        Indexes every non empty well of (name, Screen, Design or canonical wells) pairs
+        chems_f: a ChemicalsFactory, components are merged by the catalogue chemical they resolve to
+        '''
+        # normalised name -> dimension name, with the catalogue names and aliases of the chemicals
+        names: Dict[str, str] = {}
+
+        def resolve(item_name: str) -> str:
+            key = canonical.chemical_key(item_name)
+            name = names.get(key)
+            if name is None:
+                chem = None if chems_f is None else chems_f.get_chem_by_name(
+                    canonical.chemical_name(item_name))
+                if chem is None:
+                    name = names[key] = item_name
+                else:
+                    name = canonical.canonical_name(chem.name)
+                    for x in [chem.name, *chem.aliases]:
+                        names.setdefault(canonical.chemical_key(x), name)
+                    names[key] = name
+            return name
+
+        dim_index: Dict[Tuple[str, str], int] = {}
+        indptr, indices, data, ph, keys = [0], [], [], [], []
+        for name, plate in plates:
+            wells = plate if isinstance(plate, dict) else canonical.canonical_form(plate)
+            for well_id in sorted(wells):
+                if not wells[well_id]:
+                    continue
+                items, well_ph = condition_items(wells[well_id])
+                # Components of the same chemical and units are summed
+                row = {}
+                for item_name, units, conc in items:
+                    dim = dim_index.setdefault((resolve(item_name), units), len(dim_index))
+                    row[dim] = row.get(dim, 0.0) + conc
+                for dim in sorted(row):
+                    indices.append(dim)
+                    data.append(row[dim])
+                indptr.append(len(indices))
+                ph.append(np.nan if well_ph is None else well_ph)
+                keys.append((name, well_id))
+
+        indices = np.asarray(indices, dtype=np.int32)
+        data = np.asarray(data, dtype=np.float64)
+        scales = np.zeros(len(dim_index))
+        np.maximum.at(scales, indices, np.abs(data))
+        scales[scales == 0] = 1.0
+        dims = sorted(dim_index, key=dim_index.get)
+        return cls(dims, scales, indptr, indices, data / scales[indices], ph, keys, ph_weight=ph_weight,
+                   names=names)
+
+    def dim(self, item_name: str, units: str) -> int:
+        '''
+        The dimension of a chemical name or alias and units, raises ChemNotFoundError if the
+        index has none
+        '''
+        units = canonical.canonical_units(units)
+        name = self.names.get(canonical.chemical_key(item_name), canonical.canonical_name(item_name))
+        dim = self.dim_index.get((name, units))
+        if dim is not None:
+            return dim
+
+        other_units = [x[1] for x in self.dims if x[0] == name]
+        if other_units:
+            raise ChemNotFoundError(
+                f'{item_name} is not indexed in {units}, only in {", ".join(map(str, other_units))}')
+        if self._name_index is None:
+            self._name_index = ChemicalNameIndex()
+            for i, (x, _) in enumerate(self.dims):
+                self._name_index.add(x, i)
+        mesg = f'{item_name} is not in the index'
+        suggestions = self._name_index.suggest(item_name)
+        if len(suggestions) > 0:
+            mesg += '. Closest names: ' + ', '.join(f'{x[0]} ({x[2]:.2f})' for x in suggestions)
+        raise ChemNotFoundError(mesg)
+
+    def query_vector(self, items: Sequence[QueryItem], ph: Optional[float] = None):
+        '''
+        (dims, values, scaled pH) of a query. A concentration range is queried at its midpoint.
+        Chemicals are resolved with dim, so an unknown chemical raises ChemNotFoundError.
+        '''
+        dims, values = [], []
+        for item_name, conc, units in items:
+            if isinstance(conc, (tuple, list)):
+                conc = (conc[0] + conc[1]) / 2
+            dim = self.dim(item_name, units)
+            dims.append(dim)
+            values.append(conc / self.scales[dim])
+        return (np.asarray(dims, dtype=np.int64), np.asarray(values, dtype=np.float64),
+                float(self._scale_ph(np.nan if ph is None else ph)))
+
+    def knn(self, items: Sequence[QueryItem], ph: Optional[float] = None, k: int = 10,
+            block_size: int = DEFAULT_BLOCK_SIZE) -> List[Tuple[Tuple[str, int], float]]:
+        '''
+        The k closest conditions as [((plate name, well id), distance)], closest first
+        '''
+        dims, values, q_ph = self.query_vector(items, ph)
+        q = np.zeros(len(self.dims))
+        np.add.at(q, dims, values)
+        q_norm = float(np.sum(q ** 2) + q_ph ** 2)
+
+        n = len(self.keys)
+        best_idx = np.empty(0, dtype=np.int64)
+        best_dist = np.empty(0)
+        for start in range(0, n, block_size):
+            stop = min(start + block_size, n)
+            lo, hi = self.indptr[start], self.indptr[stop]
+            dots = np.bincount(self._rows[lo:hi] - start,
+                               weights=self.data[lo:hi] * q[self.indices[lo:hi]],
+                               minlength=stop - start)
+            dots += self._ph_values[start:stop] * q_ph
+            dist = self._norms[start:stop] + q_norm - 2 * dots
+            if len(dist) > k:
+                top = np.argpartition(dist, k)[:k]
+            else:
+                top = np.arange(len(dist))
+            best_idx = np.concatenate([best_idx, top + start])
+            best_dist = np.concatenate([best_dist, dist[top]])
+            if len(best_dist) > k:
+                keep = np.argpartition(best_dist, k)[:k]
+                best_idx, best_dist = best_idx[keep], best_dist[keep]
+
+        order = np.lexsort((best_idx, best_dist))
+        return [(self.keys[i], float(np.sqrt(max(best_dist[j], 0.0))))
+                for j, i in ((j, best_idx[j]) for j in order)]
+
+    def knn_well(self, well: canonical.Well, k: int = 10, **kwargs):
+        '''
+        knn for a canonical well, eg. canonical.design_well(dw) or canonical.screen_condition(c)
+        '''
+        items, ph = condition_items(well)
+        return self.knn([(name, conc, units) for name, units, conc in items], ph=ph, k=k, **kwargs)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                indptr=self.indptr, indices=self.indices, data=self.data, ph=self.ph, scales=self.scales,
+                meta=np.frombuffer(json.dumps({
+                    'dims': self.dims, 'keys': self.keys, 'ph_weight': self.ph_weight,
+                    'names': self.names,
+                }).encode(), dtype=np.uint8),
+            )
+
+    @classmethod
+    def load(cls, path) -> ConditionIndex:
+        with np.load(path) as arrays:
+            meta = json.loads(arrays['meta'].tobytes())
+            return cls(
+                [tuple(x) for x in meta['dims']], arrays['scales'], arrays['indptr'], arrays['indices'],
+                arrays['data'], arrays['ph'], [tuple(x) for x in meta['keys']], ph_weight=meta['ph_weight'],
+                names=meta.get('names'),
+            )
+
+
+def parse_query_item(text: str) -> QueryItem:
+    '''
+    "name:conc:units" or "name:low-high:units", eg. "polyethylene glycol 4000:20-25:w/v"
+    '''
+    name, conc, units = text.rsplit(':', 2)
+    if '-' in conc.strip('-'):
+        low, high = conc.split('-', 1)
+        return name, (float(low), float(high)), units
+    return name, float(conc), units
+
+
+def main(*, command, index_path, paths=(), data_dir=None, items=(), ph=None, k=10, ph_weight=DEFAULT_PH_WEIGHT,
+         profiler=None):
+    '''
+    profiler: a profiling.Profiler, reading the plates is part of the build stage
+    '''
+    from .profiling import stage
+
+    if command == 'build':
+        from .duplicates import load_plate
+        from .roundtrip import corpus_files
+        factory = None
+        if data_dir is not None:
+            from .create_rxml import FactoriesJSON
+            with stage(profiler, 'load_data'):
+                factory = FactoriesJSON(data_dir=data_dir)
+        plates = ((str(path), load_plate(path, factory)) for path in corpus_files(paths))
+        with stage(profiler, 'build'):
+            index = ConditionIndex.from_plates(plates, ph_weight=ph_weight,
+                                               chems_f=None if factory is None else factory.chems)
+        with stage(profiler, 'write'):
+            index.save(index_path)
+        print(f'{len(index)} conditions, {len(index.dims)} dimensions in {index_path}')
+    elif command == 'query':
+        with stage(profiler, 'read'):
+            index = ConditionIndex.load(index_path)
+        with stage(profiler, 'query'):
+            neighbours = index.knn([parse_query_item(x) for x in items], ph=ph, k=k)
+        for (name, well_id), dist in neighbours:
+            print(f'{dist:.4f} {name} {well_id}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Condition similarity search.')
+
+    parser.add_argument('command', choices=('build', 'query'))
+    parser.add_argument('index', help='the .npz index file')
+    parser.add_argument('paths', nargs='*', help='build: xml files or directories of them')
+    parser.add_argument('--data-dir', type=str, default=None,
+                        help='build: reference data, needed for CrystalTrak designs and to merge '
+                             'chemicals by their catalogue names and aliases')
+    parser.add_argument('--item', action='append', default=[],
+                        help='query: "name:conc:units" or "name:low-high:units"')
+    parser.add_argument('--ph', type=float, default=None)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--ph-weight', type=float, default=DEFAULT_PH_WEIGHT)
+
+    from contextlib import nullcontext
+    from . import profiling
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    profiler = profiling.from_args(
+        args, command=f'condition_index {args.command}', inputs=args.paths,
+        options={'index': args.index, 'data_dir': args.data_dir, 'items': args.item, 'ph': args.ph,
+                 'k': args.k, 'ph_weight': args.ph_weight})
+    with profiler or nullcontext():
+        main(
+            command=args.command,
+            index_path=args.index,
+            paths=args.paths,
+            data_dir=args.data_dir,
+            items=args.item,
+            ph=args.ph,
+            k=args.k,
+            ph_weight=args.ph_weight,
+            profiler=profiler,
+        )
@@ -20,6 +20,10 @@ PRECIPITANT = 'Precipitant'
 
 SHRTNAME_LEN = 9
 
+# Plate layout used when a file doesn't give one
+DEFAULT_PLATE_ROWS = 8
+DEFAULT_PLATE_COLS = 12
+
 CONC_PREC = 1
 VOL_PREC = 1
 PH_PREC = 1
@@ -1,12 +1,13 @@
-from .factories import xtaltrak
 import argparse
 import os
-from lxml import etree
 import pathlib
 import sys
 import re
 
-from .factories import convert
+from .utils import write_bytes, xml_root
+
+# The factories, object model and lxml are imported by the functions that need them so that
+# importing this module (eg. for rockmaker_filename or --help) stays cheap
 
 current_dir = pathlib.Path(__file__).parent.resolve()
 sys.path.append(str(current_dir))
@@ -26,6 +27,8 @@ def rockmaker_filename(screen_name):
 
 class FactoriesJSON:
     def __init__(self, data_dir):
+        from .factories import xtaltrak
+
         # Load all the object factories
         self.chems = xtaltrak.ChemicalsFactory(
             os.path.join(data_dir, 'chemicals.json'),
@@ -33,14 +36,18 @@ class FactoriesJSON:
         )
         self.stocks = xtaltrak.StocksFactory(
             os.path.join(data_dir, 'stocks.json'),
-            self.chems
+            self.chems,
+            xtaltrak.availability_json_path(data_dir),
         )
         self.phcurve = xtaltrak.PhCurveFactory(
             os.path.join(data_dir, 'ph_curves.json'),
             os.path.join(data_dir, 'ph_points.json'),
             self.chems
         )
-        self.design = xtaltrak.DesignFactory(self.chems)
+        self.groups = xtaltrak.ChemGroupFactory(
+            os.path.join(data_dir, 'chem_group_members.json')
+        )
+        self.design = xtaltrak.DesignFactory(self.chems, group_factory=self.groups)
         self.recipe = xtaltrak.RecipeFactory(self.stocks)
 
 
@@ -49,6 +56,27 @@ class FactoriesRM:
 
 
 def to_rm_xml(*, factory, design_xo, recipe_xo=None, as_string=True, include_aliases=False):
+    screen = design_to_screen(factory=factory, design_xo=design_xo, recipe_xo=recipe_xo,
+                              include_aliases=include_aliases)
+    return screen.to_xml(as_string=as_string)
+
+
+def to_rm_xml_bytes(*, factory, design_xo, recipe_xo=None, include_aliases=False) -> bytes:
+    '''
+    to_rm_xml as UTF-8 bytes. The design and recipe can be lxml elements, bytes, buffers,
+    binary streams or paths.
+    '''
+    screen = design_to_screen(factory=factory, design_xo=xml_root(design_xo),
+                              recipe_xo=None if recipe_xo is None else xml_root(recipe_xo),
+                              include_aliases=include_aliases)
+    return screen.to_xml_bytes()
+
+
+def design_to_screen(*, factory, design_xo, recipe_xo=None, include_aliases=False, alternatives=0):
+    '''
+    alternatives: without a recipe, keep this many stock assignments per well in screen.alternatives
+    '''
+    from .factories import convert
 
     stocks_f = factory.stocks
     phcurve_f = factory.phcurve
@@ -61,31 +89,62 @@ def to_rm_xml(*, factory, design_xo, recipe_xo=None, as_string=True, include_ali
     if recipe_xo is not None:
         recipe = recipe_f.get_recipe_from_xml_object(recipe_xo)
 
-    screen = convert.design2screen(
-        design=design, recipe=recipe, stocks_f=stocks_f, phcurve_f=phcurve_f, require_exact_ph=True, include_aliases=include_aliases)
-
-    return screen.to_xml(as_string=as_string)
+    return convert.design2screen(
+        design=design, recipe=recipe, stocks_f=stocks_f, phcurve_f=phcurve_f, require_exact_ph=True, include_aliases=include_aliases,
+        alternatives=alternatives)
 
 
 def write_rm_xml_file(*, output_xml, **kwargs):
-    xmlstr = to_rm_xml(**kwargs)
-    with open(output_xml, "w") as f:
-        f.write(xmlstr)
+    '''
+    output_xml: A path or a binary stream
+    '''
+    write_bytes(output_xml, to_rm_xml_bytes(**kwargs))
 
 
-def main(*, design_xml, recipe_xml, output_xml, data_dir):
-    # Read in the xml files
-    design_xo = etree.parse(design_xml).getroot()
-    recipe_xo = None
-    if recipe_xml is not None:
-        recipe_xo = etree.parse(recipe_xml).getroot()
+def write_alternatives_json(screen, path):
+    '''
+    Writes screen.alternatives_json() to a path or text stream
+    '''
+    import json
+
+    if hasattr(path, 'write'):
+        json.dump(screen.alternatives_json(), path, indent=1)
+    else:
+        with open(path, 'w') as f:
+            json.dump(screen.alternatives_json(), f, indent=1)
+
 
-    write_rm_xml_file(
-        output_xml=output_xml,
-        factory=FactoriesJSON(data_dir=data_dir),
-        design_xo=design_xo,
-        recipe_xo=recipe_xo,
-    )
+def main(*, design_xml, recipe_xml, output_xml, data_dir, profiler=None, alternatives=0,
+         alternatives_json=None):
+    '''
+    profiler: a profiling.Profiler that times the stages of the conversion
+    alternatives: without a recipe, the number of stock assignments of each well to keep (best
+        first, the first is the one used) and write to alternatives_json
+    '''
+    from lxml import etree
+    from .profiling import stage
+
+    if alternatives_json is not None and (recipe_xml is not None or alternatives < 1):
+        raise ValueError('--alternatives-json needs --alternatives and no --recipe-xml')
+
+    # Read in the xml files
+    with stage(profiler, 'read'):
+        design_xo = etree.parse(design_xml).getroot()
+        recipe_xo = None
+        if recipe_xml is not None:
+            recipe_xo = etree.parse(recipe_xml).getroot()
+
+    with stage(profiler, 'load_data'):
+        factory = FactoriesJSON(data_dir=data_dir)
+    with stage(profiler, 'convert'):
+        screen = design_to_screen(factory=factory, design_xo=design_xo, recipe_xo=recipe_xo,
+                                  alternatives=alternatives)
+    with stage(profiler, 'serialize'):
+        xml = screen.to_xml_bytes()
+    with stage(profiler, 'write'):
+        write_bytes(output_xml, xml)
+        if alternatives_json is not None:
+            write_alternatives_json(screen, alternatives_json)
 
 
 if __name__ == '__main__':
@@ -98,10 +157,26 @@ if __name__ == '__main__':
     parser.add_argument('--data-dir', type=str, default='data')
     parser.add_argument('--output-xml', type=str,
                         default='rockmaker_design.xml')
+    parser.add_argument('--alternatives', type=int, default=0, metavar='K',
+                        help='without --recipe-xml, keep the K best stock assignments of each well')
+    parser.add_argument('--alternatives-json', type=str, default=None,
+                        help='write the --alternatives of each well to this json file')
+
+    from contextlib import nullcontext
+    from . import profiling
+    profiling.add_arguments(parser)
 
     args = parser.parse_args()
 
-    main(design_xml=args.design_xml,
-         recipe_xml=args.recipe_xml,
-         output_xml=args.output_xml,
-         data_dir=args.data_dir)
+    profiler = profiling.from_args(
+        args, command='create_rxml', inputs=[x for x in (args.design_xml, args.recipe_xml) if x],
+        options={'data_dir': args.data_dir, 'output_xml': args.output_xml,
+                 'alternatives': args.alternatives})
+    with profiler or nullcontext():
+        main(design_xml=args.design_xml,
+             recipe_xml=args.recipe_xml,
+             output_xml=args.output_xml,
+             data_dir=args.data_dir,
+             profiler=profiler,
+             alternatives=args.alternatives,
+             alternatives_json=args.alternatives_json)
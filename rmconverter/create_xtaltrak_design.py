@@ -0,0 +1,106 @@
+from __future__ import annotations
+import argparse
+from pathlib import Path
+import pathlib
+import sys
+
+# The factories, object model and lxml are imported by the functions that need them so that
+# importing this module (eg. for --help) stays cheap
+
+current_dir = pathlib.Path(__file__).parent.resolve()
+
+
+def design_filename(rmxml) -> Path:
+    return Path(rmxml).with_name(f'{Path(rmxml).stem}_design.xml')
+
+
+def convert_rxml(*, factory, rmxml, output_xml, fuzzy_threshold=None, profiler=None):
+    '''
+    Converts a RockMaker xml file to a CrystalTrak design file, returns the Design
+    '''
+    from .factories import rockmaker
+    from .factories.convert import rmscreen2design
+    from .profiling import stage
+
+    rmxml = Path(rmxml)
+    with stage(profiler, 'read'):
+        screen = rockmaker.screen_from_rxml_file(rmxml, name=rmxml.stem)
+    with stage(profiler, 'convert'):
+        design = rmscreen2design(screen, factory.chems, stocks_f=factory.stocks,
+                                 fuzzy_threshold=fuzzy_threshold, phcurve_f=factory.phcurve)
+    with stage(profiler, 'write'):
+        design.write_xml_file(str(output_xml))
+    return design
+
+
+def main(*, rmxml, output_xml=None, output_dir=None, data_dir, fuzzy_threshold=None, profiler=None):
+    '''
+    rmxml: One or more RockMaker xml files. Each is written to output_xml if there is one file,
+        otherwise <stem>_design.xml in output_dir or next to the input.
+    profiler: a profiling.Profiler, the stages of the files of a batch are summed
+    Returns the paths of the inputs that failed.
+    '''
+    from .create_rxml import FactoriesJSON
+    from .profiling import stage
+
+    if isinstance(rmxml, (str, Path)):
+        rmxml = [rmxml]
+    if output_xml is not None and len(rmxml) != 1:
+        raise ValueError('--output-xml can only be used with a single --rmxml')
+
+    with stage(profiler, 'load_data'):
+        factory = FactoriesJSON(data_dir=data_dir)
+    failed = []
+    for path in rmxml:
+        if output_xml is not None:
+            output = Path(output_xml)
+        elif output_dir is not None:
+            output = Path(output_dir) / design_filename(path).name
+        else:
+            output = design_filename(path)
+        try:
+            convert_rxml(factory=factory, rmxml=path, output_xml=output,
+                         fuzzy_threshold=fuzzy_threshold, profiler=profiler)
+        except Exception as e:
+            if len(rmxml) == 1:
+                raise
+            # Keep going with the rest of the batch
+            print(f'{path}: {e}', file=sys.stderr)
+            failed.append(path)
+    return failed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='RockMaker xml to CrystalTrak design converter.')
+
+    # Dataset parameters
+    parser.add_argument('--rmxml', type=str, nargs='+', required=True)
+    parser.add_argument('--output-xml', type=str, default=None,
+                        help='output file for a single --rmxml')
+    parser.add_argument('--output-dir', type=str, default=None,
+                        help='directory for the <name>_design.xml outputs, default next to the inputs')
+    parser.add_argument('--data-dir', type=str, default='data')
+    parser.add_argument('--fuzzy-threshold', type=float, default=None,
+                        help='use the most similar chemical name if its similarity is at least this')
+
+    from contextlib import nullcontext
+    from . import profiling
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    profiler = profiling.from_args(
+        args, command='create_xtaltrak_design', inputs=args.rmxml,
+        options={'output_xml': args.output_xml, 'output_dir': args.output_dir, 'data_dir': args.data_dir,
+                 'fuzzy_threshold': args.fuzzy_threshold})
+    with profiler or nullcontext():
+        failed = main(
+            rmxml=args.rmxml,
+            output_xml=args.output_xml,
+            output_dir=args.output_dir,
+            data_dir=args.data_dir,
+            fuzzy_threshold=args.fuzzy_threshold,
+            profiler=profiler,
+        )
+    sys.exit(1 if failed else 0)
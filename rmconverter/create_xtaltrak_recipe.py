@@ -1,21 +1,23 @@
-from lxml import etree
+from __future__ import annotations
 import argparse
 from pathlib import Path
+from typing import TYPE_CHECKING
 import pathlib
 import os
 
-from . import objects
-from .factories import rockmaker
-from .factories.convert import rmscreen2xtrecipe
-from .factories import xtaltrak
+if TYPE_CHECKING:
+    from .objects.rockmaker import Screen
 
-
-screen_from_rxml_dom = rockmaker.screen_from_rxml_dom
+# The factories, object model and lxml are imported by the functions that need them so that
+# importing this module (eg. for --help) stays cheap
 
 current_dir = pathlib.Path(__file__).parent.resolve()
 
+
 class FactoriesJSON:
     def __init__(self, data_dir=current_dir / "data"):
+        from .factories import xtaltrak
+
         # Load all the object factories
         self.chems = xtaltrak.ChemicalsFactory(
             os.path.join(data_dir, 'chemicals.json'),
@@ -23,44 +25,91 @@ class FactoriesJSON:
         )
         self.stocks = xtaltrak.StocksFactory(
             os.path.join(data_dir, 'stocks.json'),
-            self.chems
+            self.chems,
+            xtaltrak.availability_json_path(data_dir),
         )
         self.phcurve = xtaltrak.PhCurveFactory(
             os.path.join(data_dir, 'ph_curves.json'),
             os.path.join(data_dir, 'ph_points.json'),
             self.chems
         )
-        self.design = xtaltrak.DesignFactory(self.chems)
+        self.groups = xtaltrak.ChemGroupFactory(
+            os.path.join(data_dir, 'chem_group_members.json')
+        )
+        self.design = xtaltrak.DesignFactory(self.chems, group_factory=self.groups)
         self.recipe = xtaltrak.RecipeFactory(self.stocks)
 
 
 
-def convert_screen(*, screen: objects.rockmaker.Screen, volume, output_xml=None, require_exact_ph):
+def convert_screen(*, screen: Screen, volume, output_xml=None, require_exact_ph, factory=None,
+                   profiler=None):
+    '''
+    factory: The loaded reference data, eg. a reference.ReferenceDataManager's current generation.
+        If None the default data is loaded.
+    profiler: a profiling.Profiler that times the stages of the conversion
+    '''
+    xml = convert_screen_bytes(screen=screen, volume=volume, output_xml=output_xml,
+                               require_exact_ph=require_exact_ph, factory=factory, profiler=profiler)
+    return xml.decode()
+
+
+def convert_screen_bytes(*, screen: Screen, volume, output_xml=None, require_exact_ph,
+                         factory=None, profiler=None) -> bytes:
+    '''
+    convert_screen as UTF-8 bytes. output_xml can be a path or a binary stream.
+    '''
+    from lxml import etree
+    from .factories.convert import rmscreen2xtrecipe
+    from .profiling import stage
+    from .utils import write_bytes
+
     # Calculate volumes
-    screen.add_recipe_volume(volume, require_exact_ph=require_exact_ph)
-    sp = rmscreen2xtrecipe(screen, stocks_f=FactoriesJSON().stocks,)
-    sp.add_water()
+    with stage(profiler, 'volumes'):
+        screen.add_recipe_volume(volume, require_exact_ph=require_exact_ph)
+    if factory is None:
+        with stage(profiler, 'load_data'):
+            factory = FactoriesJSON()
+    with stage(profiler, 'convert'):
+        sp = rmscreen2xtrecipe(screen, stocks_f=factory.stocks,)
+        sp.add_water()
 
     # Write XML
-    root = sp.get_xml_element()
-    etree.indent(root, space="   ")
-    xmlstr = etree.tostring(root, xml_declaration=True,
-                            pretty_print=True, encoding='utf-8').decode()
+    with stage(profiler, 'serialize'):
+        root = sp.get_xml_element()
+        etree.indent(root, space="   ")
+        xml = etree.tostring(root, xml_declaration=True,
+                             pretty_print=True, encoding='utf-8')
     if not output_xml is None:
-        with open(output_xml, "w") as f:
-            f.write(xmlstr)
+        with stage(profiler, 'write'):
+            write_bytes(output_xml, xml)
+
+    return xml
+
+
+def convert_rxml_bytes(rmxml, *, volume, require_exact_ph, name='', output_xml=None, factory=None) -> bytes:
+    '''
+    Converts RockMaker xml given as bytes, a buffer, a binary stream or a path, see convert_screen_bytes
+    '''
+    from .factories import rockmaker
+    from .utils import xml_root
 
-    return xmlstr
+    screen = rockmaker.screen_from_rxml_dom(xml_root(rmxml), name=name)
+    return convert_screen_bytes(screen=screen, volume=volume, output_xml=output_xml,
+                                require_exact_ph=require_exact_ph, factory=factory)
 
 
-def main(*, rmxml, volume, output_xml=None, require_exact_ph):
+def main(*, rmxml, volume, output_xml=None, require_exact_ph, profiler=None):
     if isinstance(rmxml, str):
         rmxml = Path(rmxml)
+    from .factories import rockmaker
+    from .profiling import stage
 
     # Load rxml into objects
-    screen = rockmaker.screen_from_rxml_file(rmxml, name=rmxml.stem)
+    with stage(profiler, 'read'):
+        screen = rockmaker.screen_from_rxml_file(rmxml, name=rmxml.stem)
 
-    return convert_screen(screen=screen, volume=volume, output_xml=output_xml, require_exact_ph=require_exact_ph)
+    return convert_screen(screen=screen, volume=volume, output_xml=output_xml, require_exact_ph=require_exact_ph,
+                          profiler=profiler)
 
 
 if __name__ == '__main__':
@@ -75,11 +124,21 @@ if __name__ == '__main__':
                         help='volume per well in uL')
     parser.add_argument('--require-exact-ph',
                         action=argparse.BooleanOptionalAction, default=True)
+
+    from contextlib import nullcontext
+    from . import profiling
+    profiling.add_arguments(parser)
+
     args = parser.parse_args()
 
-    main(
-        rmxml=args.rmxml,
-        volume=args.volume,
-        output_xml=args.output_xml,
-        require_exact_ph=args.require_exact_ph,
-    )
+    profiler = profiling.from_args(
+        args, command='create_xtaltrak_recipe', inputs=[args.rmxml],
+        options={'volume': args.volume, 'output_xml': args.output_xml, 'require_exact_ph': args.require_exact_ph})
+    with profiler or nullcontext():
+        main(
+            rmxml=args.rmxml,
+            volume=args.volume,
+            output_xml=args.output_xml,
+            require_exact_ph=args.require_exact_ph,
+            profiler=profiler,
+        )
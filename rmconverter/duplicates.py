@@ -0,0 +1,317 @@
+from __future__ import annotations
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+import argparse
+import hashlib
+import json
+import random
+import sys
+
+from . import canonical
+
+# Finds duplicate and near duplicate screens in a library.
+#
+# Each condition (well) is reduced to its chemistry: (name, concentration, units, pH) of each
+# component, from the canonical form (see canonical.py) so Screens and Designs are comparable.
+# Names are matched by canonical.chemical_key, so an ingredient with the lab suffix is the same
+# chemical as in the design it was converted from.
+#   - a condition fingerprint is the hash of that, the same in any well of any screen
+#   - a screen fingerprint is the hash of the sorted condition fingerprints, so renamed screens and
+#     screens with their wells in another order have equal fingerprints
+#   - a MinHash of the set of condition fingerprints estimates the fraction of conditions two
+#     screens share. The sketches are split into LSH bands, only screens that share a band are
+#     compared so queries don't scan the library.
+# The index is stored as json and the LSH buckets are rebuilt when it is loaded.
+
+INDEX_VERSION = 2
+DEFAULT_NUM_PERM = 128
+DEFAULT_BANDS = 32
+
+# A Mersenne prime for the universal hashes of the MinHash permutations
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 61) - 1
+
+
+def condition_chemistry(well: canonical.Well) -> Tuple[tuple, ...]:
+    # (name, class, conc, units, pH, ...) -> (name key, conc, units, pH)
+    return tuple(sorted(((canonical.chemical_key(x[0]), x[2], x[3], x[4]) for x in well),
+                        key=canonical.component_key))
+
+
+def condition_fingerprint(well: canonical.Well) -> int:
+    digest = hashlib.blake2b(
+        json.dumps(condition_chemistry(well), separators=(',', ':')).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def screen_fingerprints(obj) -> Dict[int, int]:
+    '''
+    well id -> condition fingerprint of a Screen, Design or canonical wells.
+    Empty wells are left out.
+    '''
+    wells = obj if isinstance(obj, dict) else canonical.canonical_form(obj)
+    return {well_id: condition_fingerprint(well) for well_id, well in wells.items() if well}
+
+
+def screen_fingerprint(fingerprints: Iterable[int]) -> str:
+    hasher = hashlib.sha256()
+    for fingerprint in sorted(fingerprints):
+        hasher.update(fingerprint.to_bytes(8, 'big'))
+    return hasher.hexdigest()
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = DEFAULT_NUM_PERM, seed: int = 1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.perms = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)]
+
+    def sketch(self, values: Iterable[int]) -> List[int]:
+        values = set(values)
+        if not values:
+            return [_MAX_HASH] * self.num_perm
+        return [min((a * x + b) % _PRIME for x in values) for a, b in self.perms]
+
+
+def estimate_jaccard(a: List[int], b: List[int]) -> float:
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class ScreenIndex:
+    '''
+    Fingerprints and MinHash sketches of a library of screens, see the module comment.
+    Screens are identified by name, adding a screen under an existing name replaces it.
+    '''
+
+    def __init__(self, num_perm: int = DEFAULT_NUM_PERM, bands: int = DEFAULT_BANDS):
+        if num_perm % bands:
+            raise ValueError(f'num_perm {num_perm} is not a multiple of bands {bands}')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        # name -> {'source', 'fingerprint', 'conditions': {well id: fingerprint}, 'minhash'}
+        self.screens: Dict[str, dict] = {}
+        self._by_fingerprint: Dict[str, set] = defaultdict(set)
+        self._by_condition: Dict[int, set] = defaultdict(set)
+        self._buckets: List[Dict[Tuple[int, ...], set]] = [defaultdict(set) for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.screens)
+
+    def __contains__(self, name):
+        return name in self.screens
+
+    def _bands(self, minhash: List[int]):
+        for band in range(self.bands):
+            yield band, tuple(minhash[band * self.rows:(band + 1) * self.rows])
+
+    def _insert(self, name: str, entry: dict):
+        self.remove(name)
+        self.screens[name] = entry
+        self._by_fingerprint[entry['fingerprint']].add(name)
+        for fingerprint in entry['conditions'].values():
+            self._by_condition[fingerprint].add(name)
+        for band, key in self._bands(entry['minhash']):
+            self._buckets[band][key].add(name)
+
+    def remove(self, name: str):
+        entry = self.screens.pop(name, None)
+        if entry is None:
+            return
+        self._by_fingerprint[entry['fingerprint']].discard(name)
+        for fingerprint in entry['conditions'].values():
+            self._by_condition[fingerprint].discard(name)
+        for band, key in self._bands(entry['minhash']):
+            self._buckets[band][key].discard(name)
+
+    def entry(self, obj) -> dict:
+        conditions = screen_fingerprints(obj)
+        return {
+            'fingerprint': screen_fingerprint(conditions.values()),
+            'conditions': conditions,
+            'minhash': self.hasher.sketch(conditions.values()),
+        }
+
+    def add(self, name: str, obj, source: Optional[str] = None) -> dict:
+        '''
+        Indexes a Screen, Design or canonical wells
+        '''
+        entry = self.entry(obj)
+        entry['source'] = source
+        self._insert(name, entry)
+        return entry
+
+    def duplicates_of(self, obj) -> List[str]:
+        '''
+        The screens with the same conditions, in any wells
+        '''
+        return sorted(self._by_fingerprint.get(self.entry(obj)['fingerprint'], ()))
+
+    def similar(self, obj, threshold: float = 0.5, exclude: Optional[str] = None) -> List[Tuple[str, float]]:
+        '''
+        (name, estimated fraction of shared conditions) of the LSH candidates at or above
+        threshold, most similar first
+        '''
+        minhash = self.entry(obj)['minhash'] if not isinstance(obj, list) else obj
+        candidates = set()
+        for band, key in self._bands(minhash):
+            candidates |= self._buckets[band].get(key, set())
+        candidates.discard(exclude)
+        results = []
+        for name in candidates:
+            score = estimate_jaccard(minhash, self.screens[name]['minhash'])
+            if score >= threshold:
+                results.append((name, score))
+        results.sort(key=lambda x: (-x[1], x[0]))
+        return results
+
+    def find_condition(self, well: canonical.Well) -> List[Tuple[str, int]]:
+        '''
+        (screen, well id) of every indexed condition with the same chemistry as a canonical well
+        '''
+        fingerprint = condition_fingerprint(well)
+        return sorted(
+            (name, well_id)
+            for name in self._by_condition.get(fingerprint, ())
+            for well_id, x in self.screens[name]['conditions'].items() if x == fingerprint
+        )
+
+    def duplicate_groups(self) -> List[List[str]]:
+        return sorted(sorted(names) for names in self._by_fingerprint.values() if len(names) > 1)
+
+    def near_duplicate_pairs(self, threshold: float = 0.8) -> List[Tuple[str, str, float]]:
+        pairs = []
+        for name, entry in self.screens.items():
+            for other, score in self.similar(entry['minhash'], threshold, exclude=name):
+                if name < other:
+                    pairs.append((name, other, score))
+        pairs.sort(key=lambda x: (-x[2], x[0], x[1]))
+        return pairs
+
+    def save(self, path):
+        from .utils import write_atomic
+        data = {
+            'version': INDEX_VERSION,
+            'num_perm': self.num_perm,
+            'bands': self.bands,
+            'screens': {
+                name: dict(entry, conditions={str(k): v for k, v in entry['conditions'].items()})
+                for name, entry in self.screens.items()
+            },
+        }
+        write_atomic(path, json.dumps(data, separators=(',', ':')))
+
+    @classmethod
+    def load(cls, path) -> ScreenIndex:
+        with open(path) as fp:
+            data = json.load(fp)
+        if data.get('version') != INDEX_VERSION:
+            raise ValueError(f'{path} is not a version {INDEX_VERSION} screen index')
+        index = cls(num_perm=data['num_perm'], bands=data['bands'])
+        for name, entry in data['screens'].items():
+            entry['conditions'] = {int(k): v for k, v in entry['conditions'].items()}
+            index._insert(name, entry)
+        return index
+
+
+def load_plate(path, factory=None):
+    '''
+    A Screen or Design from a RockMaker or CrystalTrak design xml file
+    '''
+    from lxml import etree
+    from .factories import rockmaker
+    from .watch import DESIGN, RXML, input_kind
+
+    path = Path(path)
+    data = path.read_bytes()
+    kind = input_kind(data)
+    if kind == RXML:
+        return rockmaker.screen_from_rxml_dom(etree.fromstring(data), name=path.stem)
+    if kind == DESIGN:
+        if factory is None:
+            raise ValueError(f'{path} is a design, designs need the reference data')
+        return factory.design.get_design_from_xml_object(etree.fromstring(data))
+    raise ValueError(f'{path} is not a RockMaker or design xml file')
+
+
+def main(*, command, index_path, paths=(), data_dir=None, threshold=0.5, profiler=None):
+    '''
+    profiler: a profiling.Profiler, the stages of the files are summed
+    '''
+    from .profiling import stage
+    from .roundtrip import corpus_files
+
+    factory = None
+    if data_dir is not None:
+        from .create_rxml import FactoriesJSON
+        with stage(profiler, 'load_data'):
+            factory = FactoriesJSON(data_dir=data_dir)
+
+    with stage(profiler, 'read_index'):
+        index = ScreenIndex.load(index_path) if Path(index_path).exists() else ScreenIndex()
+    if command == 'add':
+        for path in corpus_files(paths):
+            try:
+                with stage(profiler, 'read'):
+                    plate = load_plate(path, factory)
+                with stage(profiler, 'add'):
+                    index.add(str(path), plate, source=str(path))
+            except Exception as e:
+                print(f'{path}: {e}', file=sys.stderr)
+        with stage(profiler, 'write'):
+            index.save(index_path)
+        print(f'{len(index)} screens in {index_path}')
+    elif command == 'query':
+        for path in corpus_files(paths):
+            with stage(profiler, 'read'):
+                plate = load_plate(path, factory)
+            with stage(profiler, 'query'):
+                duplicates = index.duplicates_of(plate)
+                similar = index.similar(plate, threshold, exclude=str(path))
+            print(path)
+            for name in duplicates:
+                print(f'    duplicate {name}')
+            for name, score in similar:
+                print(f'    {score:.2f} {name}')
+    elif command == 'duplicates':
+        with stage(profiler, 'query'):
+            groups = index.duplicate_groups()
+            pairs = index.near_duplicate_pairs(threshold)
+        for group in groups:
+            print('duplicates: ' + ', '.join(group))
+        for name, other, score in pairs:
+            print(f'{score:.2f} {name} ~ {other}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Duplicate and near duplicate screen detection.')
+
+    parser.add_argument('command', choices=('add', 'query', 'duplicates'))
+    parser.add_argument('index', help='the index file, created by add')
+    parser.add_argument('paths', nargs='*', help='xml files or directories of them')
+    parser.add_argument('--data-dir', type=str, default=None,
+                        help='reference data, needed for CrystalTrak designs')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='minimum estimated fraction of shared conditions')
+
+    from contextlib import nullcontext
+    from . import profiling
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    profiler = profiling.from_args(
+        args, command=f'duplicates {args.command}', inputs=args.paths,
+        options={'index': args.index, 'data_dir': args.data_dir, 'threshold': args.threshold})
+    with profiler or nullcontext():
+        main(
+            command=args.command,
+            index_path=args.index,
+            paths=args.paths,
+            data_dir=args.data_dir,
+            threshold=args.threshold,
+            profiler=profiler,
+        )
@@ -0,0 +1,146 @@
+from __future__ import annotations
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, List
+import argparse
+import json
+import sys
+
+# Explains the recipe solver (pick_stocks_for_well) on designs: for each well what the stock
+# finders produced, which stocks were unavailable, how many combinations were tried and
+# overflowed, and where the time went (see recipe.trace_well). The traces of a batch are
+# aggregated to find the wells and chemicals that dominate the runtime and the failures.
+
+
+def trace_design(factory, design, require_exact_ph: bool = True) -> dict:
+    '''
+    The trace of every well of a Design, solved as design2screen would without a recipe
+    '''
+    from .recipe import trace_well
+
+    # As in design2screen
+    design.set_one_ph()
+    geometry = design.geometry
+    wells = []
+    for well_id, dw in design.wells.items():
+        trace = trace_well(dw, factory.stocks, factory.phcurve, require_exact_ph)
+        wells.append(dict(well=geometry.name(well_id), well_id=well_id, **trace))
+    return {
+        'design': design.name,
+        'require_exact_ph': require_exact_ph,
+        'wells': wells,
+        'time': sum(x['time']['total'] for x in wells),
+        'errors': sum(x['status'] == 'error' for x in wells),
+    }
+
+
+def trace_design_file(factory, path, require_exact_ph: bool = True) -> dict:
+    from .utils import xml_root
+
+    design = factory.design.get_design_from_xml_object(xml_root(str(path)))
+    return dict(path=str(path), **trace_design(factory, design, require_exact_ph))
+
+
+def aggregate(traces: Iterable[dict], top: int = 20) -> dict:
+    '''
+    Summary of design traces: the slowest wells, the chemicals by the time spent finding their
+    stocks, and the wells that failed with the factors that had no possible stocks
+    '''
+    wells = []
+    chemicals = defaultdict(lambda: {'factors': 0, 'time': 0.0, 'unavailable': 0, 'no_stocks': 0})
+    errors = []
+    for trace in traces:
+        for well in trace['wells']:
+            key = {'design': trace['design'], 'path': trace.get('path'), 'well': well['well']}
+            wells.append(dict(key, time=well['time']['total'],
+                              combinations=well.get('combinations'), overflowed=well.get('overflowed')))
+            for factor in well.get('factors', ()):
+                chemical = chemicals[factor['chemical']]
+                chemical['factors'] += 1
+                chemical['time'] += sum(factor['time'].values())
+                chemical['unavailable'] += len(factor['unavailable'])
+                chemical['no_stocks'] += factor['possible_stocks'] == 0
+            if well['status'] == 'error':
+                errors.append(dict(key, error=well['error'], no_stocks=[
+                    x['chemical'] for x in well.get('factors', ()) if x['possible_stocks'] == 0]))
+
+    wells.sort(key=lambda x: -x['time'])
+    return {
+        'wells': len(wells),
+        'time': sum(x['time'] for x in wells),
+        'slowest_wells': wells[:top],
+        'chemicals': sorted(
+            (dict(chemical=name, **value) for name, value in chemicals.items()),
+            key=lambda x: -x['time'])[:top],
+        'errors': errors,
+    }
+
+
+def main(*, design_xml: List, data_dir, output_json=None, require_exact_ph=True, top=20, profiler=None):
+    '''
+    Writes {'designs': [trace], 'summary': aggregate} as json to output_json or stdout and
+    prints the summary to stderr
+    profiler: a profiling.Profiler, the stages of the designs are summed
+    '''
+    from .create_rxml import FactoriesJSON
+    from .profiling import stage
+
+    with stage(profiler, 'load_data'):
+        factory = FactoriesJSON(data_dir=data_dir)
+    with stage(profiler, 'trace'):
+        traces = [trace_design_file(factory, path, require_exact_ph) for path in design_xml]
+    with stage(profiler, 'summary'):
+        summary = aggregate(traces, top=top)
+    result = {'designs': traces, 'summary': summary}
+
+    with stage(profiler, 'write'):
+        if output_json is None:
+            json.dump(result, sys.stdout, indent=1)
+            print()
+        else:
+            with open(output_json, 'w') as f:
+                json.dump(result, f, indent=1)
+
+    print(f"{summary['wells']} wells, {summary['time']:.4f}s, {len(summary['errors'])} errors",
+          file=sys.stderr)
+    for well in summary['slowest_wells'][:5]:
+        print(f"    {well['time']:.6f}s {Path(well['path'] or well['design']).name} {well['well']} "
+              f"{well['combinations']} combinations, {well['overflowed']} overflowed", file=sys.stderr)
+    for error in summary['errors']:
+        print(f"    error {Path(error['path'] or error['design']).name} {error['well']}: {error['error']}",
+              file=sys.stderr)
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Explain the recipe solver on CrystalTrak designs.')
+
+    parser.add_argument('design_xml', nargs='+')
+    parser.add_argument('--data-dir', type=str, default='data')
+    parser.add_argument('--output-json', type=str, default=None,
+                        help='write the traces here instead of stdout')
+    parser.add_argument('--no-exact-ph', action='store_true',
+                        help='allow stocks within the pH tolerance')
+    parser.add_argument('--top', type=int, default=20,
+                        help='wells and chemicals listed in the summary')
+
+    from contextlib import nullcontext
+    from . import profiling
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    profiler = profiling.from_args(
+        args, command='explain', inputs=args.design_xml,
+        options={'data_dir': args.data_dir, 'output_json': args.output_json,
+                 'require_exact_ph': not args.no_exact_ph, 'top': args.top})
+    with profiler or nullcontext():
+        main(
+            design_xml=args.design_xml,
+            data_dir=args.data_dir,
+            output_json=args.output_json,
+            require_exact_ph=not args.no_exact_ph,
+            top=args.top,
+            profiler=profiler,
+        )
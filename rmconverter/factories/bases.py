@@ -5,44 +5,117 @@ Created on Tue Oct 29 08:51:07 2024
 @author: owe043
 """
 
-import copy
+from typing import Iterable, Optional
+
+from .names import ChemicalNameIndex
 
 
 class _ChemicalsFactory:
     def __init__(self, chemicals):
         self.chemicals = chemicals
 
+        # Index the names and aliases, later entries take precedence for identical names
+        self.name_index = ChemicalNameIndex()
+        for chemical in self.chemicals.values():
+            self.name_index.add(chemical.name, chemical.id)
+            for alias in chemical.aliases:
+                self.name_index.add(alias, chemical.id)
+
     def get_chem_by_id(self, chem_id: int):
         return self.chemicals[chem_id]
 
     def get_chem_by_name(self, chem_name: str):
-        for chemical in self.chemicals.values():
-            # todo: use string collation
-            if chem_name.lower() == chemical.name.lower():
-                return chemical
+        chem_id = self.name_index.get(chem_name)
+        if chem_id is not None:
+            return self.get_chem_by_id(chem_id)
         return None
 
+    def suggest_chems(self, chem_name: str, k: int = 5):
+        '''
+        The k chemicals with the closest names as [(chemical, matched name, score)], best first
+        '''
+        return [
+            (self.get_chem_by_id(chem_id), name, score)
+            for name, chem_id, score in self.name_index.suggest(chem_name, k=k)
+        ]
+
+
+class StockAvailability:
+    '''
+    Which stocks can be used in a recipe. A stock is available if its STOCK_STATE is set and
+        - it is in stock_ids, if given
+        - it has a rack, if require_rack is set
+    Instances are not modified, a new one is swapped in with _StocksFactory.set_availability.
+    '''
+
+    def __init__(self, stock_ids: Optional[Iterable[int]] = None, require_rack: bool = False):
+        self.stock_ids = None if stock_ids is None else frozenset(stock_ids)
+        self.require_rack = require_rack
+
+    def is_available(self, stock) -> bool:
+        if not stock.available:
+            return False
+        if self.stock_ids is not None and stock.id not in self.stock_ids:
+            return False
+        if self.require_rack and not stock.rack:
+            return False
+        return True
+
 
 class _StocksFactory:
-    def __init__(self, stocks):
+    '''
+    The stocks are frozen and the getters return the shared objects rather than copies,
+    so one factory can be used by concurrent conversions. Callers that record wells take a
+    stock.copy().
+    '''
+
+    def __init__(self, stocks, availability: Optional[StockAvailability] = None):
 
         self.stocks = stocks
+        for stock in self.stocks.values():
+            stock.freeze()
+
+        # chem_id -> stocks, in the order of self.stocks
+        self.stocks_by_chem = {}
+        for stock in self.stocks.values():
+            self.stocks_by_chem.setdefault(stock.chem.id, []).append(stock)
+
+        self.set_availability(StockAvailability() if availability is None else availability)
+
+    def set_availability(self, availability: StockAvailability):
+        '''
+        Precomputes the available stocks of every chemical and swaps them in with a single
+        assignment, so it is safe to call while conversions are running.
+        '''
+        available_by_chem = {
+            chem_id: tuple(x for x in stocks if availability.is_available(x))
+            for chem_id, stocks in self.stocks_by_chem.items()
+        }
+        self._availability = (availability, available_by_chem)
+
+    @property
+    def availability(self) -> StockAvailability:
+        return self._availability[0]
 
     def get_stock_by_id(self, stock_id: int):
         assert isinstance(stock_id, int)
-        return copy.deepcopy(self.stocks[stock_id])
+        return self.stocks[stock_id]
 
     def get_first_stock_by_chemid(self, chem_id: int):
-        for stock in self.stocks.values():
-            if stock.chem.id == chem_id:
-                return copy.deepcopy(stock)
+        stocks = self.stocks_by_chem.get(chem_id)
+        if stocks:
+            return stocks[0]
         return None
 
     def get_stocks_by_chemid(self, chem_id: int):
-        return [copy.deepcopy(x) for x in self.stocks.values() if x.chem.id == chem_id]
+        return list(self.stocks_by_chem.get(chem_id, ()))
+
+    def get_available_stocks_by_chemid(self, chem_id: int):
+        _, available_by_chem = self._availability
+        return list(available_by_chem.get(chem_id, ()))
 
     def get_stocks_by_chem(self, chem_name: str):
-        return [copy.deepcopy(x) for x in self.stocks.values() if x.chem.name == chem_name]
+        return [x for x in self.stocks.values() if x.chem.name == chem_name]
 
 
 class _PhCurveFactory:
@@ -64,3 +137,44 @@ class _PhCurveFactory:
 
     def is_chem_curve(self, chem_id: int) -> bool:
         return chem_id in self.curves
+
+
+class _ChemGroupFactory:
+    '''
+    Chemical group membership stored as one int bitset per chemical, so a membership test is a
+    single AND. Each group id is given a bit in the order it is first seen.
+    '''
+
+    def __init__(self, memberships, group_names: dict):
+        # memberships: iterable of (chem_id, group_id)
+        self.group_names = dict(group_names)
+        self.group_bits = {}
+        self.masks = {}
+        for chem_id, group_id in memberships:
+            if group_id not in self.group_bits:
+                self.group_bits[group_id] = 1 << len(self.group_bits)
+                self.group_names.setdefault(group_id, f'Group {group_id}')
+            self.masks[chem_id] = self.masks.get(chem_id, 0) | self.group_bits[group_id]
+        self.group_ids_by_name = {
+            name.lower(): group_id for group_id, name in self.group_names.items()}
+
+    def get_group_mask(self, *groups) -> int:
+        '''
+        The bitset of the given groups, by id or name. Unknown groups have no bits.
+        '''
+        mask = 0
+        for group in groups:
+            if isinstance(group, str):
+                group = self.group_ids_by_name.get(group.lower())
+            mask |= self.group_bits.get(group, 0)
+        return mask
+
+    def get_mask(self, chem_id: int) -> int:
+        return self.masks.get(chem_id, 0)
+
+    def get_groups(self, chem_id: int):
+        mask = self.get_mask(chem_id)
+        return [self.group_names[group_id] for group_id, bit in self.group_bits.items() if mask & bit]
+
+    def in_group(self, chem_id: int, *groups) -> bool:
+        return bool(self.get_mask(chem_id) & self.get_group_mask(*groups))
@@ -6,9 +6,12 @@ from ..factories import xtaltrak as factories_xt
 
 from .. import utils
 from ..config import constants
-from ..recipe import pick_stocks_for_well
+from ..exceptions import ChemNotFoundError, RecipeError
+from ..recipe import pick_stocks_for_well, k_best_stocks_for_well
+from ..plate import PlateGeometry
 
 from typing import List, Optional
+import warnings
 
 ####################################################################################################
 # Rockmaker to Xtaltrak
@@ -19,6 +22,7 @@ def rm2xt_stock(
         rm_stock: objects_rm.Stock,
         rm_ingred: objects_rm.Ingredient,
         stocks_f: Optional[factories_xt.StocksFactory] = None,
+        geometry: Optional[PlateGeometry] = None,
     ) -> objects_xt.Stock:
     # Fill in the missing (None) values with stock data if available
     barcode = None
@@ -35,7 +39,8 @@ def rm2xt_stock(
             if stock_id is not None:
                 stock = stocks_f.get_stock_by_id(stock_id)
                 if stock is not None:
-                    return stock
+                    # The caller adds the wells
+                    return stock.copy()
 
     xt_stock = objects_xt.Stock(
         stock_id=None,
@@ -53,7 +58,7 @@ def rm2xt_stock(
     )
     for well_id in rm_stock.usages:
         xt_stock.add_well(objects_xt.Well(
-            utils.wellid2name(well_id + 1),
+            utils.wellid2name(well_id, geometry),
             rm_stock.usages[well_id],
         ))
     return xt_stock
@@ -78,40 +83,43 @@ def rmscreen2xtrecipe(
         stocks_f: Optional[factories_xt.StocksFactory] = None,
     ) -> objects_xt.SourcePlate:
     # TODO check volume has been created
+    geometry = rm_screen.plate_geometry
     sp = objects_xt.SourcePlate(
         description=constants.DEFAULT_DESC,
         name=rm_screen.name,
-        volume=rm_screen.volume
+        volume=rm_screen.volume,
+        geometry=geometry,
     )
     # stock_name -> xt_stock
     stock_map = {}
 
     def add_stock(rm_stock, rm_ingredient, volume, well_id):
         if volume is None:
-            raise ValueError(f"Volume is None for stock {rm_stock.localID} in well {utils.wellid2name(well_id)}")
+            raise ValueError(f"Volume is None for stock {rm_stock.localID} in well {geometry.name(well_id)}")
         xt_stock = rm2xt_stock(
             rm_stock=rm_stock,
             rm_ingred=rm_ingredient,
-            stocks_f=stocks_f
+            stocks_f=stocks_f,
+            geometry=geometry,
         )
         if xt_stock.stock_name not in stock_map:
             stock_map[xt_stock.stock_name] = xt_stock
         xt_stock = stock_map[xt_stock.stock_name]
         # Add the volume
         xt_stock.add_well(objects_xt.Well(
-            utils.wellid2name(well_id),
+            geometry.name(well_id),
             volume
         ))
         
-    for i, cond in enumerate(rm_screen.conditions):
+    for well_id, cond in enumerate(rm_screen.conditions, start=1):
         for cond_ingred in cond:
             add_stock(cond_ingred.stock, cond_ingred.ingredient,
-                      cond_ingred.volume, i + 1)
+                      cond_ingred.volume, well_id)
             
             if cond_ingred.high_ph_stock is not None:
             # If there is a high pH stock, add it as well
                 add_stock(cond_ingred.high_ph_stock, cond_ingred.ingredient,
-                            cond_ingred.high_ph_volume, i + 1)
+                            cond_ingred.high_ph_volume, well_id)
 
     # Add all the stocks in the stock_map to the source plate
     for stock in stock_map.values():
@@ -121,6 +129,128 @@ def rmscreen2xtrecipe(
     return sp
 
 
+# RockMaker units -> CrystalTrak design units
+RM2XT_UNITS = {'%w/v': 'w/v', '%v/v': 'v/v'}
+
+
+def ingredient_chemical_name(rm_ingred: objects_rm.Ingredient) -> str:
+    '''
+    The ingredient name without the lab suffix that Ingredient.name adds (see utils.suffix_str)
+    '''
+    name = rm_ingred.ingredient_name.strip()
+    suffix = f' {constants.LAB_NAME}'
+    if name.endswith(suffix):
+        name = name[:-len(suffix)].strip()
+    return name
+
+
+def _titration_points(points) -> List[tuple]:
+    # Rounded as the points may have been through xml
+    return sorted((round(ph, 6), round(acid, 6)) for ph, acid in points)
+
+
+def rmingredient2curvechemical(
+        rm_ingred: objects_rm.Ingredient,
+        phcurve_f: factories_xt.PhCurveFactory,
+        stock_chems: List[objects_xt.Chemical],
+) -> Optional[objects_xt.Chemical]:
+    '''
+    The chemical of the pH curve with the ingredient's titration table, None if the ingredient
+    has no titration table or no curve matches. If the stocks of the ingredient were found,
+    the curve must be made from their chemicals.
+    '''
+    if rm_ingred.buffer_data is None or rm_ingred.buffer_data.titration_table is None:
+        return None
+    table = _titration_points((x.ph, x.acidToBaseRatio) for x in rm_ingred.buffer_data.titration_table)
+    stock_chem_ids = set(x.id for x in stock_chems)
+    for curve in phcurve_f.curves.values():
+        if not stock_chem_ids <= {curve.chem.id, curve.low_chem.id, curve.high_chem.id}:
+            continue
+        if _titration_points((x.ph, x.acid_fraction) for x in curve.points) == table:
+            return curve.chem
+    return None
+
+
+def rmingredient2chemical(
+        rm_ingred: objects_rm.Ingredient,
+        chems_f: factories_xt.ChemicalsFactory,
+        stocks_f: Optional[factories_xt.StocksFactory] = None,
+        fuzzy_threshold: Optional[float] = None,
+        phcurve_f: Optional[factories_xt.PhCurveFactory] = None,
+) -> objects_xt.Chemical:
+    '''
+    The catalogue chemical of a RockMaker ingredient, found by (in order) its name without the
+    lab suffix, its aliases, the pH curve of its titration table (see rmingredient2curvechemical),
+    the barcode of one of its stocks and, if fuzzy_threshold is set, the most similar name
+    '''
+    name = ingredient_chemical_name(rm_ingred)
+    for x in [name, *sorted(rm_ingred.aliases)]:
+        chem = chems_f.get_chem_by_name(x)
+        if chem is not None:
+            return chem
+    stock_chems = []
+    if stocks_f is not None:
+        for rm_stock in sorted(rm_ingred.stocks, key=lambda x: x.localID):
+            barcode = utils.partnumber_to_barcode(rm_stock.vendorPartNumber or '')
+            if barcode.isdigit() and int(barcode) in stocks_f.stocks:
+                stock_chems.append(stocks_f.get_stock_by_id(int(barcode)).chem)
+    if phcurve_f is not None:
+        # A buffer made from two stocks is the curve's chemical, not the chemical of either stock
+        chem = rmingredient2curvechemical(rm_ingred, phcurve_f, stock_chems)
+        if chem is not None:
+            return chem
+    if len(stock_chems) > 0:
+        return stock_chems[0]
+
+    suggestions = chems_f.suggest_chems(name)
+    if fuzzy_threshold is not None and len(suggestions) > 0:
+        best_chem, best_name, best_score = suggestions[0]
+        if best_score >= fuzzy_threshold:
+            warnings.warn(
+                f'Chemical {name} not found, using {best_name} (similarity {best_score:.2f})')
+            return best_chem
+    mesg = f'Cant find chemical {name}'
+    if len(suggestions) > 0:
+        mesg += '. Closest names: ' + ', '.join(f'{x[1]} ({x[2]:.2f})' for x in suggestions)
+    raise ChemNotFoundError(mesg)
+
+
+def rmscreen2design(
+        rm_screen: objects_rm.Screen,
+        chems_f: factories_xt.ChemicalsFactory,
+        stocks_f: Optional[factories_xt.StocksFactory] = None,
+        fuzzy_threshold: Optional[float] = None,
+        phcurve_f: Optional[factories_xt.PhCurveFactory] = None,
+) -> objects_xt.Design:
+    '''
+    The CrystalTrak design of a RockMaker screen, condition i is well i + 1
+    phcurve_f: resolves buffers with a titration table to the chemical of their pH curve
+    '''
+    design = objects_xt.Design(name=rm_screen.name, geometry=rm_screen.plate_geometry)
+    # Each ingredient is looked up once
+    chem_memo = {}
+    for well_id, cond in enumerate(rm_screen.conditions, start=1):
+        items = []
+        for cond_ingred in cond:
+            rm_ingred = cond_ingred.ingredient
+            chem = chem_memo.get(id(rm_ingred))
+            if chem is None:
+                chem = chem_memo[id(rm_ingred)] = rmingredient2chemical(
+                    rm_ingred, chems_f, stocks_f=stocks_f, fuzzy_threshold=fuzzy_threshold,
+                    phcurve_f=phcurve_f)
+            is_buffer = cond_ingred.type == constants.BUFFER
+            units = cond_ingred.stock.units
+            items.append(objects_xt.DesignItem(
+                chemical=chem,
+                item_class=constants.BUFFER if is_buffer else constants.PRECIPITANT,
+                concentration=cond_ingred.concentration,
+                units=RM2XT_UNITS.get(units, units),
+                ph=cond_ingred.ph,
+            ))
+        design.add_well(objects_xt.DesignWell(items=items), well_id)
+    return design
+
+
 ####################################################################################################
 # Xtaltrak to Rockmaker
 ####################################################################################################
@@ -150,16 +280,22 @@ def designitem2conditioningredient(
         phcurve_f: Optional[factories_xt.PhCurveFactory] = None,
         stocks_f: Optional[factories_xt.StocksFactory] = None,
         include_aliases: Optional[bool] = False,
+        ingredient_memo: Optional[dict] = None,
 ) -> objects_rm.ConditionIngredient:
     rm_stock = xt2rm_stock(stock, is_buffer=di.is_buffer)
     ingredient = chemical2ingredient(
-        chem=di.chemical, ph=stock.ph, phcurve_f=phcurve_f, stocks_f=stocks_f, include_aliases=include_aliases)
-    ingredient.stocks.add(rm_stock)
+        chem=di.chemical, ph=stock.ph, phcurve_f=phcurve_f, stocks_f=stocks_f, include_aliases=include_aliases,
+        ingredient_memo=ingredient_memo)
     rm_high_stock = None
     if high_stock is not None:
         rm_high_stock = xt2rm_stock(
             high_stock, is_buffer=di.is_buffer,)
-        ingredient.stocks.add(rm_high_stock)
+    # A memoised ingredient is a template shared by every well, the stocks are added to the
+    # screen's own ingredient when the condition is merged into the screen
+    if ingredient_memo is None:
+        ingredient.stocks.add(rm_stock)
+        if rm_high_stock is not None:
+            ingredient.stocks.add(rm_high_stock)
     return objects_rm.ConditionIngredient(
         conc=di.concentration,
         cond_type=di.item_class,
@@ -177,7 +313,18 @@ def chemical2ingredient(
         stocks_f: Optional[factories_xt.StocksFactory],
         ph: Optional[bool] = None,
         include_aliases: Optional[bool] = False,
+        ingredient_memo: Optional[dict] = None,
 ) -> objects_rm.Ingredient:
+    '''
+    If ingredient_memo is given it is used as a per conversion cache keyed by
+    (chem id, include_aliases) and the returned ingredient is shared between calls.
+    '''
+    memo_key = None
+    if ingredient_memo is not None and chem.id is not None:
+        memo_key = (chem.id, include_aliases)
+        if memo_key in ingredient_memo:
+            return ingredient_memo[memo_key]
+
     # Create the buffer data
     buffer_data = None
     if phcurve_f is not None and phcurve_f.is_chem_curve(chem.id):
@@ -212,6 +359,8 @@ def chemical2ingredient(
     if include_aliases:
         for alias in chem.aliases:
             ingred.aliases.add(alias)
+    if memo_key is not None:
+        ingredient_memo[memo_key] = ingred
     return ingred
 
 
@@ -222,6 +371,7 @@ def designwell2condition(
         phcurve_f: Optional[factories_xt.PhCurveFactory] = None,
         stocks_f: Optional[factories_xt.StocksFactory] = None,
         include_aliases: Optional[bool] = False,
+        ingredient_memo: Optional[dict] = None,
 ) -> objects_rm.Condition:
     condition = objects_rm.Condition()
     for di, (stock, high_stock) in zip(designwell.items, stocks):
@@ -234,7 +384,8 @@ def designwell2condition(
                 well_id=well_id,
                 phcurve_f=phcurve_f,
                 stocks_f=stocks_f,
-                include_aliases=include_aliases
+                include_aliases=include_aliases,
+                ingredient_memo=ingredient_memo,
             ))
     return condition
 
@@ -246,25 +397,47 @@ def design2screen(
         phcurve_f: factories_xt.PhCurveFactory,
         require_exact_ph: bool,
         include_aliases: Optional[bool] = False,
+        alternatives: int = 0,
 ) -> objects_rm.Screen:
+    '''
+    alternatives: when solving the recipe, keep this many of the best stock assignments of each
+    well in screen.alternatives
+    '''
     # Required for buffer class fixes
     design.set_one_ph()
-    screen = objects_rm.Screen(name=design.name)
+    geometry = design.geometry
+    screen = objects_rm.Screen(name=design.name, geometry=geometry)
+    # Ingredients (and their buffer data) shared by all the wells of this conversion
+    ingredient_memo = {}
 
+    stocks_by_well = None if recipe is None else recipe.get_stocks_by_well(geometry)
     for well_id, dw in design.wells.items():
         # Get the stocks
         if recipe is None:
-            stocks = pick_stocks_for_well(
-                dw,
-                stocks_f=stocks_f,
-                phcurve_f=phcurve_f,
-                require_exact_ph=require_exact_ph
-            )
+            if alternatives > 0:
+                ranked = k_best_stocks_for_well(
+                    dw,
+                    stocks_f=stocks_f,
+                    phcurve_f=phcurve_f,
+                    require_exact_ph=require_exact_ph,
+                    k=alternatives,
+                )
+                if not ranked:
+                    raise RecipeError('Could not generate recipe.')
+                screen.alternatives[well_id] = ranked
+                stocks = ranked[0][0]
+            else:
+                stocks = pick_stocks_for_well(
+                    dw,
+                    stocks_f=stocks_f,
+                    phcurve_f=phcurve_f,
+                    require_exact_ph=require_exact_ph
+                )
             # Set the one_stock property
             for di, (_, high_stock) in zip(dw.items, stocks):
                 di.one_stock = high_stock == None
         else:
-            well_stocks = recipe.get_stocks_for_well(well_id)
+            well_stocks = stocks_by_well.get(well_id, [])
             # Sort the stocks into (low_stock, high_stock) for each design item
             sorted_stocks = []
             for di in dw.items:
@@ -296,7 +469,7 @@ def design2screen(
                 if len(chem_stocks) == 2:
                     high_stock = chem_stocks[1]
                 if high_stock is not None and high_stock.ph is None:
-                    raise Exception(f"High stock {high_stock.name} in well {utils.wellid2name(well_id)} {well_id} has no pH value.")
+                    raise Exception(f"High stock {high_stock.name} in well {geometry.name(well_id)} {well_id} has no pH value.")
                 if high_stock is not None and low_stock.ph > high_stock.ph:
                     low_stock, high_stock = high_stock, low_stock
 
@@ -304,6 +477,7 @@ def design2screen(
             stocks = sorted_stocks
 
         screen.add_condition(designwell2condition(
-            designwell=dw, stocks=stocks, well_id=well_id, phcurve_f=phcurve_f, stocks_f=stocks_f, include_aliases=include_aliases))
+            designwell=dw, stocks=stocks, well_id=well_id, phcurve_f=phcurve_f, stocks_f=stocks_f, include_aliases=include_aliases,
+            ingredient_memo=ingredient_memo))
 
     return screen
@@ -0,0 +1,132 @@
+from __future__ import annotations
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+import re
+import unicodedata
+
+
+GREEK_LETTERS = {
+    'α': 'alpha', 'β': 'beta', 'γ': 'gamma', 'δ': 'delta', 'ε': 'epsilon', 'ζ': 'zeta',
+    'η': 'eta', 'θ': 'theta', 'ι': 'iota', 'κ': 'kappa', 'λ': 'lambda', 'μ': 'mu',
+    'ν': 'nu', 'ξ': 'xi', 'ο': 'omicron', 'π': 'pi', 'ρ': 'rho', 'σ': 'sigma', 'ς': 'sigma',
+    'τ': 'tau', 'υ': 'upsilon', 'φ': 'phi', 'χ': 'chi', 'ψ': 'psi', 'ω': 'omega',
+}
+
+# eg. "magnesium chloride hexahydrate", "zinc sulfate.7H2O", "sodium acetate (anhydrous)"
+_hydration_re = re.compile(
+    r'\b(mono|di|tri|tetra|penta|hexa|hepta|octa|nona|deca|sesqui|hemi)?hydrated?\b'
+    r'|\banhydrous\b'
+    r'|[\s.·•*×]*\(?\s*\d*\s*(?<![a-z])h2o\s*\)?(?![a-z0-9])')
+_greek_re = re.compile('|'.join(GREEK_LETTERS))
+_not_alnum_re = re.compile(r'[^a-z0-9]+')
+
+TRIGRAM_PAD = '  '
+
+
+def _strip_accents(name: str) -> str:
+    return ''.join(
+        c for c in unicodedata.normalize('NFKD', name) if not unicodedata.combining(c))
+
+
+def normalize_name(name: str) -> str:
+    '''
+    A key that is the same for trivially different spellings of a chemical name:
+    case, accents, Greek letters, hydration suffixes, whitespace and punctuation are ignored.
+    eg. "Bis-Tris  propane" -> "bistrispropane", "β-alanine" -> "betaalanine",
+        "magnesium chloride hexahydrate" -> "magnesiumchloride"
+    '''
+    name = _strip_accents(name.lower())
+    name = _greek_re.sub(lambda m: GREEK_LETTERS[m.group(0)], name)
+    key = _not_alnum_re.sub('', _hydration_re.sub(' ', name))
+    if not key:
+        # The name was only a hydration term, eg. "H2O"
+        key = _not_alnum_re.sub('', name)
+    return key
+
+
+def trigrams(key: str) -> Set[str]:
+    padded = f'{TRIGRAM_PAD}{key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ChemicalNameIndex:
+    '''
+    Resolves chemical names and aliases to chemical ids.
+
+    Lookups try, in order:
+        - the case-insensitive name
+        - the normalised name (see normalize_name), if it belongs to a single chemical
+    suggest() ranks the closest names by trigram similarity of the normalised names.
+    '''
+
+    def __init__(self):
+        # lower case name -> chem id
+        self._exact: Dict[str, int] = {}
+        # normalised name -> chem ids
+        self._normalized: Dict[str, Set[int]] = defaultdict(set)
+        # normalised name -> a name it was added as, for suggestions
+        self._display: Dict[str, str] = {}
+        self._keys: List[str] = []
+        self._key_trigram_counts: List[int] = []
+        self._trigram_index: Dict[str, List[int]] = defaultdict(list)
+
+    def add(self, name: str, chem_id: int):
+        self._exact[name.lower()] = chem_id
+        key = normalize_name(name)
+        if key not in self._normalized:
+            key_idx = len(self._keys)
+            self._keys.append(key)
+            key_trigrams = trigrams(key)
+            self._key_trigram_counts.append(len(key_trigrams))
+            for trigram in key_trigrams:
+                self._trigram_index[trigram].append(key_idx)
+            self._display[key] = name
+        self._normalized[key].add(chem_id)
+
+    def __contains__(self, name: str) -> bool:
+        return self.get(name) is not None
+
+    def __len__(self):
+        return len(self._exact)
+
+    def get_exact(self, name: str) -> Optional[int]:
+        return self._exact.get(name.lower())
+
+    def get(self, name: str) -> Optional[int]:
+        chem_id = self._exact.get(name.lower())
+        if chem_id is not None:
+            return chem_id
+        chem_ids = self._normalized.get(normalize_name(name))
+        if chem_ids is not None and len(chem_ids) == 1:
+            return next(iter(chem_ids))
+        return None
+
+    def suggest(self, name: str, k: int = 5, min_score: float = 0.3) -> List[Tuple[str, int, float]]:
+        '''
+        The k closest (name, chem id, score) by trigram jaccard similarity, best first.
+        Names that normalise to several chemicals give one entry per chemical.
+        '''
+        query = trigrams(normalize_name(name))
+        if not query:
+            return []
+        overlap = defaultdict(int)
+        for trigram in query:
+            for key_idx in self._trigram_index.get(trigram, ()):
+                overlap[key_idx] += 1
+
+        scored = []
+        n_query = len(query)
+        for key_idx, count in overlap.items():
+            score = count / (n_query + self._key_trigram_counts[key_idx] - count)
+            if score >= min_score:
+                scored.append((score, key_idx))
+        scored.sort(key=lambda x: (-x[0], self._keys[x[1]]))
+
+        suggestions = []
+        for score, key_idx in scored:
+            key = self._keys[key_idx]
+            for chem_id in sorted(self._normalized[key]):
+                suggestions.append((self._display[key], chem_id, score))
+            if len(suggestions) >= k:
+                break
+        return suggestions[:k]
@@ -0,0 +1,187 @@
+from __future__ import annotations
+from array import array
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+import csv
+
+from ..objects import rockmaker as objects_rm
+from ..objects import xtaltrak as objects_xt
+from ..factories import xtaltrak as factories_xt
+from ..config import constants
+from .convert import rm2xt_stock
+
+# Plans the stocks for a batch of screens made in one run.
+#
+# rmscreen2xtrecipe gives each screen its own source plate, so a batch repeats the same stocks on
+# every plate. plan_sources instead collects every dispense of every screen into one table of
+# (stock, screen, well, volume) rows with the stocks deduplicated across screens, and aggregates
+# it into the total volume and dispense count of each stock.
+
+
+def stock_key(stock: objects_xt.Stock) -> Tuple:
+    '''
+    Stocks with the same key are the same stock, whichever screen they come from
+    '''
+    return (stock.stock_name, stock.barcode, stock.conc, stock.units, stock.ph)
+
+
+class SourcePlan:
+    '''
+    stocks: The consolidated stocks, without wells
+    screens: (name, volume, geometry) of each screen
+    The dispense table has one row per dispense: dispense_stock, dispense_screen (indices into
+    stocks and screens), dispense_well (well id on that screen's plate) and dispense_volume.
+    The rows of a screen are found through screen_rows, grouped once for the whole table.
+    '''
+
+    def __init__(self):
+        self.stocks: List[objects_xt.Stock] = []
+        self.screens: List[Tuple[str, float, object]] = []
+        self.stock_index: Dict[Tuple, int] = {}
+        self.dispense_stock = array('i')
+        self.dispense_screen = array('i')
+        self.dispense_well = array('i')
+        self.dispense_volume = array('d')
+        # (indptr, order) of the rows grouped by screen, see screen_rows
+        self._screen_groups = None
+
+    def __len__(self):
+        return len(self.dispense_volume)
+
+    def add_stock(self, stock: objects_xt.Stock) -> int:
+        key = stock_key(stock)
+        stock_idx = self.stock_index.get(key)
+        if stock_idx is None:
+            stock_idx = self.stock_index[key] = len(self.stocks)
+            stock = stock.copy()
+            stock.wells = []
+            self.stocks.append(stock)
+        return stock_idx
+
+    def add_dispense(self, stock_idx: int, screen_idx: int, well_id: int, volume: float):
+        self.dispense_stock.append(stock_idx)
+        self.dispense_screen.append(screen_idx)
+        self.dispense_well.append(well_id)
+        self.dispense_volume.append(volume)
+        self._screen_groups = None
+
+    def totals(self) -> Tuple[array, array, List[set]]:
+        '''
+        (total volume, dispense count, screen indices) of each stock, aggregated in one pass
+        '''
+        volumes = array('d', bytes(8 * len(self.stocks)))
+        counts = array('i', bytes(4 * len(self.stocks)))
+        screens = [set() for _ in self.stocks]
+        for stock_idx, screen_idx, volume in zip(
+                self.dispense_stock, self.dispense_screen, self.dispense_volume):
+            volumes[stock_idx] += volume
+            counts[stock_idx] += 1
+            screens[stock_idx].add(screen_idx)
+        return volumes, counts, screens
+
+    def screen_rows(self, screen_idx: int) -> array:
+        '''
+        The row indices of one screen, in table order
+        The rows are grouped by screen with a counting sort the first time this is called
+        (order holds the row indices of screen i at order[indptr[i]:indptr[i + 1]]), so a
+        screen costs its own rows rather than a scan of the table.
+        '''
+        if self._screen_groups is None or len(self._screen_groups[0]) != len(self.screens) + 1:
+            indptr = array('i', bytes(4 * (len(self.screens) + 1)))
+            for s_idx in self.dispense_screen:
+                indptr[s_idx + 1] += 1
+            for i in range(len(self.screens)):
+                indptr[i + 1] += indptr[i]
+            order = array('i', bytes(4 * len(self)))
+            fill = indptr[:-1]
+            for row, s_idx in enumerate(self.dispense_screen):
+                order[fill[s_idx]] = row
+                fill[s_idx] += 1
+            self._screen_groups = (indptr, order)
+        indptr, order = self._screen_groups
+        return order[indptr[screen_idx]:indptr[screen_idx + 1]]
+
+    def screen_wells(self, screen_idx: int) -> Dict[int, List[Tuple[int, float]]]:
+        '''
+        well id -> [(stock index, volume)] for one screen
+        '''
+        wells = defaultdict(list)
+        for row in self.screen_rows(screen_idx):
+            wells[self.dispense_well[row]].append((self.dispense_stock[row], self.dispense_volume[row]))
+        return wells
+
+    def source_plate(self, screen_idx: int) -> objects_xt.SourcePlate:
+        '''
+        The recipe of one screen with the consolidated stocks, in the consolidated order
+        Water is added with add_water(), as create_xtaltrak_recipe does for rmscreen2xtrecipe
+        '''
+        name, volume, geometry = self.screens[screen_idx]
+        sp = objects_xt.SourcePlate(
+            description=constants.DEFAULT_DESC,
+            name=name,
+            volume=volume,
+            geometry=geometry,
+        )
+        stocks = {}
+        for row in self.screen_rows(screen_idx):
+            stock_idx = self.dispense_stock[row]
+            stock = stocks.get(stock_idx)
+            if stock is None:
+                stock = stocks[stock_idx] = self.stocks[stock_idx].copy()
+            stock.add_well(objects_xt.Well(geometry.name(self.dispense_well[row]), self.dispense_volume[row]))
+        sp.stocks.extend(stocks[x] for x in sorted(stocks))
+        sp.add_water()
+        return sp
+
+    def write_inventory(self, f, delimiter: str = ','):
+        '''
+        One CSV row per consolidated stock with its total volume
+        '''
+        volumes, counts, screens = self.totals()
+        writer = csv.writer(f, delimiter=delimiter, lineterminator='\n')
+        writer.writerow(('stock', 'barcode', 'conc', 'units', 'ph', 'volume', 'vunits',
+                         'dispenses', 'screens'))
+        for stock_idx, stock in enumerate(self.stocks):
+            writer.writerow((
+                stock.stock_name, stock.barcode, stock.conc, stock.units, stock.ph,
+                round(volumes[stock_idx], constants.CONC_PREC), stock.vunits,
+                counts[stock_idx], len(screens[stock_idx]),
+            ))
+
+
+def plan_sources(
+        screens: Iterable[Tuple[objects_rm.Screen, float]],
+        stocks_f: Optional[factories_xt.StocksFactory] = None,
+        *,
+        require_exact_ph: bool = True,
+) -> SourcePlan:
+    '''
+    Consolidates the stocks of (screen, volume per well) pairs. The recipe volumes of each
+    screen are calculated here, as in create_xtaltrak_recipe.convert_screen.
+    '''
+    plan = SourcePlan()
+    for screen_idx, (screen, volume) in enumerate(screens):
+        screen.add_recipe_volume(volume, require_exact_ph=require_exact_ph)
+        geometry = screen.plate_geometry
+        plan.screens.append((screen.name, volume, geometry))
+        # rm stock -> consolidated stock index
+        stock_idxs = {}
+
+        def add(rm_stock, rm_ingredient, well_volume, well_id):
+            if well_volume is None:
+                raise ValueError(
+                    f"Volume is None for stock {rm_stock.localID} in well {geometry.name(well_id)} of {screen.name}")
+            stock_idx = stock_idxs.get(id(rm_stock))
+            if stock_idx is None:
+                xt_stock = rm2xt_stock(rm_stock=rm_stock, rm_ingred=rm_ingredient,
+                                       stocks_f=stocks_f, geometry=geometry)
+                stock_idx = stock_idxs[id(rm_stock)] = plan.add_stock(xt_stock)
+            plan.add_dispense(stock_idx, screen_idx, well_id, well_volume)
+
+        for well_id, cond in enumerate(screen.conditions, start=1):
+            for cond_ingred in cond:
+                add(cond_ingred.stock, cond_ingred.ingredient, cond_ingred.volume, well_id)
+                if cond_ingred.high_ph_stock is not None:
+                    add(cond_ingred.high_ph_stock, cond_ingred.ingredient,
+                        cond_ingred.high_ph_volume, well_id)
+    return plan
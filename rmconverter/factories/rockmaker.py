@@ -50,9 +50,11 @@ def screen_from_rxml_dom(xml_root, name=''):
                 titration_table=titration_table,
             )
 
+        # The names are RockMaker's already, they are written back without the lab suffix
         ingredient = Ingredient(
             name=ingredient_xml.find('name').text,
-            buffer_data=buffer_data
+            buffer_data=buffer_data,
+            name_substitution=False,
         )
         # Add aliases
         for alias_xml in all_children(ingredient_xml, 'aliases', 'alias'):
@@ -107,7 +109,7 @@ def screen_from_rxml_dom(xml_root, name=''):
                         'pH') is not None else None,
                     stock=stock,
                     high_ph_stock=high_ph_stock,
-                    well_id=i,
+                    well_id=i + 1,
                 ))
 
         conditions.append(condition)
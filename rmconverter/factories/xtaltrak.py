@@ -1,12 +1,17 @@
 from __future__ import annotations
 
+from typing import Optional
+from pathlib import Path
 import json
+import os
+import warnings
 from lxml import etree
 
 from ..config import constants
 from ..exceptions import ChemNotFoundError
 from ..objects import xtaltrak as xt_objects
-from ..factories.bases import _ChemicalsFactory, _StocksFactory, _PhCurveFactory
+from ..factories.bases import _ChemicalsFactory, _StocksFactory, _PhCurveFactory, _ChemGroupFactory, StockAvailability
+from ..plate import get_geometry
 
 
 class ChemicalsFactory(_ChemicalsFactory):
@@ -20,8 +25,6 @@ class ChemicalsFactory(_ChemicalsFactory):
         for x in alias_data:
             aliases[x['CHEMICAL_ID']].append(x['CHEM_ALIAS'])
 
-        self.name_index = {}
-
         # Load all the chemicals
         chemicals = dict()
         for chem in chem_data:
@@ -38,22 +41,37 @@ class ChemicalsFactory(_ChemicalsFactory):
                 shortname=chem['SHORTNAME']
             )
 
-            # Create a name index
-            self.name_index[chem['NAME'].lower()] = chem_id
-            for alias in aliases[chem_id]:
-                self.name_index[alias.lower()] = chem_id
-
         super().__init__(chemicals)
 
-    def get_chem_by_name(self, chem_name: str):
-        chem_name = chem_name.lower()
-        if chem_name in self.name_index:
-            return self.get_chem_by_id(self.name_index[chem_name])
-        return super().get_chem_by_name(chem_name=chem_name)
+
+# The stocks that are currently in use, see availability_json_path
+DEFAULT_AVAILABILITY_JSON = Path(__file__).parent.parent / 'config' / 'stock_availability.json'
+
+
+def availability_json_path(data_dir) -> Path:
+    '''
+    The data directory's stock_availability.json, or the packaged default if it has none
+    '''
+    path = Path(data_dir) / 'stock_availability.json'
+    return path if path.exists() else DEFAULT_AVAILABILITY_JSON
+
+
+def load_stock_availability(availability_json_path) -> StockAvailability:
+    '''
+    Reads a json list of stock ids, either plain ids or rows with a STOCK_ID
+    '''
+    with open(availability_json_path) as fp:
+        availability_data = json.load(fp)
+    return StockAvailability(
+        x['STOCK_ID'] if isinstance(x, dict) else int(x) for x in availability_data)
 
 
 class StocksFactory(_StocksFactory):
-    def __init__(self, stock_json_path, chems_f: _ChemicalsFactory):
+    def __init__(self, stock_json_path, chems_f: _ChemicalsFactory,
+                 availability_json_path=DEFAULT_AVAILABILITY_JSON):
+        '''
+        availability_json_path: The list of usable stock ids. If None only STOCK_STATE is used.
+        '''
         with open(stock_json_path) as fp:
             stock_data = json.load(fp)
         stocks = {
@@ -68,11 +86,15 @@ class StocksFactory(_StocksFactory):
                 viscosity=x['STOCK_VISCOSITY'],
                 lid_name=x['STOCK_LIDS'],
                 barcode=str(x['STOCK_ID']),
-                available=bool(x['STOCK_STATE'])
+                available=bool(x['STOCK_STATE']),
+                rack=x.get('RACK'),
             ) for x in stock_data
         }
 
-        super().__init__(stocks)
+        availability = None
+        if availability_json_path is not None:
+            availability = load_stock_availability(availability_json_path)
+        super().__init__(stocks, availability)
 
 
 class PhCurveFactory(_PhCurveFactory):
@@ -115,34 +137,85 @@ class PhCurveFactory(_PhCurveFactory):
         super().__init__(curves)
 
 
+class ChemGroupFactory(_ChemGroupFactory):
+    def __init__(self, group_json_path: str):
+        with open(group_json_path) as fp:
+            group_data = json.load(fp)
+
+        super().__init__(
+            ((x['CHEMICAL_ID'], x['GROUP_ID']) for x in group_data),
+            constants.CHEM_GROUPS,
+        )
+
+
 class DesignFactory(object):
-    def __init__(self, chem_factory: ChemicalsFactory):
+    def __init__(self,
+                 chem_factory: ChemicalsFactory,
+                 fuzzy_threshold: Optional[float] = None,
+                 group_factory: Optional[_ChemGroupFactory] = None,
+                 ):
+        '''
+        fuzzy_threshold: If given, a chemical that can't be found by name or barcode is replaced by
+            the closest catalogue name when its similarity is at least this value (0-1).
+            Otherwise a ChemNotFoundError listing the closest names is raised.
+        group_factory: If given, items without a class are classified from the chemical's groups.
+        '''
         self.chem_factory = chem_factory
+        self.fuzzy_threshold = fuzzy_threshold
+        self.group_factory = group_factory
+
+    def get_item_class(self, item_attrib, chem: xt_objects.Chemical) -> str:
+        item_class = item_attrib.get('class', '').strip()
+        if item_class or self.group_factory is None:
+            return item_class
+        if self.group_factory.in_group(chem.id, constants.BUFFER):
+            return constants.BUFFER
+        return constants.PRECIPITANT
+
+    def find_chem(self, item_attrib) -> xt_objects.Chemical:
+        name = item_attrib['name']
+        chem = self.chem_factory.get_chem_by_name(name)
+        if chem is not None:
+            return chem
+        # If the chemical cant be found by name then try to use the barcode
+        if 'barcode' in item_attrib:
+            chem = self.chem_factory.get_chem_by_id(int(item_attrib['barcode']))
+            if chem is not None:
+                return chem
+
+        suggestions = self.chem_factory.suggest_chems(name)
+        if self.fuzzy_threshold is not None and len(suggestions) > 0:
+            best_chem, best_name, best_score = suggestions[0]
+            if best_score >= self.fuzzy_threshold:
+                warnings.warn(
+                    f'Chemical {name} not found, using {best_name} (similarity {best_score:.2f})')
+                return best_chem
+        mesg = f'Cant find chemical {name}'
+        if len(suggestions) > 0:
+            mesg += '. Closest names: ' + ', '.join(f'{x[1]} ({x[2]:.2f})' for x in suggestions)
+        raise ChemNotFoundError(mesg)
 
     def get_design_from_xml_object(self, xml_root) -> xt_objects.Design:
         rd_xml = xml_root.find('reservoir_design')
 
-        design = xt_objects.Design(name=rd_xml.attrib['name'])
+        # The plate layout, eg. <format name="Generic 96 Well" rows="8" cols="12" .../>
+        geometry = None
+        format_xml = rd_xml.find('format')
+        if format_xml is not None and 'rows' in format_xml.attrib and 'cols' in format_xml.attrib:
+            geometry = get_geometry(
+                int(format_xml.attrib['rows']), int(format_xml.attrib['cols']))
+
+        design = xt_objects.Design(name=rd_xml.attrib['name'], geometry=geometry)
 
         for well in rd_xml.findall('well'):
             design_items = list()
             for item in well:
                 # Find the chemical
-                chem = self.chem_factory.get_chem_by_name(
-                    item.attrib['name'])
-                if chem is None:
-                    # If the chemical cant be found by name then try to use the barcode
-                    if 'barcode' in item.attrib:
-                        chem = self.chem_factory.get_chem_by_id(
-                            int(item.attrib['barcode'])
-                        )
-                    if chem is None:
-                        raise ChemNotFoundError(
-                            f'Cant find chemical {item.attrib["name"]}')
+                chem = self.find_chem(item.attrib)
                 design_items.append(
                     xt_objects.DesignItem(
                         chemical=chem,
-                        item_class=item.attrib['class'],
+                        item_class=self.get_item_class(item.attrib, chem),
                         concentration=float(item.attrib['conc']),
                         units=item.attrib['units'],
                         ph=float(
@@ -195,6 +268,7 @@ class RecipeFactory(object):
                 if stock is None:
                     raise Exception(
                         f"Cant find stock {stock_xml.attrib['name']}")
+                stock = stock.copy()
                 for well in stock_xml:
                     if well.attrib['vunits'] != constants.VUNITS:
                         raise Exception(f'vunits must be {constants.VUNITS}')
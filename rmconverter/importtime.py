@@ -0,0 +1,76 @@
+from __future__ import annotations
+from pathlib import Path
+from typing import Dict, List, Sequence
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Checks that the command line modules stay cheap to import: each is imported in a fresh
+# interpreter, the median import time must be within a budget and the heavy modules (NumPy,
+# lxml) must not be loaded. A converter run per file from a shell loop pays this every time.
+
+CLI_MODULES = ('rmconverter.create_rxml', 'rmconverter.create_xtaltrak_recipe',
+               'rmconverter.create_xtaltrak_design')
+HEAVY_MODULES = ('numpy', 'lxml')
+DEFAULT_BUDGET = 0.25
+DEFAULT_REPEAT = 5
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def measure_import(modules: Sequence[str], forbidden: Sequence[str] = HEAVY_MODULES,
+                   repeat: int = DEFAULT_REPEAT, root=ROOT) -> Dict[str, dict]:
+    '''
+    {module: {'times': [...], 'loaded': [forbidden modules it loads]}}, each module imported on
+    its own in a fresh interpreter so a regression is blamed on the module that has it
+    '''
+    results = {}
+    for module in modules:
+        code = (
+            'import json, sys, time\n'
+            't = time.perf_counter()\n'
+            f'import {module}\n'
+            't = time.perf_counter() - t\n'
+            f'print(json.dumps({{"time": t, "loaded": [x for x in {list(forbidden)!r} if x in sys.modules]}}))\n'
+        )
+        times, loaded = [], set()
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, '-c', code], cwd=str(root), check=True,
+                                 capture_output=True, text=True).stdout
+            result = json.loads(out)
+            times.append(result['time'])
+            loaded.update(result['loaded'])
+        results[module] = {'times': times, 'loaded': sorted(loaded)}
+    return results
+
+
+def check_import(modules: Sequence[str] = CLI_MODULES, forbidden: Sequence[str] = HEAVY_MODULES,
+                 budget: float = DEFAULT_BUDGET, repeat: int = DEFAULT_REPEAT, root=ROOT) -> List[str]:
+    '''
+    The failures of the import checks, empty if they pass
+    '''
+    failures = []
+    for module, measured in measure_import(modules, forbidden, repeat, root).items():
+        if measured['loaded']:
+            failures.append(f"import {module}: loads {', '.join(measured['loaded'])}")
+        median = statistics.median(measured['times'])
+        if median > budget:
+            failures.append(f'import {module}: {median * 1000:.1f} ms over the budget of {budget * 1000:.1f} ms')
+    return failures
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check the import time of the command line modules.')
+
+    parser.add_argument('modules', nargs='*', default=list(CLI_MODULES))
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET, help='seconds')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    args = parser.parse_args()
+
+    failed = check_import(args.modules, budget=args.budget, repeat=args.repeat)
+    for failure in failed:
+        print(failure)
+    sys.exit(1 if failed else 0)
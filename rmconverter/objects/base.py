@@ -1,13 +1,18 @@
 from __future__ import annotations
-from typing import Dict, List, Optional, Callable, Union
+from typing import Dict, List, Optional, Callable, Hashable
 from lxml import etree
+from collections import OrderedDict
 from collections.abc import Iterable
+import copy
+import threading
 
 from ..utils import convertstr
 from ..config.constants import VUNITS
 
 
 class IndexedList(list):
+    __slots__ = ('key', '_index')
+
     def __init__(self, *args, key=lambda x: x):
         super().__init__(*args)
         self.key = key
@@ -60,56 +65,334 @@ class IndexedList(list):
 
 
 class VolumeUnitsMixin:
+    __slots__ = ()
+
     @property
     def vunits(self):
         return VUNITS
 
 
 class PhMixin:
+    __slots__ = ()
+
     @property
     def pH(self):
         return self.ph
 
 
+def format_text(value) -> str:
+    '''
+    Formats a scalar child element's text
+    '''
+    if isinstance(value, float):
+        return f'{value:g}'
+    return str(value)
+
+
+def _new_element(parent, tag: str, attrib: Dict[str, str]) -> etree.Element:
+    if parent is None:
+        return etree.Element(tag, attrib)
+    return etree.SubElement(parent, tag, attrib)
+
+
+####################################################################################################
+# Xml schema
+####################################################################################################
+
+
+class XmlAttribute:
+    '''
+    An xml attribute read from the attribute `name` and formatted with `format`.
+    The default formatter writes None as an empty string.
+    '''
+    __slots__ = ('name', 'format')
+
+    def __init__(self, name: str, format: Callable = convertstr):
+        self.name = name
+        self.format = format
+
+
+class XmlText:
+    '''
+    A scalar child element, eg. <pH>7.5</pH>.
+    None values are omitted unless omit_none is False, in which case an empty element is written.
+    If wrapper is given the element is nested in a wrapper element, eg. <casNumbers><casNumber>
+    '''
+    __slots__ = ('attr', 'tag', 'wrapper', 'omit_none', 'format')
+
+    def __init__(self, attr: str, *,
+                 tag: Optional[str] = None,
+                 wrapper: Optional[str] = None,
+                 omit_none: bool = True,
+                 format: Callable = format_text,
+                 ):
+        self.attr = attr
+        self.tag = attr if tag is None else tag
+        self.wrapper = wrapper
+        self.omit_none = omit_none
+        self.format = format
+
+    def compile(self) -> Callable:
+        attr, tag, wrapper, omit_none, fmt = self.attr, self.tag, self.wrapper, self.omit_none, self.format
+        SubElement = etree.SubElement
+
+        def write(obj, parent):
+            value = getattr(obj, attr)
+            if value is None:
+                if omit_none:
+                    return
+                text = ''
+            else:
+                text = fmt(value)
+            if wrapper is not None:
+                parent = SubElement(parent, wrapper)
+                parent.text = ''
+            SubElement(parent, tag).text = text
+        return write
+
+
+class XmlTextList:
+    '''
+    An iterable of scalars written as <tag><item_tag>..</item_tag>...</tag>, sorted by key.
+    '''
+    __slots__ = ('attr', 'tag', 'item_tag', 'key', 'format')
+
+    def __init__(self, attr: str, *, tag: str, item_tag: str,
+                 key: Optional[Callable] = str, format: Callable = str):
+        self.attr = attr
+        self.tag = tag
+        self.item_tag = item_tag
+        self.key = key
+        self.format = format
+
+    def compile(self) -> Callable:
+        attr, tag, item_tag, key, fmt = self.attr, self.tag, self.item_tag, self.key, self.format
+        SubElement = etree.SubElement
+
+        def write(obj, parent):
+            values = getattr(obj, attr)
+            if values is None:
+                return
+            if key is not None:
+                values = sorted(values, key=key)
+            element = SubElement(parent, tag)
+            element.text = ''
+            for value in values:
+                SubElement(element, item_tag).text = fmt(value)
+        return write
+
+
+class XmlChild:
+    '''
+    A nested xml object, omitted if None.
+    '''
+    __slots__ = ('attr',)
+
+    def __init__(self, attr: str):
+        self.attr = attr
+
+    def compile(self) -> Callable:
+        attr = self.attr
+
+        def write(obj, parent):
+            child = getattr(obj, attr)
+            if child is not None:
+                child.write_xml(parent)
+        return write
+
+
+class XmlChildren:
+    '''
+    An iterable of nested objects, optionally sorted by key and wrapped in a `tag` element.
+    If schema is given the items are written with that schema instead of their own layout.
+    '''
+    __slots__ = ('attr', 'tag', 'key', 'schema')
+
+    def __init__(self, attr: str, *,
+                 tag: Optional[str] = None,
+                 key: Optional[Callable] = None,
+                 schema: Optional[XmlSchema] = None,
+                 ):
+        self.attr = attr
+        self.tag = tag
+        self.key = key
+        self.schema = schema
+
+    def compile(self) -> Callable:
+        attr, tag, key = self.attr, self.tag, self.key
+        item_writer = None if self.schema is None else self.schema.compile()
+        SubElement = etree.SubElement
+
+        def write(obj, parent):
+            items = getattr(obj, attr)
+            if items is None:
+                return
+            if key is not None:
+                items = sorted(items, key=key)
+            if tag is not None:
+                parent = SubElement(parent, tag)
+                parent.text = ''
+            if item_writer is None:
+                for item in items:
+                    item.write_xml(parent)
+            else:
+                for item in items:
+                    item_writer(item, parent)
+        return write
+
+
+class XmlFragmentCache:
+    '''
+    A bounded LRU cache of rendered elements keyed by the content they were rendered from.
+    The cached elements are never attached to a tree, callers always receive a copy.
+    Because the key is the content itself a changed object simply misses the cache.
+    '''
+    __slots__ = ('maxsize', 'hits', 'misses', '_elements', '_lock')
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._elements = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[etree.Element]:
+        with self._lock:
+            element = self._elements.get(key)
+            if element is None:
+                self.misses += 1
+                return None
+            self._elements.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(element)
+
+    def put(self, key: Hashable, element: etree.Element):
+        element = copy.deepcopy(element)
+        with self._lock:
+            self._elements[key] = element
+            self._elements.move_to_end(key)
+            while len(self._elements) > self.maxsize:
+                self._elements.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._elements.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._elements)
+
+
+class XmlSchema:
+    '''
+    The xml layout of a class: element name, text, attributes and ordered children.
+    Attributes and children given as strings are shorthand for XmlAttribute and XmlText.
+
+    If cache_key is given the rendered elements are kept in an XmlFragmentCache keyed by
+    cache_key(obj), which must capture everything that is written.
+
+    A schema can also be used as a child of another schema, in which case it writes an element
+    whose attributes and children are read from the same object.
+    '''
+    __slots__ = ('name', 'text', 'attributes', 'children', 'cache_key', 'cache', '_writer')
+
+    def __init__(self, name: str, *, text: str = '', attributes=(), children=(),
+                 cache_key: Optional[Callable] = None):
+        self.name = name
+        self.text = text
+        self.attributes = tuple(
+            XmlAttribute(x) if isinstance(x, str) else x for x in attributes)
+        self.children = tuple(
+            XmlText(x) if isinstance(x, str) else x for x in children)
+        self.cache_key = cache_key
+        self.cache = None if cache_key is None else XmlFragmentCache()
+        self._writer = None
+
+    def get_attributes(self, obj) -> Dict[str, str]:
+        return {x.name: x.format(getattr(obj, x.name)) for x in self.attributes}
+
+    def compile(self) -> Callable:
+        '''
+        Returns a function writer(obj, parent=None) -> etree.Element.
+        The element is appended to parent if given, otherwise a new root element is returned.
+        '''
+        if self._writer is not None:
+            return self._writer
+        name, text = self.name, self.text
+        attributes = tuple((x.name, x.format) for x in self.attributes)
+        children = tuple(x.compile() for x in self.children)
+
+        def write(obj, parent=None):
+            element = _new_element(
+                parent, name, {attr: fmt(getattr(obj, attr)) for attr, fmt in attributes})
+            element.text = text
+            for child in children:
+                child(obj, element)
+            return element
+
+        if self.cache_key is not None:
+            render, cache_key, cache = write, self.cache_key, self.cache
+
+            def write(obj, parent=None):
+                key = cache_key(obj)
+                element = cache.get(key)
+                if element is None:
+                    element = render(obj)
+                    cache.put(key, element)
+                if parent is not None:
+                    parent.append(element)
+                return element
+
+        self._writer = write
+        return write
+
+
+####################################################################################################
+# Xml objects
+####################################################################################################
+
+
 class XmlMixin:
+    '''
+    Objects are turned into xml in one of two ways:
+        - Classes with a fixed layout declare an XmlSchema as _xml_schema, which is compiled once
+          when the class is created.
+        - Dynamic classes (eg. the list containers) override get_xml_name, get_xml_attributes,
+          get_xml_text and get_children.
+    '''
+    __slots__ = ()
+
+    _xml_schema: Optional[XmlSchema] = None
+    _xml_writer: Optional[Callable] = None
+    _xml_name = ''
+    _xml_text = ''
+    _attributes = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        schema = cls.__dict__.get('_xml_schema')
+        if schema is not None:
+            cls._xml_name = schema.name
+            cls._xml_text = schema.text
+            cls._xml_writer = staticmethod(schema.compile())
+
     def get_xml_attributes(self) -> Dict:
         '''
         Generate the attributes of the xml 
         '''
+        if self._xml_schema is not None:
+            return self._xml_schema.get_attributes(self)
         return {
             attr: convertstr(getattr(self, attr))
             for attr in self._attributes
         }
 
-    def get_children(self) -> Union[Iterable[XmlMixin], object]:
+    def get_children(self) -> Iterable[XmlMixin]:
         '''
-        Get a list of children
+        Get the children of a dynamic xml object
         '''
-        children = []
-        for attr in self._children:
-            child = getattr(self, attr)
-            if child is None:
-                continue
-            if isinstance(child, XmlMixin):
-                # This can include the iterable xmlelements
-                children.append(child)
-            # Exclude strings
-            elif isinstance(child, Iterable) and not isinstance(child, str):
-                # Also allow iterables to be pass as children
-                # All items in the iterable will be used as a child
-                for item in child:
-                    if not isinstance(item, XmlMixin):
-                        raise Exception(
-                            'Iterable must only contain XmlMixin objects')
-                    children.append(item)
-            else:
-                # As a default case cast the child to a str
-                if isinstance(child, float):
-                    string = f'{child:g}'
-                else:
-                    string = str(child)
-                children.append(self.string_child(attr, string))
-        return children
+        return ()
 
     def get_xml_text(self) -> str:
         '''
@@ -123,21 +406,21 @@ class XmlMixin:
         '''
         return self._xml_name
 
-    def get_xml_element(self) -> etree.Element:
-        self_element = etree.Element(
-            self.get_xml_name(),
-            attrib=self.get_xml_attributes())
-        self_element.text = self.get_xml_text()
-        children = self.get_children()
-        for child in children:
-            self_element.append(child.get_xml_element())
-
-        return self_element
+    def write_xml(self, parent: Optional[etree.Element] = None) -> etree.Element:
+        '''
+        Writes this object as a child of parent, or as a new root element if parent is None.
+        '''
+        if self._xml_writer is not None:
+            return self._xml_writer(self, parent)
+        element = _new_element(
+            parent, self.get_xml_name(), self.get_xml_attributes())
+        element.text = self.get_xml_text()
+        for child in self.get_children():
+            child.write_xml(element)
+        return element
 
-    def string_child(self, name, string) -> BaseXml:
-        return BaseXml(
-            name=name, text=string
-        )
+    def get_xml_element(self) -> etree.Element:
+        return self.write_xml()
 
     def __repr__(self):
         return self.print_self()
@@ -147,28 +430,35 @@ class XmlMixin:
         return f'{self._xml_name}:{self._xml_text}:{self.get_xml_attributes()}'
 
     def to_xml(self, as_string: bool = False):
-        root = self.get_xml_element()
-        xml = etree.ElementTree(root)
         if as_string:
-            etree.indent(xml, space='  ')
-            xml = etree.tostring(xml, xml_declaration=True,
-                                 pretty_print=True, encoding='utf-8').decode()
-        return xml
+            return self.to_xml_bytes().decode()
+        return etree.ElementTree(self.get_xml_element())
+
+    def to_xml_bytes(self) -> bytes:
+        '''
+        The indented document as UTF-8 bytes, the same as to_xml(as_string=True) without decoding
+        '''
+        xml = etree.ElementTree(self.get_xml_element())
+        etree.indent(xml, space='  ')
+        return etree.tostring(xml, xml_declaration=True, pretty_print=True, encoding='utf-8')
 
 
 class BaseXml(XmlMixin):
-    # __slots__ = ('_xml_text', '_xml_name', '_attributes', '_children')
+    '''
+    Base class for objects whose xml layout is declared by an XmlSchema.
+    '''
+    __slots__ = ()
 
-    def __init__(self, *,
-                 name: str = '',
-                 text: str = '',
-                 attributes: Dict[str, str] = [],
-                 children: List[str] = []
-                 ):
+
+class TextXml(BaseXml):
+    '''
+    A leaf element with a per-instance name and text, eg. <casNumber>7647-14-5</casNumber>
+    '''
+    __slots__ = ('_xml_name', '_xml_text')
+
+    def __init__(self, *, name: str, text: str = ''):
         self._xml_name = name
         self._xml_text = text
-        self._attributes = attributes
-        self._children = children
 
 
 class ListXml(list, XmlMixin):
@@ -176,11 +466,12 @@ class ListXml(list, XmlMixin):
     A class that can be used as a list but implements the functionality to turn its contents into
     an xml file
     '''
+    __slots__ = ('xml_constructor_fn', '_xml_name', '_xml_text', '_attributes')
 
     def __init__(self, *args,
                  name: Optional[str] = '',
                  text: Optional[str] = '',
-                 attributes: Optional[List[str]] = [],
+                 attributes: Optional[List[str]] = (),
                  xml_constructor_fn: Optional[Callable] = None
                  ):
         list.__init__(self, *args)
@@ -200,11 +491,12 @@ class SetXml(set, XmlMixin):
     A class that can be used as a set but implements the functionality to turn its contents into
     an xml file
     '''
+    __slots__ = ('xml_constructor_fn', '_xml_name', '_xml_text', '_attributes')
 
     def __init__(self, *args,
                  name: Optional[str] = '',
                  text: Optional[str] = '',
-                 attributes: Optional[List[str]] = [],
+                 attributes: Optional[List[str]] = (),
                  xml_constructor_fn: Optional[Callable] = None
                  ):
         set.__init__(self, *args)
@@ -224,11 +516,12 @@ class IndexedListXml(IndexedList, XmlMixin):
     A class that can be used as a set but implements the functionality to turn its contents into
     an xml file
     '''
+    __slots__ = ('xml_constructor_fn', '_xml_name', '_xml_text', '_attributes')
 
     def __init__(self, *args,
                  name: Optional[str] = '',
                  text: Optional[str] = '',
-                 attributes: Optional[List[str]] = [],
+                 attributes: Optional[List[str]] = (),
                  xml_constructor_fn: Optional[Callable] = None,
                  key=lambda x: x
                  ):
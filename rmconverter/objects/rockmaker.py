@@ -1,11 +1,16 @@
 from __future__ import annotations
-from typing import Optional, Set, Iterable
-import numpy as np
+from typing import Optional, Set, Iterable, Tuple
+from operator import methodcaller
+import math
 import warnings
 from lxml import etree
 
 from .. import utils
-from .base import BaseXml, ListXml, SetXml, IndexedListXml, PhMixin
+from ..plate import PlateGeometry, geometry_for_well_count
+from .base import (
+    BaseXml, ListXml, IndexedListXml, PhMixin,
+    XmlSchema, XmlText, XmlTextList, XmlChild, XmlChildren,
+)
 from ..config import constants
 
 ####################################################################################################
@@ -14,10 +19,12 @@ from ..config import constants
 
 
 class RecipeVolumeMixin:
-    def add_recipe_volume(self, volume, *, require_exact_ph):
+    __slots__ = ()
+
+    def add_recipe_volume(self, volume, *, require_exact_ph, geometry=None):
         for child in self:
             child.add_recipe_volume(
-                volume, require_exact_ph=require_exact_ph)
+                volume, require_exact_ph=require_exact_ph, geometry=geometry)
 
 
 ####################################################################################################
@@ -25,16 +32,22 @@ class RecipeVolumeMixin:
 ####################################################################################################
 
 class Condition(ListXml, RecipeVolumeMixin):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name='condition')
 
 
 class Conditions(ListXml, RecipeVolumeMixin):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name='conditions')
 
 
 class Ingredients(IndexedListXml):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name='ingredients', key=lambda x: x.ingredient_name)
 
@@ -47,6 +60,8 @@ class Ingredients(IndexedListXml):
 
 
 class TitrationTable(ListXml):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super().__init__(name='titrationTable', *args, **kwargs)
 
@@ -56,21 +71,23 @@ class TitrationTable(ListXml):
 
 
 class TitrationPoint(BaseXml, PhMixin):
-    # __slots__ = ['ph', 'a2b_ratio']
+    __slots__ = ('ph', 'acidToBaseRatio')
+
+    _xml_schema = XmlSchema('titrationPoint', children=('pH', 'acidToBaseRatio'))
 
     def __init__(self, ph: float, a2b_ratio: float):
-        super().__init__(name='titrationPoint',
-                         children=['pH', 'acidToBaseRatio'])
         self.ph = ph
         self.acidToBaseRatio = a2b_ratio
 
 
 class BufferData(BaseXml):
-    # __slots__ = ['pka', 'titration_table']
+    __slots__ = ('pka', 'titration_table')
+
+    # Buffers and their titration tables are shared by most screens so are rendered once
+    _xml_schema = XmlSchema('bufferData', children=('pKa', XmlChild('titration_table')),
+                            cache_key=methodcaller('content_key'))
 
     def __init__(self, pka: float = None, titration_table: TitrationTable = None):
-        super().__init__(name='bufferData',
-                         children=['pKa', 'titration_table'])
         assert pka is not None or titration_table is not None
         self.pka = pka
         self.titration_table = titration_table
@@ -79,11 +96,21 @@ class BufferData(BaseXml):
     def pKa(self):
         return self.pka
 
+    def content_key(self) -> Tuple:
+        points = None
+        if self.titration_table is not None:
+            points = tuple((x.ph, x.acidToBaseRatio) for x in self.titration_table)
+        return (self.pka, points)
+
 
 class ConditionIngredient(BaseXml, PhMixin):
-    # __slots__ = [
-    # 'conc','type','ph','stock','high_ph_stock','well_id','volume','high_ph_volume',
-    # ]
+    __slots__ = (
+        'concentration', 'type', 'ph', 'ingredient', 'stock', 'high_ph_stock', 'well_id',
+        'volume', 'high_ph_volume',
+    )
+
+    _xml_schema = XmlSchema('conditionIngredient', children=(
+        'concentration', 'pH', 'type', 'stockLocalID', 'highPHStockLocalID'))
 
     def __init__(self,
                  conc: float,
@@ -94,9 +121,7 @@ class ConditionIngredient(BaseXml, PhMixin):
                  high_ph_stock: Optional[Stock] = None,
                  well_id: Optional[int] = None,
                  ):
-        super().__init__(name='conditionIngredient', children=[
-            'concentration', 'pH', 'type', 'stockLocalID', 'highPHStockLocalID'])
-
+        # well_id is the 1-based id of the well on the plate
         self.concentration = conc
         self.type = cond_type
         self.ph = ph
@@ -104,6 +129,8 @@ class ConditionIngredient(BaseXml, PhMixin):
         self.stock = stock
         self.high_ph_stock = high_ph_stock
         self.well_id = well_id
+        self.volume = None
+        self.high_ph_volume = None
 
         # Add the type of this condition ingredient to the ingredients
         self.ingredient.add_type(self.type)
@@ -126,16 +153,16 @@ class ConditionIngredient(BaseXml, PhMixin):
                 f'None localID for ConditionIngredient {self.ingredient.ingredient_name}')
         return None
 
-    def check_exact_ph(self, raise_error: bool = False):
+    def check_exact_ph(self, raise_error: bool = False, geometry: Optional[PlateGeometry] = None):
         if self.ph != self.stock.ph:
             mesg = f"desired pH ({self.ph}) does not match stock pH ({self.stock.ph}) in well \
-                {utils.wellid2name(self.well_id + 1)}"
+                {utils.wellid2name(self.well_id, geometry)}"
             if raise_error:
                 raise Exception(mesg)
             else:
                 warnings.warn(mesg)
 
-    def add_recipe_volume(self, well_volume, *, require_exact_ph):
+    def add_recipe_volume(self, well_volume, *, require_exact_ph, geometry=None):
         total_volume = (well_volume * self.concentration) / \
             self.stock.stockConcentration
         self.volume = None
@@ -163,9 +190,9 @@ class ConditionIngredient(BaseXml, PhMixin):
 
                 elif self.ingredient.buffer_data.titration_table is not None:
                     a2b_ratio = None
-                    min_dist = np.inf
+                    min_dist = math.inf
                     for point in self.ingredient.buffer_data.titration_table:
-                        dist = np.abs(point.ph - self.ph)
+                        dist = abs(point.ph - self.ph)
                         if dist < min_dist:
                             min_dist = dist
                             a2b_ratio = point.acidToBaseRatio
@@ -176,7 +203,7 @@ class ConditionIngredient(BaseXml, PhMixin):
                 else:
                     raise no_buffer_data
             else:
-                self.check_exact_ph(require_exact_ph)
+                self.check_exact_ph(require_exact_ph, geometry)
                 self.volume = total_volume
         else:
             # Easy case
@@ -194,11 +221,19 @@ class ConditionIngredient(BaseXml, PhMixin):
         if self.high_ph_stock is not None:
             if self.high_ph_volume is None:
                 raise Exception(
-                    f'High pH volume is None for {self.ingredient.ingredient_name} in well {utils.wellid2name(self.well_id + 1)}, {self.stock.ph}, {self.high_ph_stock.ph}')
+                    f'High pH volume is None for {self.ingredient.ingredient_name} in well {utils.wellid2name(self.well_id, geometry)}, {self.stock.ph}, {self.high_ph_stock.ph}')
 
 
 class Stock(BaseXml, PhMixin):
-    # __slots__ = ['local_id','conc','units','ph','buffer','part_number', 'usages']
+    __slots__ = (
+        'localID', 'stockConcentration', 'defaultLowConcentration', 'defaultHighConcentration',
+        'units', 'ph', 'buffer', 'vendorPartNumber', 'vendorName', 'comments', 'usages',
+    )
+
+    _xml_schema = XmlSchema('stock', children=(
+        'localID', 'stockConcentration', 'defaultLowConcentration', 'defaultHighConcentration',
+        'units', 'pH', 'useAsBuffer', 'vendorPartNumber', 'vendorName', 'comments'))
+
     def __init__(self,
                  local_id: Optional[int],
                  conc: float,
@@ -209,8 +244,6 @@ class Stock(BaseXml, PhMixin):
                  vendor: Optional[str],
                  comments: Optional[str],
                  ):
-        super().__init__(name='stock', children=[
-            'localID', 'stockConcentration', 'defaultLowConcentration', 'defaultHighConcentration', 'units', 'pH', 'useAsBuffer', 'vendorPartNumber', 'vendorName', 'comments'])
         self.localID = local_id
         self.stockConcentration = conc
         self.defaultLowConcentration = 0
@@ -223,7 +256,7 @@ class Stock(BaseXml, PhMixin):
         self.comments = comments
 
         # Used to track total volume in screen
-        # {well_number: volume}
+        # {well_id: volume}
         self.usages = dict()
 
     @property
@@ -242,8 +275,29 @@ class Stock(BaseXml, PhMixin):
     def get_total_volume(self):
         return sum([self.usages[x] for x in self.usages])
 
+    def content_key(self) -> Tuple:
+        return (
+            self.localID, self.stockConcentration, self.defaultLowConcentration,
+            self.defaultHighConcentration, self.units, self.ph, self.buffer,
+            self.vendorPartNumber, self.vendorName, self.comments,
+        )
+
 
 class Ingredient(BaseXml):
+    __slots__ = (
+        'ingredient_name', 'buffer_data', 'cas_number', 'shortname', 'name_substitution',
+        'aliases', 'stocks', 'types',
+    )
+
+    _xml_schema = XmlSchema('ingredient', children=(
+        XmlChildren('stocks', tag='stocks', key=lambda x: x.localID),
+        XmlTextList('types', tag='types', item_tag='type'),
+        XmlChild('buffer_data_xml'),
+        XmlText('cas_number', tag='casNumber', wrapper='casNumbers', format=str),
+        'name',
+        'shortName',
+    ), cache_key=methodcaller('content_key'))
+
     def __init__(self,
                  name: str,
                  cas_number: Optional[str] = None,
@@ -253,8 +307,6 @@ class Ingredient(BaseXml):
                  types: Iterable[str] = [],
                  aliases: Iterable[str] = [],
                  ):
-        super().__init__(name='ingredient', children=[
-            'stocks_xml', 'types_xml', 'buffer_data_xml', 'cas_numbers', 'name', 'shortName'])
         self.ingredient_name = name
         self.buffer_data = buffer_data
         self.cas_number = cas_number
@@ -264,42 +316,35 @@ class Ingredient(BaseXml):
         self.stocks = set()
         self.types = set(types)
 
-    @property
-    def stocks_xml(self):
-        stocks = sorted(self.stocks, key=lambda x: x.localID)
-        return ListXml(stocks, name='stocks')
-
     @property
     def buffer_data_xml(self):
         return self.buffer_data if constants.BUFFER in self.types else None
 
-    # TODO Can make cas numbers track multiple
-    @property
-    def cas_numbers(self):
-        if self.cas_number is not None:
-            cas_numbers = SetXml(name='casNumbers')
-            cas_numbers.add(
-                BaseXml(text=str(self.cas_number), name='casNumber'))
-            return cas_numbers
-        return None
-
     @property
     def shortName(self):
+        # Ingredients read from RockMaker xml have no short name, it is left out
+        if self.shortname is None:
+            return None
         return utils.prefix_str(constants.LAB_NAME, self.shortname, self.name_substitution)
 
     @property
     def name(self):
         return utils.suffix_str(self.ingredient_name, f' {constants.LAB_NAME}', self.name_substitution)
 
-    @property
-    def aliases_xml(self):
-        sorted_aliases = sorted([str(x) for x in self.aliases])
-        return SetXml([BaseXml(name='alias', text=x) for x in sorted_aliases], name='aliases')
-
-    @property
-    def types_xml(self):
-        sorted_types = sorted([str(x) for x in self.types])
-        return SetXml([BaseXml(name='type', text=str(x)) for x in sorted_types], name='types')
+    def content_key(self) -> Tuple:
+        '''
+        Everything that is written to xml, so a change to the stocks or types changes the key
+        '''
+        buffer_data = self.buffer_data_xml
+        return (
+            self.ingredient_name,
+            self.shortname,
+            self.name_substitution,
+            self.cas_number,
+            tuple(sorted(str(x) for x in self.types)),
+            None if buffer_data is None else buffer_data.content_key(),
+            tuple(x.content_key() for x in sorted(self.stocks, key=lambda x: x.localID)),
+        )
 
     def add_stock(self, stock: Stock):
         self.stocks.add(stock)
@@ -312,24 +357,70 @@ class Ingredient(BaseXml):
 
 
 class Screen(BaseXml):
-    # __slots__ = ['name', 'ingredients','conditions', 'volume']
+    __slots__ = ('name', 'ingredients', 'conditions', 'volume', 'geometry', 'alternatives')
+
+    _xml_schema = XmlSchema('screen', children=(
+        XmlChild('conditions'), XmlChild('ingredients')))
 
     def __init__(
             self,
             name: str,
             ingredients: Optional[Ingredients] = None,
-            conditions: Optional[Conditions] = None
+            conditions: Optional[Conditions] = None,
+            geometry: Optional[PlateGeometry] = None,
     ):
-        super().__init__(name='screen', children=['conditions', 'ingredients'])
         self.ingredients = Ingredients() if ingredients is None else ingredients
         self.conditions = Conditions() if conditions is None else conditions
         self.name = name
         self.volume = None
+        # Condition i is in well i + 1 of this plate
+        self.geometry = geometry
+        # well id -> the k best [(stocks, dispenses)] of the solver, best first, see design2screen
+        self.alternatives = {}
+
+    @property
+    def plate_geometry(self) -> PlateGeometry:
+        '''
+        The plate layout of the screen. RockMaker xml doesn't record one so if none was given
+        the smallest standard plate that holds all the conditions is used.
+        '''
+        if self.geometry is not None:
+            return self.geometry
+        return geometry_for_well_count(len(self.conditions))
+
+    def alternative_stocks(self, well_id: int, exclude=()):
+        '''
+        The best alternative [(low stock, high stock)] of a well that uses none of the stock ids
+        in exclude, or None if there is none.
+        '''
+        exclude = set(exclude)
+        for stocks, _ in self.alternatives.get(well_id, ()):
+            if not any(x.id in exclude for pair in stocks for x in pair if x is not None):
+                return stocks
+        return None
+
+    def alternatives_json(self) -> dict:
+        '''
+        The alternatives as {well name: [{'stocks': [[low stock id, high stock id or None]],
+        'dispenses': [sorted fractions of the well volume]}]}, best first, as written by
+        create_rxml --alternatives-json
+        '''
+        geometry = self.plate_geometry
+        return {
+            geometry.name(well_id): [
+                {
+                    'stocks': [[None if x is None else x.id for x in pair] for pair in stocks],
+                    'dispenses': list(dispenses),
+                }
+                for stocks, dispenses in ranked
+            ]
+            for well_id, ranked in sorted(self.alternatives.items())
+        }
 
     def add_recipe_volume(self, volume, *, require_exact_ph):
         self.volume = volume
         self.conditions.add_recipe_volume(
-            volume, require_exact_ph=require_exact_ph)
+            volume, require_exact_ph=require_exact_ph, geometry=self.plate_geometry)
 
     def get_stocks(self) -> Set[Stock]:
         global_stocks = set()
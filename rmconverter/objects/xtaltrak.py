@@ -1,16 +1,19 @@
 from __future__ import annotations
-from typing import Optional, List, Set
+from typing import Optional, List, Set, Dict, Iterable, Iterator
 from lxml import etree
+from array import array
+import csv
 import warnings
 from collections import defaultdict
 
 from ..config.constants import SHRTNAME_LEN, WATER, BUFFER, PRECIPITANT
-from ..utils import get_shortname_from_lid_name, wellid2name, _is_tacsimate
-from .base import BaseXml, ListXml, XmlMixin, VolumeUnitsMixin
+from ..utils import get_shortname_from_lid_name, _is_tacsimate
+from ..plate import PlateGeometry, DEFAULT_GEOMETRY, PLATE_96
+from .base import BaseXml, XmlMixin, VolumeUnitsMixin, XmlSchema, XmlChild, XmlChildren
 
 
 class DesignItem:
-    # __slots__ = ("chemical", "item_class", "concentration", "units", "ph")
+    __slots__ = ("chemical", "_item_class", "concentration", "units", "ph", "one_ph", "one_stock")
 
     def __init__(
         self,
@@ -53,19 +56,24 @@ class DesignItem:
 
 
 class DesignWell:
-    # __slots__ = ("items")
+    __slots__ = ("items",)
 
     def __init__(self, items: List[DesignItem]):
         self.items = items
 
 
+# The CrystalTrak version written in design xml
+DESIGN_XML_VERSION = '2.3.43'
+
+
 class Design:
-    # __slots__ = ("wells")
+    __slots__ = ("wells", "name", "geometry")
 
-    def __init__(self, name):
-        # Dict that maps a well id [1,96] to a DesignWell
+    def __init__(self, name, geometry: Optional[PlateGeometry] = None):
+        # Dict that maps a well id [1, geometry.size] to a DesignWell
         self.wells = dict()
         self.name = name
+        self.geometry = DEFAULT_GEOMETRY if geometry is None else geometry
 
     def add_well(self, well: DesignWell, well_id: int):
         self.wells[well_id] = well
@@ -84,10 +92,51 @@ class Design:
             for di in dw.items:
                 di.one_ph = di.chemical.id in single_chem_ids
 
+    def write_xml_file(self, f, comments: Optional[str] = None):
+        '''
+        Writes the CrystalTrak design xml (as read by DesignFactory) to a path or binary stream,
+        a well at a time
+        '''
+        geometry = self.geometry
+        with etree.xmlfile(f, encoding='utf-8') as xf:
+            with xf.element('crystaltrak', datatype='design', version=DESIGN_XML_VERSION):
+                xf.write('\n  ')
+                with xf.element('reservoir_design', name=self.name):
+                    xf.write('\n    ')
+                    xf.write(etree.Element('format', {
+                        'name': f'Generic {geometry.size} Well',
+                        'rows': str(geometry.rows),
+                        'cols': str(geometry.cols),
+                    }))
+                    if comments is not None:
+                        xf.write('\n    ')
+                        comments_xml = etree.Element('comments')
+                        comments_xml.text = comments
+                        xf.write(comments_xml)
+                    for well_id in sorted(self.wells):
+                        well_xml = etree.Element('well', {
+                            'number': str(well_id), 'label': geometry.name(well_id)})
+                        well_xml.text = '\n      '
+                        item_xml = None
+                        for di in self.wells[well_id].items:
+                            item_xml = etree.SubElement(well_xml, 'item', {
+                                'name': di.chemical.name,
+                                'class': di.item_class,
+                                'conc': str(di.concentration),
+                                'units': di.units,
+                                'ph': '' if di.ph is None else str(di.ph),
+                            })
+                            item_xml.tail = '\n      '
+                        if item_xml is not None:
+                            item_xml.tail = '\n    '
+                        xf.write('\n    ')
+                        xf.write(well_xml)
+                    xf.write('\n  ')
+                xf.write('\n')
+
 
 class Chemical:
-    # __slots__ = ("id", "name", "cas", "pka", "aliases",
-    #              "shortname")
+    __slots__ = ("id", "name", "cas", "pkas", "aliases", "shortname")
 
     def __init__(self,
                  chem_id: Optional[int],
@@ -121,7 +170,7 @@ class Chemical:
 
 
 class PhPoint:
-    # __slots__ = ("base_fraction", "acid_fraction", "ph")
+    __slots__ = ("base_fraction", "acid_fraction", "ph")
 
     def __init__(self, base_fraction: float, ph: float):
         self.base_fraction = base_fraction
@@ -133,8 +182,7 @@ class PhPoint:
 
 
 class PhCurve:
-    # __slots__ = ("chem_id", "low_chem_id", "high_chem_id",
-    #              "low_ph", "high_ph", "points")
+    __slots__ = ("chem", "low_chem", "high_chem", "low_ph", "high_ph", "points")
 
     def __init__(
         self,
@@ -176,9 +224,13 @@ class PhCurve:
 
 
 class Stock(VolumeUnitsMixin):
-    # __slots__ = ("id", "stock_name", "chem_id", "conc",
-    #              "cunits", "ph", "local_id", "short_name",
-    #              'wells', 'show_wells')
+    '''
+    The stocks held by a StocksFactory are frozen and shared between conversions.
+    A conversion that records wells for a stock works on its own copy(), see add_well.
+    '''
+    __slots__ = ("id", "stock_name", "chem", "density", "viscosity", "volatility",
+                 "conc", "units", "ph", "local_id", "short_name", "barcode", "comments",
+                 "wells", "available", "rack", "_frozen")
 
     def __init__(
         self, *,
@@ -195,7 +247,9 @@ class Stock(VolumeUnitsMixin):
         density: Optional[float] = None,
         comments: Optional[str] = None,
         available: bool = True,
+        rack: Optional[str] = None,
     ):
+        self._frozen = False
         self.id = stock_id
         self.stock_name = stock_name
         self.chem = chem
@@ -211,10 +265,41 @@ class Stock(VolumeUnitsMixin):
         self.comments = comments
         self.wells = []
         self.available = available
+        self.rack = rack
 
         if isinstance(self.chem, int):
             raise Exception('should be chem')
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError(f'Stock {self.id} is frozen, set {name} on a copy()')
+        object.__setattr__(self, name, value)
+
+    def freeze(self):
+        '''
+        Makes this stock read-only so it can be shared, eg. between threads
+        '''
+        self.wells = tuple(self.wells)
+        self._frozen = True
+
+    @property
+    def frozen(self) -> bool:
+        return self._frozen
+
+    def copy(self) -> Stock:
+        '''
+        A mutable copy with its own wells. The chemical and stock data are shared.
+        '''
+        stock = object.__new__(type(self))
+        for name in Stock.__slots__:
+            object.__setattr__(stock, name, getattr(self, name))
+        object.__setattr__(stock, 'wells', list(self.wells))
+        object.__setattr__(stock, '_frozen', False)
+        return stock
+
     def add_well(self, well: Well):
+        if self._frozen:
+            raise AttributeError(f'Stock {self.id} is frozen, add wells to a copy()')
         self.wells.append(well)
 
     @property
@@ -242,7 +327,12 @@ class Stock(VolumeUnitsMixin):
 
 
 class StockVolCount(Stock, XmlMixin):
-    # __slots__ = Stock.__slots__ + BaseXml.__slots__
+    __slots__ = ()
+
+    _xml_schema = XmlSchema('stock', attributes=(
+        'barcode', 'comments', 'conc', 'count', 'cunits',
+        'density', 'name', 'pH', 'viscosity', 'volatility', 'volume', 'vunits'))
+
     def __init__(self, original_stock: Stock):
         super().__init__(
             stock_id=original_stock.id,
@@ -258,15 +348,16 @@ class StockVolCount(Stock, XmlMixin):
             density=original_stock.density,
             comments=original_stock.comments,
         )
-        self._xml_name = 'stock'
-        self._xml_text = ''
-        self._attributes = ['barcode', 'comments', 'conc', 'count', 'cunits',
-                            'density', 'name', 'pH', 'viscosity', 'volatility', 'volume', 'vunits']
-        self._children = []
         self.wells = list(original_stock.wells)
 
 
 class StockWells(Stock, XmlMixin):
+    __slots__ = ()
+
+    _xml_schema = XmlSchema('stock', attributes=(
+        'barcode', 'comments', 'conc', 'cunits',
+        'density', 'name', 'pH', 'viscosity', 'volatility'), children=(XmlChildren('wells'),))
+
     def __init__(self, original_stock: Stock):
         super().__init__(
             stock_id=original_stock.id,
@@ -282,27 +373,26 @@ class StockWells(Stock, XmlMixin):
             density=original_stock.density,
             comments=original_stock.comments,
         )
-        self._xml_name = 'stock'
-        self._xml_text = ''
-        self._attributes = ['barcode', 'comments', 'conc', 'cunits',
-                            'density', 'name', 'pH', 'viscosity', 'volatility']
-        self._children = ['wells']
         self.wells = list(original_stock.wells)
 
 
 class Well(BaseXml, VolumeUnitsMixin):
-    # __slots__ = ('volume',)
+    __slots__ = ('name', 'volume')
+
+    _xml_schema = XmlSchema('well', attributes=('name', 'volume', 'vunits'))
+
     def __init__(self, name: str, volume: float):
-        super().__init__(name='well', attributes=['name', 'volume', 'vunits'])
         self.name = name
         self.volume = volume
 
 
 class Wells(BaseXml, VolumeUnitsMixin):
-    # __slots__ = ('volume','stocks')
+    __slots__ = ('volume', 'stocks')
+
+    _xml_schema = XmlSchema('wells', attributes=('volume', 'vunits'),
+                            children=(XmlChildren('stocks'),))
+
     def __init__(self, volume: float):
-        super().__init__(name='wells', attributes=[
-            'volume', 'vunits'], children=['stocks'])
         self.volume = volume
         self.stocks = []
 
@@ -311,55 +401,93 @@ class Wells(BaseXml, VolumeUnitsMixin):
 
 
 class Plate(BaseXml):
-    # __slots__ = ['wells']
+    __slots__ = ('wells',)
+
+    _xml_schema = XmlSchema('plate', children=(XmlChild('wells'),))
+
     def __init__(self, stocks: List[StockWells], volume: float):
-        super().__init__(name='plate', children=['wells'])
         self.wells = Wells(volume)
         for s in stocks:
             self.wells.stocks.append(s)
 
 
-class SourcePlate(BaseXml):
+# Worklist fields: name -> fn(source_plate, source_well_id, stock, dest_well_id, well)
+WORKLIST_FIELDS = {
+    'source_well': lambda sp, src_id, stock, dst_id, well: sp.source_geometry.name(src_id),
+    'source_well_id': lambda sp, src_id, stock, dst_id, well: src_id,
+    'stock': lambda sp, src_id, stock, dst_id, well: stock.stock_name,
+    'barcode': lambda sp, src_id, stock, dst_id, well: stock.barcode,
+    'dest_well': lambda sp, src_id, stock, dst_id, well: well.name,
+    'dest_well_id': lambda sp, src_id, stock, dst_id, well: dst_id,
+    'volume': lambda sp, src_id, stock, dst_id, well: well.volume,
+    'vunits': lambda sp, src_id, stock, dst_id, well: well.vunits,
+}
+DEFAULT_WORKLIST_COLUMNS = ('source_well', 'dest_well', 'volume')
+# source: by stock then destination well, destination: by destination well then stock
+WORKLIST_SORTS = ('source', 'destination')
+
+
+class SourcePlate(BaseXml, VolumeUnitsMixin):
     # TODO this is missing some attributes and not sure whether they are required: Test
     # barcode, name, plateid, tracking_id
-    # __slots__ = ('description', 'stocks','wells', 'name')
-
-    def __init__(self, name: str, description: str, volume: float):
-        super().__init__(name='sourceplate', attributes=['description'])
+    __slots__ = ('description', 'name', 'volume', 'stocks', 'geometry', 'source_geometry')
+
+    # The stocks are written directly with the StockVolCount and StockWells layouts
+    _xml_schema = XmlSchema('sourceplate', attributes=('description',), children=(
+        XmlChildren('stocks', tag='stocks', schema=StockVolCount._xml_schema),
+        XmlSchema('plate', children=(
+            XmlSchema('wells', attributes=('volume', 'vunits'), children=(
+                XmlChildren('stocks', schema=StockWells._xml_schema),)),
+        )),
+    ))
+
+    def __init__(self, name: str, description: str, volume: float,
+                 geometry: Optional[PlateGeometry] = None,
+                 source_geometry: Optional[PlateGeometry] = None):
+        '''
+        geometry: The destination (screen) plate
+        source_geometry: The plate or rack holding the stocks, in the order of self.stocks.
+            Only used for worklists.
+        '''
         self.description = description
         self.name = name
         self.volume = volume
         self.stocks = []
-
-    def get_children(self) -> List[XmlMixin]:
-        children = []
-        children.append(ListXml(
-            [StockVolCount(x) for x in self.stocks],
-            name='stocks'
-        ))
-        children.append(
-            Plate(stocks=[StockWells(x)
-                  for x in self.stocks], volume=self.volume)
-        )
-        return children
+        self.geometry = DEFAULT_GEOMETRY if geometry is None else geometry
+        self.source_geometry = PLATE_96 if source_geometry is None else source_geometry
 
     def get_xml_element(self) -> etree.Element:
         # Automatically wrap this class in the parents
         self_element = etree.Element(
             'job',
             attrib={'name': self.name})
-        sourceplates_elem = etree.Element(
-            'sourceplates'
+        sourceplates_elem = etree.SubElement(
+            self_element, 'sourceplates'
         )
-        sp_elem = super().get_xml_element()
-        sourceplates_elem.append(sp_elem)
-        self_element.append(sourceplates_elem)
+        self.write_xml(sourceplates_elem)
         return self_element
 
-    def get_stocks_for_well(self, well_id: int) -> List[Stock]:
-        well_name = wellid2name(well_id)
+    def get_stocks_for_well(self, well_id: int,
+                            geometry: Optional[PlateGeometry] = None) -> List[Stock]:
+        well_name = (self.geometry if geometry is None else geometry).name(well_id)
         return [x for x in self.stocks if well_name in [y.name for y in x.wells]]
 
+    def get_stocks_by_well(self, geometry: Optional[PlateGeometry] = None) -> Dict[int, List[Stock]]:
+        '''
+        Maps each well id to its stocks in a single pass over the stocks.
+        The stocks for a well are in the same order as get_stocks_for_well.
+        '''
+        geometry = self.geometry if geometry is None else geometry
+        stocks_by_well = defaultdict(list)
+        for stock in self.stocks:
+            seen = set()
+            for well in stock.wells:
+                well_id = geometry.id(well.name)
+                if well_id not in seen:
+                    seen.add(well_id)
+                    stocks_by_well[well_id].append(stock)
+        return stocks_by_well
+
     def add_water(self):
         well_volume_map = {}
         # TODO What to do if a well has no stocks? No water will be added
@@ -397,3 +525,70 @@ class SourcePlate(BaseXml):
             comments=WATER.comment,
         )
         return water_stock
+
+    def iter_worklist(self, columns: Iterable[str] = DEFAULT_WORKLIST_COLUMNS,
+                      sort: str = 'source') -> Iterator[tuple]:
+        '''
+        One row per dispense with the given WORKLIST_FIELDS.
+        Stock i is in source well i + 1 of source_geometry.
+        'source' rows are made a stock at a time. 'destination' rows need the whole plate, so
+        the dispenses are counting sorted by destination well id over compact index arrays.
+        '''
+        if sort not in WORKLIST_SORTS:
+            raise ValueError(f'Unknown worklist sort "{sort}", expected one of {WORKLIST_SORTS}')
+        try:
+            getters = [WORKLIST_FIELDS[x] for x in columns]
+        except KeyError as e:
+            raise ValueError(f'Unknown worklist column {e}, expected one of {list(WORKLIST_FIELDS)}') from e
+        if len(self.stocks) > self.source_geometry.size:
+            raise ValueError(f'{len(self.stocks)} stocks do not fit in a {self.source_geometry}')
+
+        geometry_id = self.geometry.id
+
+        if sort == 'source':
+            for source_id, stock in enumerate(self.stocks, start=1):
+                # Stable, so a well dispensed twice keeps its order
+                for dest_id, well in sorted(((geometry_id(x.name), x) for x in stock.wells),
+                                            key=lambda x: x[0]):
+                    yield tuple(fn(self, source_id, stock, dest_id, well) for fn in getters)
+            return
+
+        # The stock index, position in stock.wells and destination well id of each dispense
+        stock_idxs, well_idxs, dest_ids = array('i'), array('i'), array('i')
+        for stock_idx, stock in enumerate(self.stocks):
+            for well_idx, well in enumerate(stock.wells):
+                stock_idxs.append(stock_idx)
+                well_idxs.append(well_idx)
+                dest_ids.append(geometry_id(well.name))
+        indptr = array('i', bytes(4 * (self.geometry.size + 2)))
+        for dest_id in dest_ids:
+            indptr[dest_id + 1] += 1
+        for i in range(1, len(indptr)):
+            indptr[i] += indptr[i - 1]
+        # In source order within a destination well, as the dispenses are
+        order = array('i', bytes(4 * len(dest_ids)))
+        fill = indptr[:-1]
+        for i, dest_id in enumerate(dest_ids):
+            order[fill[dest_id]] = i
+            fill[dest_id] += 1
+        for i in order:
+            stock = self.stocks[stock_idxs[i]]
+            yield tuple(fn(self, stock_idxs[i] + 1, stock, dest_ids[i], stock.wells[well_idxs[i]])
+                        for fn in getters)
+
+    def write_worklist(self, f, columns: Iterable[str] = DEFAULT_WORKLIST_COLUMNS,
+                       sort: str = 'source', delimiter: str = ',', header: bool = True,
+                       headers: Optional[Iterable[str]] = None) -> int:
+        '''
+        Writes a CSV (or TSV with delimiter='\\t') worklist to a text stream, a row at a time.
+        headers renames the columns. Returns the number of dispenses.
+        '''
+        columns = tuple(columns)
+        writer = csv.writer(f, delimiter=delimiter, lineterminator='\n')
+        if header:
+            writer.writerow(columns if headers is None else tuple(headers))
+        count = 0
+        for row in self.iter_worklist(columns, sort=sort):
+            writer.writerow(row)
+            count += 1
+        return count
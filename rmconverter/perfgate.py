@@ -0,0 +1,612 @@
+from __future__ import annotations
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import argparse
+import hashlib
+import json
+import platform
+import statistics
+import sys
+import time
+
+from .canonical import canonical_form, well_hash
+from .importtime import measure_import
+
+# A performance regression gate over a committed corpus (perf/corpus.json):
+#   - CrystalTrak designs, with and without a recipe, converted to RockMaker xml (the recipe
+#     solver, the factories and the design reader).
+#   - round trips of a design to RockMaker xml, back to a design through the chemical name index,
+#     and to a CrystalTrak recipe with the catalogue stocks.
+#   - RockMaker xml screens converted to CrystalTrak recipes, including large screens generated
+#     from the examples (see generate_rxml) so that the per-well costs show.
+# The design entries use the committed reference data fixture (perf/data, made from the full
+# reference data with --write-data), and their goldens are kept with a hash of the data they
+# were recorded with.
+# Every entry's outputs must match its golden outputs (perf/golden.json) byte for byte, and an
+# entry without golden outputs or data fails. The goldens also keep a hash of the canonical
+# form (see canonical.py) of each well, so a failure names the wells whose chemistry changed. The
+# stages of each conversion are timed over several runs and their median compared with the
+# stored baseline (perf/baseline.json), allowing for a relative tolerance plus a multiple of the
+# baseline's median absolute deviation. The traced peak memory of each stage is compared the same
+# way, and the cold import of the CLI modules has its own budget.
+# Baselines depend on the machine, they are recorded with --record-baseline and only compared
+# on the same platform and Python. A fixed pure Python workload (calibrate) is timed between the
+# runs of each entry, and the entry's time baselines are scaled by how much slower it ran than
+# when the baseline was recorded, so a loaded machine doesn't fail the gate.
+
+PERF_DIR = Path(__file__).resolve().parent.parent / 'perf'
+DEFAULT_MANIFEST = PERF_DIR / 'corpus.json'
+MANIFEST_VERSION = 1
+
+# Scales for the concentrations of generated screens, exact in binary so the xml text is stable
+GENERATED_SCALES = (0.5, 0.625, 0.75, 0.875, 1.0)
+
+# MAD to standard deviation for normally distributed timings
+MAD_SCALE = 1.4826
+CALIBRATION_SIZE = 20000
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def data_hash(data_dir) -> Optional[str]:
+    '''
+    A hash of the contents of the reference data files, None without chemicals.json
+    '''
+    from .reference import DATA_FILES
+
+    data_dir = Path(data_dir)
+    if not (data_dir / 'chemicals.json').exists():
+        return None
+    hasher = hashlib.sha256()
+    for name in DATA_FILES:
+        path = data_dir / name
+        if path.exists():
+            hasher.update(f'{name}\n'.encode())
+            hasher.update(sha256(path.read_bytes()).encode())
+    return hasher.hexdigest()
+
+
+def environment() -> dict:
+    from lxml import etree
+    return {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'python': platform.python_version(),
+        'lxml': '.'.join(map(str, etree.LXML_VERSION)),
+    }
+
+
+def generate_rxml(source: Path, wells: int, seed: int) -> bytes:
+    '''
+    A RockMaker screen of wells conditions drawn from the conditions of source, with their
+    concentrations scaled down by one of GENERATED_SCALES so the conditions stay feasible but
+    are not all copies.
+    '''
+    import copy
+    import random
+    from lxml import etree
+
+    rng = random.Random(seed)
+    root = etree.parse(str(source)).getroot()
+    conditions = root.find('conditions')
+    originals = list(conditions)
+    for condition in originals:
+        conditions.remove(condition)
+    for _ in range(wells):
+        condition = copy.deepcopy(rng.choice(originals))
+        scale = rng.choice(GENERATED_SCALES)
+        for conc in condition.iter('concentration'):
+            conc.text = f'{float(conc.text) * scale:.10g}'
+        conditions.append(condition)
+    return etree.tostring(root, xml_declaration=True, encoding='utf-8')
+
+
+def calibrate() -> float:
+    '''
+    The time of a fixed pure Python workload: arithmetic, sorting and dict building
+    '''
+    start = time.perf_counter()
+    values = [(i * 2654435761) % 1000003 for i in range(CALIBRATION_SIZE)]
+    index = {}
+    for i, value in enumerate(sorted(values)):
+        index.setdefault(value % 1024, []).append(i)
+    ''.join(str(len(x)) for x in index.values())
+    return time.perf_counter() - start
+
+
+def write_data(data_dir, output_dir, designs=(), recipes=()):
+    '''
+    Writes the reference data that the designs and recipes use to output_dir: their chemicals,
+    the pH curves of those chemicals and the chemicals the curves are made from, every stock of
+    those chemicals and their aliases, groups and stock availability. The design entries of the
+    corpus give the same outputs with it as with the full data.
+    '''
+    from lxml import etree
+    from .create_rxml import FactoriesJSON
+    from .factories.xtaltrak import availability_json_path
+
+    data_dir, output_dir = Path(data_dir), Path(output_dir)
+    factory = FactoriesJSON(data_dir=str(data_dir))
+    chem_ids = set()
+    for path in designs:
+        design = factory.design.get_design_from_xml_object(etree.parse(str(path)).getroot())
+        chem_ids.update(di.chemical.id for dw in design.wells.values() for di in dw.items)
+    for path in recipes:
+        recipe = factory.recipe.get_recipe_from_xml_object(etree.parse(str(path)).getroot())
+        chem_ids.update(x.chem.id for x in recipe.stocks)
+    for curve in factory.phcurve.curves.values():
+        if curve.chem.id in chem_ids:
+            chem_ids.update((curve.low_chem.id, curve.high_chem.id))
+
+    def rows(name):
+        with open(data_dir / name) as f:
+            return json.load(f)
+
+    curves = [x for x in rows('ph_curves.json') if x['FK_CHEMICAL_ID'] in chem_ids]
+    curve_ids = set(x['PK_PH_CURVE_ID'] for x in curves)
+    stocks = [x for x in rows('stocks.json') if x['CHEMICAL_ID'] in chem_ids]
+    stock_ids = set(x['STOCK_ID'] for x in stocks)
+    with open(availability_json_path(data_dir)) as f:
+        availability = [x for x in json.load(f)
+                        if (x['STOCK_ID'] if isinstance(x, dict) else int(x)) in stock_ids]
+    subsets = {
+        'chemicals.json': [x for x in rows('chemicals.json') if x['CHEMICAL_ID'] in chem_ids],
+        'chemical_alias.json': [x for x in rows('chemical_alias.json') if x['CHEMICAL_ID'] in chem_ids],
+        'stocks.json': stocks,
+        'stock_availability.json': availability,
+        'ph_curves.json': curves,
+        'ph_points.json': [x for x in rows('ph_points.json') if x['FK_PH_CURVE_ID'] in curve_ids],
+        'chem_group_members.json': [x for x in rows('chem_group_members.json') if x['CHEMICAL_ID'] in chem_ids],
+    }
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for name, data in subsets.items():
+        write_json(output_dir / name, data)
+    return {name: len(data) for name, data in subsets.items()}
+
+
+class Context:
+    '''
+    What the entries of a run share: the repository root and the reference data, loaded once
+    '''
+
+    def __init__(self, root: Path, data_dir):
+        self.root = root
+        self.data_dir = Path(data_dir) if Path(data_dir).is_absolute() else root / data_dir
+        self.data_hash = data_hash(self.data_dir)
+        self._factory = None
+        self._inputs = {}
+
+    def factory(self):
+        if self._factory is None:
+            from .create_rxml import FactoriesJSON
+            self._factory = FactoriesJSON(data_dir=str(self.data_dir))
+        return self._factory
+
+    def input_bytes(self, entry: dict, key: str) -> bytes:
+        '''
+        The bytes of an input file of an entry, or of its generated screen
+        '''
+        cache_key = (entry['name'], key)
+        if cache_key not in self._inputs:
+            if key == 'rxml' and 'generate' in entry:
+                generate = entry['generate']
+                data = generate_rxml(self.root / generate['source'], generate['wells'], generate['seed'])
+            else:
+                data = (self.root / entry[key]).read_bytes()
+            self._inputs[cache_key] = data
+        return self._inputs[cache_key]
+
+
+def needs_data(entry: dict) -> bool:
+    return entry['kind'] in ('design', 'roundtrip')
+
+
+def recipe_xml_bytes(sp) -> bytes:
+    from lxml import etree
+
+    root = sp.get_xml_element()
+    etree.indent(root, space='   ')
+    return etree.tostring(root, xml_declaration=True, pretty_print=True, encoding='utf-8')
+
+
+def run_entry(entry: dict, context: Context, profiler) -> Tuple[Dict[str, bytes], Dict[str, object]]:
+    '''
+    Converts an entry once, timing its stages with the profiler, and returns its outputs and
+    the Screen, Design or SourcePlate of each output
+    '''
+    from .profiling import stage
+    from .utils import xml_root
+
+    if entry['kind'] == 'design':
+        from .create_rxml import design_to_screen
+        factory = context.factory()
+        with stage(profiler, 'parse'):
+            design_xo = xml_root(context.input_bytes(entry, 'design'))
+            recipe_xo = xml_root(context.input_bytes(entry, 'recipe')) if entry.get('recipe') else None
+        with stage(profiler, 'convert'):
+            screen = design_to_screen(factory=factory, design_xo=design_xo, recipe_xo=recipe_xo,
+                                      include_aliases=entry.get('include_aliases', False))
+        with stage(profiler, 'serialize'):
+            rxml = screen.to_xml_bytes()
+        return {'rxml': rxml}, {'rxml': screen}
+
+    if entry['kind'] == 'roundtrip':
+        import io
+        from .create_rxml import design_to_screen
+        from .factories import rockmaker
+        from .factories.convert import rmscreen2design, rmscreen2xtrecipe
+        factory = context.factory()
+        with stage(profiler, 'convert'):
+            rxml = design_to_screen(factory=factory, design_xo=xml_root(context.input_bytes(entry, 'design')),
+                                    ).to_xml_bytes()
+        with stage(profiler, 'parse'):
+            screen = rockmaker.screen_from_rxml_dom(xml_root(rxml), name=entry['name'])
+        with stage(profiler, 'design'):
+            design = rmscreen2design(screen, factory.chems, stocks_f=factory.stocks, phcurve_f=factory.phcurve)
+            f = io.BytesIO()
+            design.write_xml_file(f)
+        with stage(profiler, 'recipe'):
+            screen.add_recipe_volume(entry.get('volume', 1000),
+                                     require_exact_ph=entry.get('require_exact_ph', False))
+            sp = rmscreen2xtrecipe(screen, stocks_f=factory.stocks)
+            sp.add_water()
+            recipe = recipe_xml_bytes(sp)
+        return {'design': f.getvalue(), 'recipe': recipe}, {'design': design, 'recipe': sp}
+
+    if entry['kind'] == 'rxml':
+        from .factories import rockmaker
+        from .factories.convert import rmscreen2xtrecipe
+        with stage(profiler, 'parse'):
+            screen = rockmaker.screen_from_rxml_dom(xml_root(context.input_bytes(entry, 'rxml')),
+                                                    name=entry['name'])
+        with stage(profiler, 'volumes'):
+            screen.add_recipe_volume(entry.get('volume', 1000),
+                                     require_exact_ph=entry.get('require_exact_ph', False))
+        with stage(profiler, 'recipe'):
+            sp = rmscreen2xtrecipe(screen, stocks_f=None)
+            sp.add_water()
+        with stage(profiler, 'serialize'):
+            recipe = recipe_xml_bytes(sp)
+        return {'recipe': recipe}, {'recipe': sp}
+
+    raise ValueError(f"Unknown corpus entry kind {entry['kind']}")
+
+
+def measure_entry(entry: dict, context: Context, repeat: int) -> Tuple[Dict[str, bytes], dict, dict, list]:
+    '''
+    (outputs, {output: plate}, {stage: {'times': [...], 'memory': traced peak}}, calibration times)
+    of an entry.
+    A first run warms up imports and caches, the timed runs are not traced, and the memory comes
+    from one more run under tracemalloc.
+    '''
+    import tracemalloc
+    from .profiling import Profiler
+
+    outputs, plates = run_entry(entry, context, None)
+    times: Dict[str, List[float]] = {}
+    calibration = []
+    for _ in range(repeat):
+        calibration.append(calibrate())
+        profiler = Profiler()
+        result, _ = run_entry(entry, context, profiler)
+        if result != outputs:
+            raise RuntimeError(f"{entry['name']}: outputs differ between runs")
+        for name, stage in profiler.stages.items():
+            times.setdefault(name, []).append(stage['time'])
+
+    profiler = Profiler(trace_malloc=1)
+    tracemalloc.start()
+    try:
+        run_entry(entry, context, profiler)
+    finally:
+        tracemalloc.stop()
+
+    return outputs, plates, {
+        name: {'times': times[name], 'memory': profiler.stages[name]['peak_memory']}
+        for name in times
+    }, calibration
+
+
+def output_digest(data: bytes, plate) -> dict:
+    '''
+    The golden form of an output: its sha256 and size, and the hash of each canonical well
+    keyed by the well name
+    '''
+    geometry = getattr(plate, 'plate_geometry', None) or plate.geometry
+    wells = canonical_form(plate)
+    return {
+        'sha256': sha256(data),
+        'size': len(data),
+        'wells': {geometry.name(well_id): well_hash(wells[well_id])[:16] for well_id in sorted(wells)},
+    }
+
+
+def diff_digests(golden: dict, digests: dict) -> List[str]:
+    '''
+    What differs between the golden and current digests of an entry's outputs
+    '''
+    diffs = []
+    for key in sorted(golden.keys() | digests.keys()):
+        if key not in digests or key not in golden:
+            diffs.append(f"{key}: {'missing' if key not in digests else 'new'} output")
+            continue
+        old, new = golden[key], digests[key]
+        if old['sha256'] == new['sha256']:
+            continue
+        old_wells, new_wells = old.get('wells', {}), new['wells']
+        wells = [x for x in list(old_wells) + [x for x in new_wells if x not in old_wells]
+                 if old_wells.get(x) != new_wells.get(x)]
+        if wells:
+            shown = ', '.join(wells[:10]) + (f' and {len(wells) - 10} more' if len(wells) > 10 else '')
+            diffs.append(f'{key}: the chemistry of {len(wells)} wells differs ({shown})')
+        else:
+            diffs.append(f"{key}: the xml differs ({old['size']} -> {new['size']} bytes) with the same chemistry")
+    return diffs
+
+
+def write_outputs(output_dir, name: str, outputs: Dict[str, bytes], plates: Dict[str, object]):
+    '''
+    Writes the outputs of an entry and their canonical forms (well name -> components)
+    '''
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for key, data in outputs.items():
+        (output_dir / f'{name}.{key}.xml').write_bytes(data)
+        plate = plates[key]
+        geometry = getattr(plate, 'plate_geometry', None) or plate.geometry
+        wells = canonical_form(plate)
+        with open(output_dir / f'{name}.{key}.canonical.json', 'w') as f:
+            json.dump({geometry.name(x): wells[x] for x in sorted(wells)}, f, indent=1)
+
+
+def summarize(samples: List[float]) -> dict:
+    median = statistics.median(samples)
+    return {
+        'median': median,
+        'mad': statistics.median(abs(x - median) for x in samples),
+        'runs': len(samples),
+    }
+
+
+def time_limit(baseline: dict, tolerance: dict, load: float = 1.0) -> float:
+    '''
+    load: how much slower the calibration workload ran than for the baseline, not below 1
+    '''
+    return ((baseline['median'] * (1 + tolerance['time_rel'])
+             + tolerance['time_mads'] * MAD_SCALE * baseline['mad']) * load
+            + tolerance['time_abs'])
+
+
+def load_factor(calibration: List[float], baseline: Optional[dict]) -> float:
+    if not baseline or not calibration:
+        return 1.0
+    return max(1.0, statistics.median(calibration) / baseline['median'])
+
+
+def memory_limit(baseline: int, tolerance: dict) -> float:
+    return baseline * (1 + tolerance['memory_rel']) + tolerance['memory_abs']
+
+
+def check_stages(name: str, stages: dict, baseline: Optional[dict], budgets: dict, tolerance: dict,
+                 load: float = 1.0) -> List[str]:
+    '''
+    The regressions of an entry's stages against its baseline and absolute budgets
+    '''
+    failures = []
+    for stage, measured in stages.items():
+        median = statistics.median(measured['times'])
+        base = (baseline or {}).get(stage)
+        if base is not None:
+            limit = time_limit(base['time'], tolerance, load)
+            if median > limit:
+                failures.append(f"{name} {stage}: {median * 1000:.2f} ms, baseline "
+                                f"{base['time']['median'] * 1000:.2f} ms, limit {limit * 1000:.2f} ms"
+                                f" (load {load:.2f})")
+            if base.get('memory') is not None and measured['memory'] is not None:
+                limit = memory_limit(base['memory'], tolerance)
+                if measured['memory'] > limit:
+                    failures.append(f"{name} {stage}: {measured['memory']} bytes traced, baseline "
+                                    f"{base['memory']}, limit {limit:.0f}")
+        budget = budgets.get(stage, {})
+        if 'time' in budget and median > budget['time']:
+            failures.append(f"{name} {stage}: {median * 1000:.2f} ms over the budget of {budget['time'] * 1000:.2f} ms")
+        if 'memory' in budget and measured['memory'] is not None and measured['memory'] > budget['memory']:
+            failures.append(f"{name} {stage}: {measured['memory']} bytes traced over the budget of {budget['memory']}")
+    return failures
+
+
+def load_json(path: Path, default):
+    if not path.exists():
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(path: Path, data):
+    from .utils import write_atomic
+    write_atomic(str(path), json.dumps(data, indent=1, sort_keys=True) + '\n')
+
+
+def run(*, manifest_path=DEFAULT_MANIFEST, data_dir=None, repeat=None, entries=None,
+        update_golden=False, record_baseline=False, output_dir=None, check_timing=True) -> dict:
+    '''
+    Runs the gate, returns {'failures': [...], 'skipped': [...], 'entries': {...}}
+    data_dir: the reference data, relative to the repository root, by default the manifest's
+        data fixture
+    '''
+    manifest_path = Path(manifest_path)
+    manifest = load_json(manifest_path, None)
+    if manifest is None or manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'{manifest_path} is not a version {MANIFEST_VERSION} corpus manifest')
+    perf_dir = manifest_path.parent
+    root = (perf_dir / manifest.get('root', '..')).resolve()
+    golden_path = perf_dir / manifest.get('golden', 'golden.json')
+    baseline_path = perf_dir / manifest.get('baseline', 'baseline.json')
+    repeat = repeat or manifest.get('repeat', 5)
+    tolerance = manifest['tolerance']
+
+    golden = load_json(golden_path, {})
+    baseline = load_json(baseline_path, {})
+    env = environment()
+    same_env = all(baseline.get('environment', {}).get(x) == env[x] for x in ('machine', 'python', 'lxml'))
+    compare_timing = check_timing and not record_baseline and same_env
+    if data_dir is None:
+        data_dir = (perf_dir / manifest.get('data', 'data')).resolve()
+    context = Context(root, data_dir)
+
+    failures, skipped, results = [], [], {}
+    new_baseline = {'environment': env, 'repeat': repeat, 'entries': {}, 'calibration': {}}
+    for entry in manifest['entries']:
+        name = entry['name']
+        if entries and name not in entries:
+            continue
+        if needs_data(entry) and context.data_hash is None:
+            failures.append(f'{name}: no reference data (chemicals.json) in {context.data_dir}')
+            continue
+        entry_golden = golden.get(name)
+        entry_data = context.data_hash if needs_data(entry) else None
+        if not update_golden and entry_golden is not None and entry_golden.get('data') != entry_data:
+            failures.append(f'{name}: the golden outputs were recorded with other reference data than '
+                            f'{context.data_dir}, record them again with --update-golden')
+            continue
+
+        try:
+            outputs, plates, stages, calibration = measure_entry(entry, context, repeat)
+        except Exception as e:
+            failures.append(f'{name}: {type(e).__name__}: {e}')
+            continue
+
+        digests = {key: output_digest(data, plates[key]) for key, data in outputs.items()}
+        results[name] = {'outputs': digests, 'stages': {
+            stage: dict(time=summarize(x['times']), memory=x['memory']) for stage, x in stages.items()}}
+        results[name]['calibration'] = summarize(calibration)
+        new_baseline['entries'][name] = results[name]['stages']
+        new_baseline['calibration'][name] = results[name]['calibration']
+
+        if update_golden:
+            golden[name] = {'data': entry_data, 'outputs': digests}
+        elif entry_golden is None:
+            failures.append(f'{name}: no golden outputs, record them with --update-golden')
+        elif entry_golden['outputs'] != digests:
+            diffs = diff_digests(entry_golden['outputs'], digests) or ['the outputs differ from the golden outputs']
+            failures.extend(f'{name} {x}' for x in diffs)
+            if output_dir is not None:
+                write_outputs(output_dir, name, outputs, plates)
+
+        if compare_timing:
+            load = load_factor(calibration, baseline.get('calibration', {}).get(name))
+            results[name]['load'] = load
+            failures.extend(check_stages(name, stages, baseline.get('entries', {}).get(name),
+                                         entry.get('budgets', {}), tolerance, load))
+
+    if 'import' in manifest and not entries:
+        spec = manifest['import']
+        results['import'] = {}
+        new_baseline['import'] = {}
+        for module, measured in measure_import(spec['modules'], spec.get('forbidden', []), repeat, root).items():
+            results['import'][module] = {'time': summarize(measured['times']), 'loaded': measured['loaded']}
+            new_baseline['import'][module] = {'time': results['import'][module]['time']}
+            median = results['import'][module]['time']['median']
+            if measured['loaded']:
+                failures.append(f"import {module}: loads {', '.join(measured['loaded'])}")
+            if median > spec['budget']:
+                failures.append(f"import {module}: {median * 1000:.1f} ms over the budget of "
+                                f"{spec['budget'] * 1000:.1f} ms")
+            base = baseline.get('import', {}).get(module)
+            if compare_timing and base is not None:
+                limit = time_limit(base['time'], tolerance)
+                if median > limit:
+                    failures.append(f"import {module}: {median * 1000:.1f} ms, baseline "
+                                    f"{base['time']['median'] * 1000:.1f} ms, limit {limit * 1000:.1f} ms")
+
+    if check_timing and not record_baseline and not same_env:
+        skipped.append('timings: the baseline was recorded on another machine or Python, see --record-baseline')
+    if update_golden:
+        write_json(golden_path, golden)
+    if record_baseline:
+        write_json(baseline_path, new_baseline)
+    return {'failures': failures, 'skipped': skipped, 'entries': results}
+
+
+def main(*, manifest, data_dir, repeat=None, entries=None, update_golden=False, record_baseline=False,
+         output_dir=None, check_timing=True, json_output=None, write_data_dir=None):
+    '''
+    write_data_dir: instead of running the gate, write the reference data of the design entries
+        (taken from data_dir) here, see write_data
+    '''
+    if write_data_dir is not None:
+        if data_dir is None:
+            raise ValueError('--write-data needs the full reference data, see --data-dir')
+        manifest_path = Path(manifest)
+        root = (manifest_path.parent / load_json(manifest_path, {}).get('root', '..')).resolve()
+        data_entries = [x for x in load_json(manifest_path, {})['entries'] if needs_data(x)]
+        counts = write_data(
+            root / data_dir, write_data_dir,
+            designs=sorted(set(root / x['design'] for x in data_entries)),
+            recipes=sorted(set(root / x['recipe'] for x in data_entries if x.get('recipe'))))
+        for name, count in counts.items():
+            print(f'{name:24} {count} rows')
+        return []
+
+    start = time.perf_counter()
+    result = run(manifest_path=manifest, data_dir=data_dir, repeat=repeat, entries=entries,
+                 update_golden=update_golden, record_baseline=record_baseline, output_dir=output_dir,
+                 check_timing=check_timing)
+    for name, entry in result['entries'].items():
+        if name == 'import':
+            for module, x in entry.items():
+                print(f"import {module:40} {x['time']['median'] * 1000:9.2f} ms")
+            continue
+        stages = ', '.join(f"{stage} {x['time']['median'] * 1000:.2f} ms" for stage, x in entry['stages'].items())
+        load = f", load {entry['load']:.2f}" if 'load' in entry else ''
+        print(f'{name:24} {stages}{load}')
+    for x in result['skipped']:
+        print(f'skipped  {x}')
+    for x in result['failures']:
+        print(f'FAILED   {x}')
+    print(f"{len(result['failures'])} failures in {time.perf_counter() - start:.1f}s")
+
+    if json_output is not None:
+        with open(json_output, 'w') as f:
+            json.dump(result, f, indent=1)
+    return result['failures']
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Performance regression gate.')
+
+    parser.add_argument('--manifest', type=str, default=str(DEFAULT_MANIFEST))
+    parser.add_argument('--data-dir', type=str, default=None,
+                        help='reference data for the design entries, relative to the repository root, '
+                             'by default the fixture in perf/data')
+    parser.add_argument('--repeat', type=int, default=None, help='timed runs per entry')
+    parser.add_argument('--entry', action='append', default=None, help='only run these entries')
+    parser.add_argument('--update-golden', action='store_true',
+                        help='record the outputs as the golden outputs')
+    parser.add_argument('--record-baseline', action='store_true',
+                        help='record the timings and memory as the baseline of this machine')
+    parser.add_argument('--no-timing', action='store_true', help='only check the outputs')
+    parser.add_argument('--output-dir', type=str, default=None,
+                        help='write the outputs that differ from the golden outputs here')
+    parser.add_argument('--json', type=str, default=None, help='write the results to this file')
+    parser.add_argument('--write-data', type=str, default=None, metavar='DIR',
+                        help='write the reference data fixture of the design entries, from --data-dir, to DIR')
+    args = parser.parse_args()
+
+    failed = main(
+        manifest=args.manifest,
+        data_dir=args.data_dir,
+        repeat=args.repeat,
+        entries=args.entry,
+        update_golden=args.update_golden,
+        record_baseline=args.record_baseline,
+        output_dir=args.output_dir,
+        check_timing=not args.no_timing,
+        json_output=args.json,
+        write_data_dir=args.write_data,
+    )
+    sys.exit(1 if failed else 0)
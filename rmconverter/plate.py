@@ -0,0 +1,108 @@
+from __future__ import annotations
+from functools import lru_cache
+from typing import Tuple, Dict
+import re
+
+from .config import constants
+
+
+_well_name_re = re.compile(r'^\s*([A-Za-z]+)\s*0*(\d+)\s*$')
+
+
+def row_name(row_idx: int) -> str:
+    '''
+    Name of a 0-based row index, eg. 0 -> A, 25 -> Z, 26 -> AA, 31 -> AF
+    '''
+    name = ''
+    row_idx += 1
+    while row_idx > 0:
+        row_idx, rem = divmod(row_idx - 1, 26)
+        name = chr(ord('A') + rem) + name
+    return name
+
+
+def row_index(name: str) -> int:
+    '''
+    Inverse of row_name
+    '''
+    row_idx = 0
+    for c in name.upper():
+        row_idx = row_idx * 26 + (ord(c) - ord('A') + 1)
+    return row_idx - 1
+
+
+class PlateGeometry:
+    '''
+    The layout of a plate. Well ids are 1-based and run along the rows:
+    A1 = 1, A2 = 2, ..., B1 = cols + 1, ...
+
+    The well names are precomputed so id <-> name lookups are a single index or dict access.
+    '''
+    __slots__ = ('rows', 'cols', 'names', 'ids')
+
+    def __init__(self, rows: int, cols: int):
+        if rows <= 0 or cols <= 0:
+            raise ValueError(f'Invalid plate geometry {rows}x{cols}')
+        self.rows = rows
+        self.cols = cols
+        self.names: Tuple[str] = tuple(
+            f'{row_name(row)}{col + 1}' for row in range(rows) for col in range(cols))
+        self.ids: Dict[str, int] = {
+            name: idx + 1 for idx, name in enumerate(self.names)}
+
+    @property
+    def size(self) -> int:
+        return len(self.names)
+
+    def name(self, well_id: int) -> str:
+        if not 0 < well_id <= len(self.names):
+            raise ValueError(f'Well id {well_id} is not in a {self}')
+        return self.names[well_id - 1]
+
+    def id(self, name: str) -> int:
+        well_id = self.ids.get(name)
+        if well_id is not None:
+            return well_id
+        # Fall back to parsing names such as 'a01' or 'B 3'
+        match = _well_name_re.match(name)
+        if match is not None:
+            row, col = row_index(match.group(1)), int(match.group(2)) - 1
+            if 0 <= row < self.rows and 0 <= col < self.cols:
+                return row * self.cols + col + 1
+        raise ValueError(f'Well {name} is not in a {self}')
+
+    def row(self, well_id: int) -> int:
+        '''0-based row of a well'''
+        return (well_id - 1) // self.cols
+
+    def col(self, well_id: int) -> int:
+        '''0-based column of a well'''
+        return (well_id - 1) % self.cols
+
+    def __repr__(self):
+        return f'{self.size} well plate ({self.rows}x{self.cols})'
+
+
+@lru_cache(maxsize=None)
+def get_geometry(rows: int, cols: int) -> PlateGeometry:
+    return PlateGeometry(rows, cols)
+
+
+PLATE_96 = get_geometry(8, 12)
+PLATE_384 = get_geometry(16, 24)
+PLATE_1536 = get_geometry(32, 48)
+
+STANDARD_GEOMETRIES = (PLATE_96, PLATE_384, PLATE_1536)
+
+DEFAULT_GEOMETRY = get_geometry(constants.DEFAULT_PLATE_ROWS, constants.DEFAULT_PLATE_COLS)
+
+
+def geometry_for_well_count(count: int) -> PlateGeometry:
+    '''
+    The smallest standard plate that holds count wells.
+    Used for formats such as RockMaker xml that don't record the plate layout.
+    '''
+    for geometry in STANDARD_GEOMETRIES:
+        if count <= geometry.size:
+            return geometry
+    raise ValueError(f'No standard plate holds {count} wells')
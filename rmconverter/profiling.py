@@ -0,0 +1,213 @@
+from __future__ import annotations
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+import json
+import sys
+import time
+
+# Profiling hooks for the command line entry points (--profile, --trace-malloc and
+# --profile-report, see add_arguments). A Profiler times the named stages of a conversion and,
+# when asked, runs cProfile and tracemalloc around it. Its report is a json serializable dict
+# tagged with the command, its inputs and options, so reports of production runs can be compared.
+# cProfile, pstats and tracemalloc are only imported when they are used.
+
+DEFAULT_TOP = 20
+
+
+class Profiler:
+    '''
+    profile: write the cProfile stats (pstats format) to this path
+    trace_malloc: record allocations with tracemalloc and report the top N allocation sites
+    report: write the json report to this path
+    tags: eg. {'command': ..., 'inputs': [...], 'options': {...}}, copied into the report
+    '''
+
+    def __init__(self, *, profile=None, trace_malloc: Optional[int] = None, report=None,
+                 tags: Optional[dict] = None, top: int = DEFAULT_TOP):
+        self.profile = profile
+        self.trace_malloc = trace_malloc
+        self.report_path = report
+        self.tags = dict(tags or {})
+        self.top = top
+        # name -> {'time', 'calls', 'peak_memory'}
+        self.stages = {}
+        # The traced peak so far and the peaks of the open stages, innermost last. tracemalloc
+        # has a single peak that each stage resets, so the peaks are carried over here.
+        self._traced_peak = 0
+        self._open_peaks = []
+        self.result = None
+        self._profiler = None
+        self._start = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.profile or self.trace_malloc or self.report_path)
+
+    def __enter__(self):
+        if self.trace_malloc:
+            import tracemalloc
+            tracemalloc.start()
+        if self.profile:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        total = time.perf_counter() - self._start
+        if self._profiler is not None:
+            self._profiler.disable()
+        self.result = self.report(total, failed=exc_info[0] is not None)
+        if self.enabled:
+            self.write_report()
+        return False
+
+    @contextmanager
+    def stage(self, name: str):
+        '''
+        Times a stage of the conversion, repeated stages (eg. per file of a batch) are summed.
+        With tracemalloc the peak traced memory of the stage is kept, including the stages
+        nested in it.
+        '''
+        tracing = self.trace_malloc and _tracemalloc_running()
+        if tracing:
+            import tracemalloc
+            self._record_peak(tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._open_peaks.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'time': 0.0, 'calls': 0, 'peak_memory': None})
+            stage['time'] += time.perf_counter() - start
+            stage['calls'] += 1
+            if tracing:
+                import tracemalloc
+                self._record_peak(tracemalloc.get_traced_memory()[1])
+                stage['peak_memory'] = max(stage['peak_memory'] or 0, self._open_peaks.pop())
+
+    def _record_peak(self, peak: int):
+        # The peak since the last reset belongs to every open stage
+        self._traced_peak = max(self._traced_peak, peak)
+        self._open_peaks[:] = [max(x, peak) for x in self._open_peaks]
+
+    def report(self, total: float, failed: bool = False) -> dict:
+        result = {
+            'tags': self.tags,
+            'failed': failed,
+            'time': total,
+            'stages': self.stages,
+            'peak_rss': peak_rss(),
+        }
+        if self._profiler is not None:
+            import pstats
+            self._profiler.dump_stats(self.profile)
+            result['profile'] = str(self.profile)
+            result['functions'] = top_functions(pstats.Stats(self._profiler), self.top)
+        if self.trace_malloc and _tracemalloc_running():
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            result['traced_memory_peak'] = max(self._traced_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            result['allocations'] = [
+                {'site': str(x.traceback), 'size': x.size, 'count': x.count}
+                for x in snapshot.statistics('lineno')[:self.trace_malloc]
+            ]
+        return result
+
+    def write_report(self):
+        if self.report_path is not None:
+            with open(self.report_path, 'w') as f:
+                json.dump(self.result, f, indent=1)
+        print_summary(self.result, file=sys.stderr)
+
+
+def _tracemalloc_running() -> bool:
+    import tracemalloc
+    return tracemalloc.is_tracing()
+
+
+def stage(profiler: Optional[Profiler], name: str):
+    '''
+    profiler.stage(name), or nothing if there is no profiler
+    '''
+    return nullcontext() if profiler is None else profiler.stage(name)
+
+
+def peak_rss() -> Optional[int]:
+    '''
+    The peak resident set size of the process in bytes, None where it isn't available
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def top_functions(stats, top: int = DEFAULT_TOP) -> list:
+    '''
+    The top functions of pstats.Stats by cumulative time
+    '''
+    functions = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        functions.append({
+            'function': f'{filename}:{line}({name})',
+            'calls': calls,
+            'tottime': tottime,
+            'cumtime': cumtime,
+        })
+    functions.sort(key=lambda x: -x['cumtime'])
+    return functions[:top]
+
+
+def print_summary(result: dict, file=sys.stderr):
+    tags = result['tags']
+    print(f"{tags.get('command', '')} {' '.join(map(str, tags.get('inputs', ())))}: "
+          f"{result['time']:.4f}s", file=file)
+    for name, x in result['stages'].items():
+        memory = '' if x['peak_memory'] is None else f", peak {x['peak_memory'] / 2**20:.1f} MiB traced"
+        print(f"    {name:12} {x['time']:.4f}s ({x['calls']}){memory}", file=file)
+    if result['peak_rss'] is not None:
+        print(f"    peak RSS {result['peak_rss'] / 2**20:.1f} MiB", file=file)
+    if 'profile' in result:
+        print(f"    profile written to {result['profile']}", file=file)
+    for x in result.get('allocations', ())[:5]:
+        print(f"    {x['size'] / 1024:.1f} KiB in {x['count']} blocks at {x['site']}", file=file)
+
+
+def positive_int(text: str) -> int:
+    import argparse
+
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'expected a positive integer, got {text}')
+    return value
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group('profiling')
+    group.add_argument('--profile', type=str, default=None,
+                       help='write cProfile stats (pstats format) to this file')
+    group.add_argument('--trace-malloc', type=positive_int, default=None, metavar='N',
+                       help='trace allocations and report the top N allocation sites')
+    group.add_argument('--profile-report', type=str, default=None,
+                       help='write the json profiling report (stage timings, peak RSS, ...) to this file')
+
+
+def from_args(args, *, command: str, inputs, options: dict) -> Optional[Profiler]:
+    '''
+    A Profiler for the options added by add_arguments, None if none were given
+    '''
+    if not (args.profile or args.trace_malloc is not None or args.profile_report):
+        return None
+    return Profiler(
+        profile=args.profile,
+        trace_malloc=args.trace_malloc,
+        report=args.profile_report,
+        tags={'command': command, 'inputs': [str(x) for x in inputs], 'options': options},
+    )
@@ -3,15 +3,13 @@ from .utils import henderson_hasselbach_mix
 from .factories.bases import _StocksFactory, _PhCurveFactory
 from .config.constants import PH_TOL, HH_PH_PKA_MAX_DIFF
 from .objects.xtaltrak import Stock, DesignItem, DesignWell
+import heapq
 import math
+import time
 from dataclasses import dataclass
 from typing import List, Tuple, Optional
 from itertools import product
 
-# TODO Temporarily hardcoded stock ids
-stockaid_avail = {3520, 1099, 110, 2440, 3601, 371, 3660, 3666, 3723, 2143, 1377, 3401, 190, 1369, 1037, 128, 903, 2702, 3066, 826, 1387, 1382, 2542, 3022, 3021, 2540, 3132, 4244, 4245, 4260, 4002, 4001, 1939, 4240, 844, 4340, 4341, 4360, 3863, 4380, 220, 1655, 219, 1362, 3121, 201, 4440, 3122, 1652, 243, 1386, 1761, 2781, 1432, 200, 315, 3740, 2363, 271, 198, 3669, 194, 1380, 146, 2606, 1394, 908, 1375, 3662, 2044, 1979, 1777, 475, 1032, 1031, 183, 291, 292, 4160, 4460, 2520, 208, 1201, 4481, 1373, 4220, 140, 1696, 2763, 622, 805, 1240, 445, 258, 1899, 1900, 196, 4500, 4520, 148, 4600, 2765, 1258, 3260, 4161, 1532, 370, 1320, 262, 1262, 938, 209, 395, 179, 830, 2800, 1378, 1379, 212, 1227, 3460, 217, 1223, 2340, 1006, 2141, 199, 4480, 2620, 273, 1672, 1265, 206, 540, 3129, 3126, 3125, 3127, 1038, 362, 1389, 299, 3131, 3124, 202, 1492, 1451, 123, 1693, 1673, 1692, 1779, 2764, 1715, 3880, 621, 2142, 3940, 940, 218, 3123, 2602, 2400, 3128, 2220, 1121, 1239, 945, 363, 234, 303, 173, 2421, 2019, 1393, 1424, 1081, 349, 1281, 1282, 2280, 825, 3864, 2200, 3743, 1361, 1010, 1011, 1260, 1363, 1266, 829, 306, 471, 1400, 626, 2160, 835, 2541, 236, 1181, 310, 1252, 1253, 138, 318, 2600, 322, 323, 2601, 1372, 1515, 121, 1244, 3024, 3025, 2607, 204, 181, 2605, 2820, 3860, 1302, 3700, 3744, 311, 117, 3641, 166, 2941, 4711, 4710, 4361, 1254, 1079, 470, 4809, 1230, 4750, 4703, 4849, 4872, 4870, 4751, 4871, 4869, 4789, 4873, 4909, 4729, 4769, 4647, 4704, 4702, 2762, 2780, 4949, 1028, 1697, 3440, 36, 4706, 418, 108, 224, 260, 293, 350, 134, 3902, 624, 4080, 520, 3721, 1259, 4241, 1007, 3720, 1778, 2861, 4020, 4180, 1431, 1592, 205, 3130, 1041, 1839, 2300, 1059, 744, 1760, 4889, 1340, 1430, 1759, 804, 2900, 1533, 1222, 789, 1383, 421, 2420, 3420, 1920, 246, 824, 444, 62, 1371, 476, 1376, 623, 1517, 4, 1039, 1699, 1392, 1119, 4714, 4713, 1246, 450, 907, 2320, 895, 211, 1758, 4140, 899, 1713, 309, 3120, 14, 1280, 320, 1780, 207, 1959, 284, 125, 43, 2360, 946, 3621, 3780, 1999}
-
-
 @dataclass
 class StockFrac:
     stock: Stock
@@ -46,17 +44,33 @@ def pick_stocks_for_well(
     phcurve_f: _PhCurveFactory,
     require_exact_ph: bool,
     return_dispenses: bool = False,
+    trace: Optional[dict] = None,
 ) -> List[Tuple[Stock, Optional[Stock]]]:
+    '''
+    trace: a dict that is filled in with what the solver did, see trace_well. It is also filled
+    in when a RecipeError is raised.
+    '''
+    if trace is not None:
+        start = time.perf_counter()
+        trace['factors'] = []
     possible_stocks = get_possible_stocks(
-        dw, stocks_f, phcurve_f, require_exact_ph)
+        dw, stocks_f, phcurve_f, require_exact_ph,
+        trace=None if trace is None else trace['factors'])
     
     num_factors = len(dw.items)
 
     # Check if there are any factors that have no possible stocks
     for i, x in enumerate(possible_stocks):
         if len(x) == 0:
+            if trace is not None:
+                trace['time'] = {'possible_stocks': time.perf_counter() - start}
             raise RecipeError(f'{dw.items[i]} has no possible stocks.')
 
+    if trace is not None:
+        combinations_start = time.perf_counter()
+        trace['combinations'] = math.prod(len(x) for x in possible_stocks)
+        trace['overflowed'] = 0
+
     idxs = [0]*num_factors
     best_dispense = [-1]
     best_stocks = None
@@ -72,6 +86,8 @@ def pick_stocks_for_well(
 
         # Do we overflow
         if sum(dispenses) > 1:
+            if trace is not None:
+                trace['overflowed'] += 1
             continue
 
         dispenses.sort()
@@ -83,6 +99,13 @@ def pick_stocks_for_well(
                 sv2 = possible_stocks[k][idxs[k]]
                 best_stocks.append((sv2.stock, sv2.high_stock))
 
+    if trace is not None:
+        end = time.perf_counter()
+        trace['time'] = {
+            'possible_stocks': combinations_start - start,
+            'combinations': end - combinations_start,
+        }
+        trace['dispenses'] = None if best_stocks is None else best_dispense
     if best_stocks is None:
         raise RecipeError('Could not generate recipe.')
     if return_dispenses:
@@ -90,40 +113,239 @@ def pick_stocks_for_well(
     return best_stocks
 
 
+def trace_well(
+    dw: DesignWell,
+    stocks_f: _StocksFactory,
+    phcurve_f: _PhCurveFactory,
+    require_exact_ph: bool,
+) -> dict:
+    '''
+    Runs pick_stocks_for_well and returns what it did as a json serializable dict:
+      - status: ok or error, and the error
+      - factors: per design item the stocks filtered as unavailable, the stocks each finder
+        (exact_match, hh, phcurve) produced and the time of each phase
+      - combinations: the size of the product of the factors' stocks, and how many overflowed
+      - time: of finding the stocks, of trying the combinations and in total
+      - stocks and dispenses of the result
+    '''
+    trace = {'status': 'ok'}
+    start = time.perf_counter()
+    try:
+        stocks = pick_stocks_for_well(dw, stocks_f, phcurve_f, require_exact_ph, trace=trace)
+    except RecipeError as e:
+        trace['status'] = 'error'
+        trace['error'] = str(e)
+        stocks = None
+    trace.setdefault('time', {})['total'] = time.perf_counter() - start
+    trace['stocks'] = None if stocks is None else [
+        [x.id, None if y is None else y.id] for x, y in stocks]
+    return trace
+
+
+def _dispense_fracs(sf: StockFrac) -> Tuple[float, ...]:
+    if sf.high_frac is not None:
+        return (sf.frac, sf.high_frac)
+    return (sf.frac,)
+
+
+def k_best_stocks_for_well(
+    dw: DesignWell,
+    stocks_f: _StocksFactory,
+    phcurve_f: _PhCurveFactory,
+    require_exact_ph: bool,
+    k: int,
+) -> List[Tuple[List[Tuple[Stock, Optional[Stock]]], List[float]]]:
+    """
+    The k best feasible (stocks, dispenses) for a well, best first, ranked as in pick_stocks_for_well
+    (the first is its result, ties are in the same order).
+
+    The combinations are enumerated best-first instead of trying the whole product. The options of
+    each factor are sorted best first and a combination's successors replace one factor's option
+    with the next one. Every factor's options dispense the same number of stocks, so a successor is
+    never better than its predecessor (prefer_dispense compares sorted dispenses lexicographically)
+    and combinations leave the heap in rank order. Overflowing combinations are expanded but not
+    returned.
+    """
+    possible_stocks = get_possible_stocks(
+        dw, stocks_f, phcurve_f, require_exact_ph)
+
+    for i, x in enumerate(possible_stocks):
+        if len(x) == 0:
+            raise RecipeError(f'{dw.items[i]} has no possible stocks.')
+
+    # Per factor: (sorted fracs, original index, fracs in dispense order, StockFrac), best first
+    options = []
+    for stocks in possible_stocks:
+        factor = [(tuple(sorted(_dispense_fracs(sf))), idx, _dispense_fracs(sf), sf)
+                  for idx, sf in enumerate(stocks)]
+        if len({len(x[0]) for x in factor}) > 1:
+            # Not expected from get_possible_stocks, the ordering argument above would not hold
+            return _k_best_by_product(possible_stocks, k)
+        factor.sort(key=lambda x: tuple(-y for y in x[0]))
+        options.append(factor)
+
+    def entry(position):
+        dispenses = []
+        for factor, i in zip(options, position):
+            dispenses.extend(factor[i][2])
+        overflow = sum(dispenses) > 1
+        dispenses.sort()
+        original = tuple(factor[i][1] for factor, i in zip(options, position))
+        # Best first, then in product order for ties
+        return (tuple(-x for x in dispenses), original, position, overflow, dispenses)
+
+    results = []
+    heap = [entry((0,) * len(options))]
+    # The tied combinations popped so far, sorted by product order once the tie ends
+    tied = []
+    while heap and len(results) < k:
+        item = heapq.heappop(heap)
+        if tied and item[0] != tied[0][0]:
+            results.extend(sorted(tied))
+            tied = []
+        if not item[3]:
+            tied.append(item)
+        position = item[2]
+        # Successors only advance factors from the last advanced one on, so each is pushed once
+        last = max((i for i, x in enumerate(position) if x > 0), default=0)
+        for j in range(last, len(options)):
+            if position[j] + 1 < len(options[j]):
+                heapq.heappush(heap, entry(position[:j] + (position[j] + 1,) + position[j + 1:]))
+    results.extend(sorted(tied))
+
+    return [
+        ([(options[f][i][3].stock, options[f][i][3].high_stock) for f, i in enumerate(item[2])], item[4])
+        for item in results[:k]
+    ]
+
+
+def _k_best_by_product(possible_stocks, k):
+    ranked = []
+    for idxs in product(*[range(len(x)) for x in possible_stocks]):
+        dispenses = []
+        for stocks, idx in zip(possible_stocks, idxs):
+            dispenses.extend(_dispense_fracs(stocks[idx]))
+        if sum(dispenses) > 1:
+            continue
+        dispenses.sort()
+        ranked.append((tuple(-x for x in dispenses), idxs, dispenses))
+    ranked.sort()
+    return [
+        ([(possible_stocks[f][i].stock, possible_stocks[f][i].high_stock) for f, i in enumerate(idxs)], dispenses)
+        for _, idxs, dispenses in ranked[:k]
+    ]
+
+
 def get_possible_stocks(
     dw: DesignWell,
     stocks_f: _StocksFactory,
     phcurve_f: _PhCurveFactory,
     require_exact_ph: bool,
     filter_unavailable: bool = True,
+    trace: Optional[list] = None,
 ) -> list:
+    '''
+    trace: a list that a dict per factor is appended to, see trace_factor
+    '''
     # TODO There are dispense values that are very close to zero but negative
     all_possible_stocks = []
     for di in dw.items:
         possible_stocks = []
+        factor_trace = None if trace is None else trace_factor(di, stocks_f, filter_unavailable)
+        timer = _PhaseTimer(factor_trace)
         # TODO Name instead of id?
-        factor_stocks = stocks_f.get_stocks_by_chemid(di.chemical.id)
-        # Filter out stocks that are not available
+        # The available stocks of each chemical are precomputed by the factory, see StockAvailability
         if filter_unavailable:
-            factor_stocks = [fs for fs in factor_stocks if fs.available and fs.id in stockaid_avail]
+            factor_stocks = stocks_f.get_available_stocks_by_chemid(di.chemical.id)
+        else:
+            factor_stocks = stocks_f.get_stocks_by_chemid(di.chemical.id)
+        timer.lap('stocks', None)
         if di.ph is None:
             possible_stocks += find_exact_match(di,
                                                 factor_stocks, require_exact_ph)
+            timer.lap('exact_match', possible_stocks)
         else:
             # Henderson Hasselbach
             possible_stocks += find_hh_stocks(di, factor_stocks)
+            timer.lap('hh', possible_stocks)
             possible_stocks += find_phcurve_stocks(di, stocks_f, phcurve_f)
+            timer.lap('phcurve', possible_stocks)
             # If a stock pair can't be found by mixing buffers fallback to an exact match
             # Rockmaker complains if a buffer only has one stock so this is only done if stocks cant
             # be found by another means
             if len(possible_stocks) == 0:
                 possible_stocks += find_exact_match(di,
                                                     factor_stocks, require_exact_ph)
+                timer.lap('exact_match', possible_stocks)
         
         all_possible_stocks.append(possible_stocks)
+        if trace is not None:
+            factor_trace['possible_stocks'] = len(possible_stocks)
+            trace.append(factor_trace)
     return all_possible_stocks
 
 
+def stock_frac_trace(sf: StockFrac) -> dict:
+    return {
+        'stock': sf.stock.id,
+        'name': sf.stock.name,
+        'frac': sf.frac,
+        'high_stock': None if sf.high_stock is None else sf.high_stock.id,
+        'high_name': None if sf.high_stock is None else sf.high_stock.name,
+        'high_frac': sf.high_frac,
+    }
+
+
+def trace_factor(di: DesignItem, stocks_f: _StocksFactory, filter_unavailable: bool) -> dict:
+    '''
+    The start of the trace of a design item: what it asks for and which of its chemical's stocks
+    were filtered out as unavailable. get_possible_stocks adds what each finder produced and the
+    time it took.
+    '''
+    unavailable = []
+    if filter_unavailable:
+        available = {x.id for x in stocks_f.get_available_stocks_by_chemid(di.chemical.id)}
+        unavailable = [
+            {'stock': x.id, 'name': x.name}
+            for x in stocks_f.get_stocks_by_chemid(di.chemical.id) if x.id not in available
+        ]
+    return {
+        'chemical': di.chemical.name,
+        'chemical_id': di.chemical.id,
+        'class': di.item_class,
+        'concentration': di.concentration,
+        'units': di.units,
+        'ph': di.ph,
+        'unavailable': unavailable,
+        'finders': {},
+        'time': {},
+    }
+
+
+class _PhaseTimer:
+    '''
+    Records the time since the last lap and the stocks found by each finder into a factor trace.
+    Does nothing without a trace.
+    '''
+    __slots__ = ('trace', 'last', 'found')
+
+    def __init__(self, trace: Optional[dict]):
+        self.trace = trace
+        self.found = 0
+        if trace is not None:
+            self.last = time.perf_counter()
+
+    def lap(self, phase: str, possible_stocks: Optional[list]):
+        if self.trace is None:
+            return
+        self.trace['time'][phase] = time.perf_counter() - self.last
+        if possible_stocks is not None:
+            self.trace['finders'][phase] = [stock_frac_trace(x) for x in possible_stocks[self.found:]]
+            self.found = len(possible_stocks)
+        # Recording isn't part of the next phase
+        self.last = time.perf_counter()
+
+
 def find_exact_match(
         di: DesignItem,
         factor_stocks: List[Stock],
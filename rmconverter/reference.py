@@ -0,0 +1,190 @@
+from __future__ import annotations
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+import itertools
+import logging
+import os
+import threading
+
+# Reloads the JSON reference data (chemicals, stocks, pH curves, ...) of a long running process.
+#
+# Each load builds a new, complete set of factories (a generation) which is swapped in with a
+# single assignment. A conversion should take the current generation once and use it throughout,
+# it then keeps the data it started with even if a newer generation is swapped in meanwhile.
+
+logger = logging.getLogger(__name__)
+
+# The files of a data directory that the factories read
+DATA_FILES = (
+    'chemicals.json',
+    'chemical_alias.json',
+    'stocks.json',
+    'stock_availability.json',
+    'ph_curves.json',
+    'ph_points.json',
+    'chem_group_members.json',
+)
+
+# file name -> (mtime_ns, size), None if the file does not exist
+Signature = Tuple[Tuple[str, Optional[Tuple[int, int]]], ...]
+
+
+def data_signature(data_dir) -> Signature:
+    signature = []
+    for name in DATA_FILES:
+        try:
+            st = os.stat(os.path.join(data_dir, name))
+        except FileNotFoundError:
+            signature.append((name, None))
+        else:
+            signature.append((name, (st.st_mtime_ns, st.st_size)))
+    return tuple(signature)
+
+
+def _default_factories(data_dir):
+    from .create_rxml import FactoriesJSON
+    return FactoriesJSON(data_dir=data_dir)
+
+
+class ReferenceData:
+    '''
+    One generation of loaded reference data. Never modified once built.
+    '''
+    __slots__ = ('generation', 'data_dir', 'signature', 'factories')
+
+    def __init__(self, generation: int, data_dir, signature: Signature, factories):
+        self.generation = generation
+        self.data_dir = data_dir
+        self.signature = signature
+        self.factories = factories
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set. Unset slots (eg. while unpickling or copying)
+        # and dunders aren't forwarded, reading self.factories would recurse.
+        if name.startswith('__') or name in ReferenceData.__slots__:
+            raise AttributeError(name)
+        # Forward chems, stocks, phcurve, design, ... so a generation can be passed as a factory
+        return getattr(self.factories, name)
+
+    def __repr__(self):
+        return f'ReferenceData(generation={self.generation}, data_dir={str(self.data_dir)!r})'
+
+
+class ReferenceDataManager:
+    '''
+    Holds the current ReferenceData of a data directory and loads a new generation when the
+    files change.
+
+    check() reloads if the files changed, start() does so from a background thread every
+    poll_interval seconds. A change is only loaded once the files have been unchanged for one
+    poll, so a half written file is not picked up. If loading fails the current generation is kept.
+
+    Caches that depend on the reference data are registered with register_cache (anything with a
+    clear() method) and cleared on each swap; add_listener callbacks are called with the new generation.
+
+    factories_fn(data_dir) builds the factories, by default create_rxml.FactoriesJSON.
+    '''
+
+    def __init__(self, data_dir, *, factories_fn: Optional[Callable] = None, poll_interval: float = 2.0):
+        self.data_dir = Path(data_dir)
+        self.poll_interval = poll_interval
+        self._factories_fn = _default_factories if factories_fn is None else factories_fn
+        self._generations = itertools.count(1)
+        self._reload_lock = threading.Lock()
+        self._caches = []
+        self._listeners = []
+        self._pending: Optional[Signature] = None
+        self._failed: Optional[Signature] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self._current = self._load(data_signature(self.data_dir))
+
+    @property
+    def current(self) -> ReferenceData:
+        return self._current
+
+    @property
+    def generation(self) -> int:
+        return self._current.generation
+
+    def register_cache(self, cache):
+        self._caches.append(cache)
+        return cache
+
+    def add_listener(self, fn: Callable[[ReferenceData], None]):
+        self._listeners.append(fn)
+
+    def _load(self, signature: Signature) -> ReferenceData:
+        factories = self._factories_fn(self.data_dir)
+        return ReferenceData(next(self._generations), self.data_dir, signature, factories)
+
+    def reload(self) -> ReferenceData:
+        '''
+        Loads a new generation and swaps it in, regardless of whether the files changed
+        '''
+        with self._reload_lock:
+            return self._swap(self._load(data_signature(self.data_dir)))
+
+    def _swap(self, reference: ReferenceData) -> ReferenceData:
+        self._current = reference
+        self._pending = None
+        self._failed = None
+        for cache in self._caches:
+            cache.clear()
+        for fn in self._listeners:
+            fn(reference)
+        logger.info('Loaded reference data %s', reference)
+        return reference
+
+    def check(self) -> bool:
+        '''
+        Reloads if the data files changed and have since been stable for one check.
+        Returns True if a new generation was swapped in.
+        '''
+        with self._reload_lock:
+            signature = data_signature(self.data_dir)
+            if signature == self._current.signature or signature == self._failed:
+                self._pending = None
+                return False
+            if signature != self._pending:
+                # Wait for the next check in case the files are still being written
+                self._pending = signature
+                return False
+            try:
+                reference = self._load(signature)
+            except Exception:
+                logger.exception('Failed to load reference data from %s, keeping %s',
+                                 self.data_dir, self._current)
+                # Don't retry until the files change again
+                self._pending = None
+                self._failed = signature
+                return False
+            self._swap(reference)
+            return True
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            self.check()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._watch, name='reference-data-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,177 @@
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional
+import argparse
+import json
+import sys
+
+from .canonical import content_hash, design_wells, diff_wells, screen_wells
+from .watch import DESIGN, RXML, input_kind
+
+# Checks that conversions preserve the chemistry of a corpus, comparing canonical forms
+# (see canonical.py) rather than xml text:
+#   - a CrystalTrak design goes to RockMaker xml and back to a design (rmscreen2design)
+#   - a RockMaker xml file is parsed, written and parsed again
+# The files are checked in parallel worker processes, each loading the reference data once.
+
+# The reference data of a worker process
+_factory = None
+
+
+def _init_worker(data_dir):
+    global _factory
+    if data_dir is not None:
+        from .create_rxml import FactoriesJSON
+        _factory = FactoriesJSON(data_dir=data_dir)
+
+
+def roundtrip_design(factory, data: bytes, fuzzy_threshold: Optional[float] = None):
+    '''
+    (canonical design, canonical design after CrystalTrak -> RockMaker -> CrystalTrak)
+    The classes of the original are the ones design2screen writes, after its buffer class fixes
+    (one pH, one stock), so a buffer written as a precipitant isn't reported as a difference.
+    '''
+    from lxml import etree
+    from .factories import rockmaker
+    from .factories.convert import design2screen, rmscreen2design
+
+    design = factory.design.get_design_from_xml_object(etree.fromstring(data))
+    # As create_rxml.to_rm_xml_bytes, but keeping the design whose items design2screen fixed
+    rxml = design2screen(design=design, recipe=None, stocks_f=factory.stocks, phcurve_f=factory.phcurve,
+                         require_exact_ph=True).to_xml_bytes()
+    screen = rockmaker.screen_from_rxml_dom(etree.fromstring(rxml), name=design.name)
+    # The design is written with the geometry of the original
+    screen.geometry = design.geometry
+    result = rmscreen2design(screen, factory.chems, stocks_f=factory.stocks,
+                             fuzzy_threshold=fuzzy_threshold, phcurve_f=factory.phcurve)
+    return design_wells(design), design_wells(result), design.geometry
+
+
+def roundtrip_rxml(data: bytes):
+    '''
+    (canonical screen, canonical screen after writing and reading it again)
+    '''
+    from lxml import etree
+    from .factories import rockmaker
+
+    screen = rockmaker.screen_from_rxml_dom(etree.fromstring(data))
+    again = rockmaker.screen_from_rxml_dom(etree.fromstring(screen.to_xml_bytes()))
+    return screen_wells(screen), screen_wells(again), screen.plate_geometry
+
+
+def check_file(path, fuzzy_threshold: Optional[float] = None) -> dict:
+    '''
+    The report of one file: path, kind, status (ok, diff, error or skipped), the hashes
+    before and after, and the differing wells
+    '''
+    report = {'path': str(path), 'kind': None, 'status': 'skipped'}
+    try:
+        data = Path(path).read_bytes()
+        kind = report['kind'] = input_kind(data)
+        if kind == DESIGN:
+            if _factory is None:
+                raise ValueError('Designs need the reference data, see --data-dir')
+            before, after, geometry = roundtrip_design(_factory, data, fuzzy_threshold)
+        elif kind == RXML:
+            before, after, geometry = roundtrip_rxml(data)
+        else:
+            return report
+    except Exception as e:
+        report.update(status='error', error=f'{type(e).__name__}: {e}')
+        return report
+
+    report['hash'] = content_hash(before)
+    report['roundtrip_hash'] = content_hash(after)
+    report['status'] = 'ok' if report['hash'] == report['roundtrip_hash'] else 'diff'
+    report['wells'] = [
+        {'well': geometry.name(well_id) if 0 < well_id <= geometry.size else well_id,
+         'before': only_before, 'after': only_after}
+        for well_id, only_before, only_after in diff_wells(before, after)
+    ]
+    return report
+
+
+def corpus_files(paths: Iterable) -> List[Path]:
+    '''
+    The xml files of the given files and directories
+    '''
+    files = []
+    for path in map(Path, paths):
+        files.extend(sorted(path.glob('*.xml')) if path.is_dir() else [path])
+    return files
+
+
+def check_corpus(paths: Iterable, data_dir=None, workers: Optional[int] = None,
+                 fuzzy_threshold: Optional[float] = None) -> Iterator[dict]:
+    '''
+    Reports for the files in order, checked by worker processes
+    '''
+    files = corpus_files(paths)
+    if workers == 1:
+        _init_worker(data_dir)
+        for path in files:
+            yield check_file(path, fuzzy_threshold)
+        return
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(data_dir,)) as pool:
+        yield from pool.map(check_file, files, [fuzzy_threshold] * len(files))
+
+
+def main(*, paths, data_dir, workers=None, fuzzy_threshold=None, json_output=None, profiler=None):
+    '''
+    profiler: a profiling.Profiler. It only sees this process, use --workers 1 to profile the
+        round trips themselves.
+    '''
+    from .profiling import stage
+
+    reports = []
+    with stage(profiler, 'check'):
+        for report in check_corpus(paths, data_dir=data_dir, workers=workers,
+                                   fuzzy_threshold=fuzzy_threshold):
+            reports.append(report)
+            line = f"{report['status']:8} {report['path']}"
+            if report['status'] == 'error':
+                line += f" {report['error']}"
+            elif report['status'] == 'diff':
+                line += f" {len(report['wells'])} wells differ"
+            print(line)
+            for well in report.get('wells', ()):
+                print(f"    {well['well']}: - {well['before']}\n    {' ' * len(str(well['well']))}  + {well['after']}")
+
+    if json_output is not None:
+        with stage(profiler, 'write'), open(json_output, 'w') as f:
+            json.dump(reports, f, indent=1)
+    return [x for x in reports if x['status'] in ('diff', 'error')]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Round trip a corpus of designs and RockMaker xml.')
+
+    parser.add_argument('paths', nargs='+', help='xml files or directories of them')
+    parser.add_argument('--data-dir', type=str, default='data')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes, default the number of CPUs')
+    parser.add_argument('--fuzzy-threshold', type=float, default=None)
+    parser.add_argument('--json', type=str, default=None, help='write the reports to this file')
+
+    from contextlib import nullcontext
+    from . import profiling
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    profiler = profiling.from_args(
+        args, command='roundtrip', inputs=args.paths,
+        options={'data_dir': args.data_dir, 'workers': args.workers,
+                 'fuzzy_threshold': args.fuzzy_threshold, 'json': args.json})
+    with profiler or nullcontext():
+        failed = main(
+            paths=args.paths,
+            data_dir=args.data_dir,
+            workers=args.workers,
+            fuzzy_threshold=args.fuzzy_threshold,
+            json_output=args.json,
+            profiler=profiler,
+        )
+    sys.exit(1 if failed else 0)
@@ -1,18 +1,20 @@
 from .config import constants
+from .plate import PlateGeometry, DEFAULT_GEOMETRY
 
 import math
+import os
 import re
+import secrets
+import stat
+from typing import Optional, Union
 
 
-def wellname2id(name: str) -> int:
-    well_id = (ord(name[0]) - ord('A'))*12 + int(name[1:])
-    return well_id
+def wellname2id(name: str, geometry: Optional[PlateGeometry] = None) -> int:
+    return (DEFAULT_GEOMETRY if geometry is None else geometry).id(name)
 
 
-def wellid2name(well_id: int) -> str:
-    assert (well_id > 0)
-    well_idx = well_id - 1
-    return chr(ord('A') + well_idx//12) + str(well_idx % 12 + 1)
+def wellid2name(well_id: int, geometry: Optional[PlateGeometry] = None) -> str:
+    return (DEFAULT_GEOMETRY if geometry is None else geometry).name(well_id)
 
 
 def frac2ratio(base_frac: int) -> float:
@@ -93,10 +95,11 @@ def partnumber_to_barcode(partnumber):
     return ''
 
 
+_tacsimate_re = re.compile("^tacsimate")
+
+
 def _is_tacsimate(name: str):
-    import re
-    x = re.search("^tacsimate", name)
-    return x != None
+    return _tacsimate_re.match(name) is not None
 
 
 def henderson_hasselbach_mix(pka: float, low_ph: float, high_ph: float, desired_ph: float) -> float:
@@ -119,3 +122,58 @@ def henderson_hasselbach_mix(pka: float, low_ph: float, high_ph: float, desired_
     fraction_low = frac_num / frac_denom
 
     return fraction_low
+
+
+def write_atomic(path, data: Union[str, bytes]):
+    '''
+    Writes to a temporary file next to path and renames it into place,
+    so readers never see a partially written file. str is written as UTF-8.
+    The file keeps the mode of the file it replaces, a new file gets the mode open() would give it.
+    '''
+    dirname, basename = os.path.split(os.path.abspath(path))
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = None
+    while True:
+        tmp_path = os.path.join(dirname, f'.{basename}.{secrets.token_hex(4)}.tmp')
+        try:
+            # As open() does, so the kernel applies the current umask
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        except FileExistsError:
+            continue
+        break
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data.encode('utf-8') if isinstance(data, str) else data)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def xml_root(source):
+    '''
+    The root element of an lxml element, bytes-like object, binary stream or path
+    '''
+    from lxml import etree
+    if isinstance(source, etree._Element):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return etree.fromstring(bytes(source) if not isinstance(source, bytes) else source)
+    if hasattr(source, 'read'):
+        return etree.parse(source).getroot()
+    return etree.parse(os.fspath(source)).getroot()
+
+
+def write_bytes(output, data: bytes):
+    '''
+    Writes to a binary stream, or to a path
+    '''
+    if hasattr(output, 'write'):
+        output.write(data)
+    else:
+        with open(output, 'wb') as f:
+            f.write(data)
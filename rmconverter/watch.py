@@ -0,0 +1,354 @@
+from __future__ import annotations
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+import argparse
+import hashlib
+import io
+import json
+import logging
+import time
+
+from .create_rxml import rockmaker_filename
+from .utils import write_atomic
+
+# Watches folders for CrystalTrak design exports and RockMaker xml files and converts the ones that
+# are new or changed:
+#   - a design (<crystaltrak datatype="design">) becomes <name>_RockMaker.xml, using the recipe
+#     <stem>_recipe.xml next to it if there is one. If another input's output or a file that
+#     isn't an output already has that name, it becomes <stem>_RockMaker.xml instead.
+#   - a RockMaker screen (<screen>) becomes <stem>_xtaltrak_recipe.xml
+# The folders are polled, a file is converted once its size and mtime have not changed for the
+# settle time. A journal in each folder records the content hash of every converted input so
+# unchanged files are not converted again, including after a restart. Inputs that failed are
+# tried again when the reference data is reloaded.
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_NAME = '.rmconverter-watch.json'
+RECIPE_SUFFIX = '_recipe'
+XTALTRAK_SUFFIX = '_xtaltrak_recipe'
+
+DESIGN = 'design'
+RXML = 'rxml'
+
+
+def xtaltrak_filename(stem) -> Path:
+    return Path(f'{stem}{XTALTRAK_SUFFIX}.xml')
+
+
+def input_kind(data: bytes) -> Optional[str]:
+    '''
+    DESIGN, RXML or None, from the root element
+    '''
+    from lxml import etree
+    try:
+        for _, root in etree.iterparse(io.BytesIO(data), events=('start',)):
+            if root.tag == 'crystaltrak' and root.get('datatype') == 'design':
+                return DESIGN
+            if root.tag == 'screen':
+                return RXML
+            return None
+    except etree.XMLSyntaxError:
+        return None
+    return None
+
+
+class Journal:
+    '''
+    input file name -> {'hash': content hash, 'output': output file name}, stored as json
+    '''
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        if path.exists():
+            try:
+                with open(path) as fp:
+                    self.entries = json.load(fp)
+            except ValueError:
+                logger.warning('Ignoring unreadable journal %s', path)
+
+    def get(self, name: str) -> Optional[dict]:
+        return self.entries.get(name)
+
+    def outputs(self):
+        return {x['output'] for x in self.entries.values() if x.get('output')}
+
+    def owner(self, output: str) -> Optional[str]:
+        '''
+        The input whose output is named output
+        '''
+        for name, entry in self.entries.items():
+            if entry.get('output') == output:
+                return name
+        return None
+
+    def record(self, name: str, content_hash: str, output: Optional[str], error: Optional[str] = None):
+        self.entries[name] = {'hash': content_hash, 'output': output, 'error': error}
+        write_atomic(self.path, json.dumps(self.entries, indent=1, sort_keys=True))
+
+
+class FolderWatcher:
+    '''
+    Polls folders and converts new or changed inputs, see the module comment.
+
+    factory: A create_rxml.FactoriesJSON or reference.ReferenceDataManager
+    settle: Seconds a file must be unchanged before it is converted
+    '''
+
+    def __init__(self, folders: Iterable, factory, *, volume: float = 1000,
+                 require_exact_ph: bool = True, include_aliases: bool = False, settle: float = 2.0):
+        self.folders = [Path(x) for x in folders]
+        self.factory = factory
+        self.volume = volume
+        self.require_exact_ph = require_exact_ph
+        self.include_aliases = include_aliases
+        self.settle = settle
+        self.journals = {folder: Journal(folder / JOURNAL_NAME) for folder in self.folders}
+        # path -> ((mtime_ns, size), first seen with that stat)
+        self._seen: Dict[Path, Tuple[Tuple[int, int], float]] = {}
+        # path -> stats of the input and its recipe when it was last processed,
+        # so unchanged files are not even read and hashed again
+        self._processed: Dict[Path, tuple] = {}
+
+    def _factory(self):
+        # A ReferenceDataManager
+        if hasattr(self.factory, 'current'):
+            return self.factory.current
+        return self.factory
+
+    def _generation(self):
+        # The generation of a ReferenceDataManager's data, None for fixed reference data
+        return getattr(self.factory, 'generation', None)
+
+    def _options(self, kind: str) -> str:
+        if kind == DESIGN:
+            return f'include_aliases={self.include_aliases}'
+        return f'volume={self.volume} require_exact_ph={self.require_exact_ph}'
+
+    def _is_output(self, path: Path, journal: Journal) -> bool:
+        # Only what the journal says was written here, a RockMaker screen named like an output
+        # that came from elsewhere is still an input
+        return path.name in journal.outputs()
+
+    @staticmethod
+    def _output_taken(journal: Journal, path: Path, output: Path) -> bool:
+        '''
+        Whether writing output for path would overwrite another input's output or a file that
+        isn't an output
+        '''
+        owner = journal.owner(output.name)
+        if owner is None:
+            return output.exists()
+        return owner != path.name and (path.parent / owner).exists()
+
+    def settled_files(self, now: Optional[float] = None):
+        '''
+        The inputs whose size and mtime have not changed for the settle time
+        '''
+        now = time.monotonic() if now is None else now
+        for folder in self.folders:
+            journal = self.journals[folder]
+            for path in sorted(folder.glob('*.xml')):
+                if self._is_output(path, journal):
+                    continue
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                stat = (st.st_mtime_ns, st.st_size)
+                seen = self._seen.get(path)
+                if seen is None or seen[0] != stat:
+                    self._seen[path] = (stat, now)
+                    if self.settle > 0:
+                        continue
+                elif now - seen[1] < self.settle:
+                    continue
+                if self._processed.get(path) == (self._stats(path), self._generation()):
+                    continue
+                yield folder, path
+
+    @staticmethod
+    def _stats(path: Path):
+        stats = []
+        for p in (path, path.with_name(f'{path.stem}{RECIPE_SUFFIX}.xml')):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                stats.append(None)
+            else:
+                stats.append((st.st_mtime_ns, st.st_size))
+        return tuple(stats)
+
+    def process(self, folder: Path, path: Path) -> Optional[Path]:
+        '''
+        Converts path if its content (or its recipe) changed since it was last converted, or if
+        it failed. Returns the output written, if any.
+        '''
+        journal = self.journals[folder]
+        self._processed[path] = (self._stats(path), self._generation())
+        try:
+            data = path.read_bytes()
+        except OSError as e:
+            # eg. deleted or renamed since it was listed
+            logger.warning('Could not read %s: %s', path, e)
+            return None
+        kind = input_kind(data)
+        if kind is None:
+            return None
+
+        recipe_path = path.with_name(f'{path.stem}{RECIPE_SUFFIX}.xml')
+        recipe = None
+        if kind == DESIGN:
+            try:
+                recipe = recipe_path.read_bytes()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning('Could not read %s: %s', recipe_path, e)
+                return None
+
+        hasher = hashlib.sha256(data)
+        if recipe is not None:
+            hasher.update(recipe)
+        hasher.update(self._options(kind).encode())
+        content_hash = hasher.hexdigest()
+
+        entry = journal.get(path.name)
+        # A failure may be fixed by new reference data, so only successes are skipped
+        if entry is not None and entry['hash'] == content_hash and not entry.get('error'):
+            return None
+
+        try:
+            output_path, xml = self.convert(kind, path, data, recipe)
+            if self._output_taken(journal, path, output_path) and kind == DESIGN:
+                # eg. two designs with the same name
+                stem_output = path.parent / rockmaker_filename(path.stem)
+                logger.warning('%s is taken, writing %s to %s', output_path.name, path, stem_output.name)
+                output_path = stem_output
+            if self._output_taken(journal, path, output_path):
+                raise FileExistsError(f'{output_path} is not an output of {path.name}')
+        except Exception as e:
+            logger.exception('Failed to convert %s', path)
+            # The output of an earlier conversion is still this input's
+            journal.record(path.name, content_hash, None if entry is None else entry.get('output'),
+                           error=repr(e))
+            return None
+        write_atomic(output_path, xml)
+        journal.record(path.name, content_hash, output_path.name)
+        logger.info('Converted %s -> %s', path, output_path)
+        return output_path
+
+    def convert(self, kind: str, path: Path, data: bytes, recipe: Optional[bytes]):
+        from lxml import etree
+        factory = self._factory()
+        if kind == DESIGN:
+            from .create_rxml import to_rm_xml_bytes
+            design_xo = etree.fromstring(data)
+            recipe_xo = None if recipe is None else etree.fromstring(recipe)
+            # The output is named after the design, like the RockMaker screen
+            name = design_xo.find('reservoir_design').get('name') or path.stem
+            xml = to_rm_xml_bytes(factory=factory, design_xo=design_xo, recipe_xo=recipe_xo,
+                            include_aliases=self.include_aliases)
+            return path.parent / rockmaker_filename(name), xml
+
+        from .create_xtaltrak_recipe import convert_screen_bytes
+        from .factories import rockmaker
+        screen = rockmaker.screen_from_rxml_dom(etree.fromstring(data), name=path.stem)
+        xml = convert_screen_bytes(screen=screen, volume=self.volume,
+                             require_exact_ph=self.require_exact_ph, factory=factory)
+        return path.parent / xtaltrak_filename(path.stem), xml
+
+    def poll(self):
+        '''
+        One pass over the folders, returns the outputs written
+        '''
+        outputs = []
+        for folder, path in list(self.settled_files()):
+            try:
+                output = self.process(folder, path)
+            except OSError:
+                # eg. the output or journal could not be written, carry on with the other files
+                logger.exception('Failed to process %s', path)
+                continue
+            if output is not None:
+                outputs.append(output)
+        return outputs
+
+    def run(self, interval: float = 1.0, profiler=None):
+        from .profiling import stage
+
+        while True:
+            with stage(profiler, 'poll'):
+                self.poll()
+            if hasattr(self.factory, 'check'):
+                self.factory.check()
+            time.sleep(interval)
+
+
+def main(*, folders, data_dir, volume, require_exact_ph, include_aliases, interval, settle, once,
+         profiler=None):
+    '''
+    profiler: a profiling.Profiler, the stages of the polls are summed
+    '''
+    from .profiling import stage
+    from .reference import ReferenceDataManager
+
+    with stage(profiler, 'load_data'):
+        reference = ReferenceDataManager(data_dir)
+    watcher = FolderWatcher(
+        folders,
+        reference,
+        volume=volume,
+        require_exact_ph=require_exact_ph,
+        include_aliases=include_aliases,
+        settle=0 if once else settle,
+    )
+    if once:
+        with stage(profiler, 'poll'):
+            return watcher.poll()
+    watcher.run(interval, profiler=profiler)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Converts designs and RockMaker xml dropped into folders.')
+
+    parser.add_argument('folders', nargs='+')
+    parser.add_argument('--data-dir', type=str, default='data')
+    parser.add_argument('--volume', type=float, default=1000,
+                        help='volume per well in uL')
+    parser.add_argument('--require-exact-ph',
+                        action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--include-aliases', action='store_true')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between polls')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='seconds a file must be unchanged before it is converted')
+    parser.add_argument('--once', action='store_true',
+                        help='convert what is there and exit')
+
+    from contextlib import nullcontext
+    from . import profiling
+    profiling.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    profiler = profiling.from_args(
+        args, command='watch', inputs=args.folders,
+        options={'data_dir': args.data_dir, 'volume': args.volume,
+                 'require_exact_ph': args.require_exact_ph, 'include_aliases': args.include_aliases,
+                 'interval': args.interval, 'settle': args.settle, 'once': args.once})
+    with profiler or nullcontext():
+        main(
+            folders=args.folders,
+            data_dir=args.data_dir,
+            volume=args.volume,
+            require_exact_ph=args.require_exact_ph,
+            include_aliases=args.include_aliases,
+            interval=args.interval,
+            settle=args.settle,
+            once=args.once,
+            profiler=profiler,
+        )